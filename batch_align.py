@@ -0,0 +1,239 @@
+"""
+Batch alignment of many runs in a process pool.
+
+A run is a directory holding the EMON trace (emon_raw_data.txt) and a ThermaPy trace, laid out like 'examples/Prime95'
+or 'RPL_examples/PCMark10/65_degrees'. The ThermaPy trace is taken, in order of preference, from a ThermaPy cache
+directory (*.cache), a parsed CSV (parsed_*.csv) or the raw capture (thermapy_raw_data.csv, or the zip archive holding
+it). Raw captures are decoded with ThermapyDataParser from the ThermaPy lab code (--thermapy-lab-path). A DAQ trace
+(*daq*.csv) next to the EMON trace is used when present.
+
+Runs are either discovered under a root directory or listed in a JSON manifest:
+
+    [
+        {"name": "Prime95", "emon_file": "Prime95/emon_raw_data.txt", "thermalpy_file": "Prime95/parsed.cache",
+         "daq_file": "Prime95/NiDaq.csv"},
+        {"name": "PCMark10_65", "emon_file": "PCMark10/emon_raw_data.txt",
+         "thermalpy_raw_file": "PCMark10/thermapy_raw_data.zip"}
+    ]
+
+Relative manifest paths are relative to the manifest location. Every run writes '<name>.<format>', '<name>.html'
+(unless --report none) and '<name>.log' to the output directory. A failing run is recorded and does not stop the
+batch. The per-run status, duration and alignment offsets are written to 'summary.csv'.
+
+:example:
+
+    C:\\Program Files\\SPEED\\speed.exe run batch_align.py --root examples --output-dir out --workers 4
+"""
+import argparse
+import contextlib
+import fnmatch
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas
+
+from thermapy_parser import ARCHIVE_SUFFIX, is_cache, parse_capture
+from trace_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, TraceCache
+from trace_output import OUTPUT_FORMATS
+from chart_decimation import REPORT_MODES
+
+EMON_FILE = 'emon_raw_data.txt'
+PARSED_THERMAPY_PATTERN = 'parsed_*.csv'
+RAW_THERMAPY_PATTERNS = ('thermapy_raw_data*.csv', 'thermapy_raw_data*' + ARCHIVE_SUFFIX)
+DAQ_PATTERN = '*daq*.csv'
+SUMMARY_FILE = 'summary.csv'
+SUMMARY_COLUMNS = ['name', 'status', 'seconds', 'emon_offset', 'emon_correlation', 'daq_offset', 'daq_correlation',
+                   'output_file', 'error']
+
+
+def _parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description="Align many EMON/ThermalPy(/DAQ) runs in parallel",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--root", help="Root directory to discover run directories under")
+    source.add_argument("--manifest", help="JSON manifest listing the runs")
+    parser.add_argument("--output-dir", "-o", help="Directory of the per-run outputs and the summary", required=True)
+    parser.add_argument("--workers", "-j", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default='csv',
+                        help="Format of the combined traces")
+    parser.add_argument("--report", choices=REPORT_MODES, default='decimated',
+                        help="Health report of every run: every sample, downsampled charts or no report")
+    parser.add_argument("--thermapy-lab-path", help="ThermaPy lab code path, required to decode raw captures")
+    parser.add_argument("--coarse-factor", type=int, default=None,
+                        help="Decimation factor for a coarse-to-fine alignment search")
+    parser.add_argument("--no-cache", action='store_true',
+                        help="Do not use the parsed trace/alignment cache")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory of the parsed trace cache")
+    parser.add_argument("--cache-size-mb", type=int, default=DEFAULT_MAX_BYTES // 1024 ** 2,
+                        help="Size budget of the parsed trace cache")
+    return parser.parse_args(argv)
+
+
+def _match(names, pattern):
+    return sorted(name for name in names if fnmatch.fnmatch(name.lower(), pattern))
+
+
+def _run_name(root, run_dir):
+    relative = os.path.relpath(run_dir, root)
+    if relative == os.curdir:
+        return os.path.basename(os.path.abspath(root))
+    return relative.replace(os.sep, '_')
+
+
+def discover_runs(root):
+    """
+    Find the run directories under root.
+
+    :param root: directory to search recursively
+    :return: list of run dicts (name, emon_file, thermalpy_file, thermalpy_raw_file, daq_file). A run without a
+        ThermaPy trace is still listed, so that it is reported as failed
+    """
+    runs = []
+    for run_dir, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        caches = [name for name in dir_names if is_cache(os.path.join(run_dir, name))]
+        # ThermaPy caches are traces, not run directories
+        dir_names[:] = [name for name in dir_names if name not in caches]
+        if EMON_FILE not in file_names:
+            continue
+
+        thermalpy_file = (caches + _match(file_names, PARSED_THERMAPY_PATTERN) + [None])[0]
+        raw_files = [name for pattern in RAW_THERMAPY_PATTERNS for name in _match(file_names, pattern)]
+        daq_files = _match(file_names, DAQ_PATTERN)
+        runs.append({
+            'name': _run_name(root, run_dir),
+            'emon_file': os.path.join(run_dir, EMON_FILE),
+            'thermalpy_file': thermalpy_file and os.path.join(run_dir, thermalpy_file),
+            'thermalpy_raw_file': os.path.join(run_dir, raw_files[0]) if raw_files else None,
+            'daq_file': os.path.join(run_dir, daq_files[0]) if daq_files else None,
+        })
+    return runs
+
+
+def read_manifest(manifest_file):
+    """
+    Read a JSON manifest of runs (see the module description).
+
+    :return: list of run dicts
+    """
+    with open(manifest_file, 'r') as in_file:
+        entries = json.load(in_file)
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    runs = []
+    for position, entry in enumerate(entries):
+        run = {'name': entry.get('name') or f'run_{position}'}
+        for key in ('emon_file', 'thermalpy_file', 'thermalpy_raw_file', 'daq_file'):
+            path = entry.get(key)
+            run[key] = os.path.join(base_dir, path) if path else None
+        runs.append(run)
+    return runs
+
+
+def _thermalpy_trace(run, output_dir, thermapy_lab_path):
+    if run['thermalpy_file']:
+        return run['thermalpy_file']
+    if not run['thermalpy_raw_file']:
+        raise FileNotFoundError(f"No ThermaPy trace for run {run['name']}")
+    if not thermapy_lab_path:
+        raise ValueError(f"Run {run['name']} has only a raw ThermaPy capture, --thermapy-lab-path is required")
+    parsed_file = os.path.join(output_dir, f"{run['name']}_parsed_thermapy.csv")
+    return parse_capture(run['thermalpy_raw_file'], parsed_file, thermapy_lab_path)
+
+
+def _correlation(info, source):
+    quality = info.get(f'{source}_alignment_quality')
+    return quality['correlation'] if quality else None
+
+
+def align_run(run, output_dir, output_format='csv', coarse_factor=None, thermapy_lab_path=None, cache_dir=None,
+              cache_size=DEFAULT_MAX_BYTES, report_mode='decimated'):
+    """
+    Align a single run, logging to '<output_dir>/<name>.log'. Errors are reported in the result instead of raised.
+
+    :param run: run dict (see discover_runs)
+    :param cache_dir: trace cache directory (None to disable the cache)
+    :return: summary row dict (see SUMMARY_COLUMNS)
+    """
+    # Imported here so that the reports module is only required where alignment actually runs
+    from thermapy_emon_combine import align
+
+    result = dict.fromkeys(SUMMARY_COLUMNS)
+    result.update(name=run['name'], status='failed', error='')
+    start = time.perf_counter()
+    log_file = os.path.join(output_dir, f"{run['name']}.log")
+    with open(log_file, 'w') as log, contextlib.redirect_stdout(log):
+        try:
+            cache = TraceCache(cache_dir, max_bytes=cache_size) if cache_dir else None
+            info = align(emon_file=run['emon_file'],
+                         thermalpy_file=_thermalpy_trace(run, output_dir, thermapy_lab_path),
+                         daq_file=run['daq_file'],
+                         output_file=os.path.join(output_dir, run['name']),
+                         coarse_factor=coarse_factor, output_format=output_format,
+                         thermalpy_raw_file=run['thermalpy_raw_file'], cache=cache, report_mode=report_mode)
+            result.update(status='ok', output_file=info['output_file'],
+                          emon_offset=info['emon_offset'], emon_correlation=_correlation(info, 'emon'),
+                          daq_offset=info.get('daq_offset'), daq_correlation=_correlation(info, 'daq'))
+        except Exception as e:
+            traceback.print_exc(file=log)
+            result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def align_batch(runs, output_dir, workers=None, **options):
+    """
+    Align the runs in a pool of worker processes and write the summary table.
+
+    :param runs: list of run dicts (see discover_runs and read_manifest)
+    :param output_dir: directory of the per-run outputs and the summary
+    :param workers: number of worker processes (default: number of CPUs)
+    :param options: align_run keyword arguments
+    :return: summary pandas.DataFrame, one row per run in the order of "runs"
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(align_run, run, output_dir, **options): run for run in runs}
+        for future in as_completed(futures):
+            run = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process itself died (e.g. out of memory)
+                result = dict.fromkeys(SUMMARY_COLUMNS)
+                result.update(name=run['name'], status='failed', error=f'{type(e).__name__}: {e}')
+            results[run['name']] = result
+            print(f"[{len(results)}/{len(runs)}] {run['name']}: {result['status']} "
+                  f"({result['seconds'] or 0:.1f} sec) {result['error']}")
+
+    summary = pandas.DataFrame([results[run['name']] for run in runs], columns=SUMMARY_COLUMNS)
+    summary_file = os.path.join(output_dir, SUMMARY_FILE)
+    summary.to_csv(summary_file, index=False)
+    print(f'Generated batch summary: {summary_file}')
+    return summary
+
+
+def main(argv):
+    args = _parse_command_line(argv=argv)
+    runs = discover_runs(args.root) if args.root else read_manifest(args.manifest)
+    names = [run['name'] for run in runs]
+    if len(set(names)) != len(names):
+        raise ValueError('Run names must be unique')
+    print(f'Aligning {len(runs)} runs with {args.workers} workers')
+
+    summary = align_batch(runs, args.output_dir, workers=args.workers, output_format=args.output_format,
+                          coarse_factor=args.coarse_factor, thermapy_lab_path=args.thermapy_lab_path,
+                          cache_dir=None if args.no_cache else args.cache_dir,
+                          cache_size=args.cache_size_mb * 1024 ** 2, report_mode=args.report)
+    print(summary.to_string(index=False))
+    return 0 if (summary['status'] == 'ok').all() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,190 @@
+"""
+Benchmarks of the alignment pipeline stages, on the committed example runs and on synthetic runs of growing length.
+
+Every stage is measured for its wall time and its peak traced memory (tracemalloc, which also sees the NumPy buffers):
+
+* real fixtures ('examples' and 'RPL_examples'): EMON parsing, the derived metrics of every CPU and the raw ThermaPy
+  capture reading (header and a full streamed pass over the zip member)
+* synthetic runs (see trace_synth) of every --durations value: trace loading, step_resample of the EMON frequency to the
+  ThermaPy rate, find_pattern (full rate and coarse-to-fine), bin_to_intervals of the ThermaPy trace to the EMON grid
+  and align() end to end, in memory and chunked (see chunked_combine), and the DAQ pyramid ingestion (see
+  daq_pyramid). The offsets align() finds are checked against the offsets the generator inserted
+
+The results are printed as a table and written as JSON.
+
+:example:
+
+    python benchmark_align.py --durations 60 600 3600 --cpus 8 --smallcores 8 --output bench.json
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+
+import emon_parser
+import trace_synth
+from chunked_combine import DEFAULT_CHUNK_ROWS
+from daq_pyramid import build_pyramid
+from emon_metrics import DEFAULT_METRICS, compute_metrics
+from interval_binning import bin_to_intervals
+from thermapy_parser import open_capture, read_header
+import combine_steps
+import thermapy_emon_combine as combine
+
+FIXTURE_ROOTS = ('examples', 'RPL_examples')
+DEFAULT_DURATIONS = (60.0, 300.0)
+DEFAULT_TOLERANCE = 0.02
+
+
+def measure(records, case, stage, func, *args, **kwargs):
+    """
+    Run a stage, appending its wall time [sec] and peak traced memory [MB] to the records.
+
+    :return: the stage result
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        records.append({'case': case, 'stage': stage, 'seconds': seconds, 'peak_mb': peak / 1024 ** 2})
+
+
+def _stream_capture(raw_file):
+    lines = 0
+    with open_capture(raw_file) as in_file:
+        for _ in in_file:
+            lines += 1
+    return lines
+
+
+def benchmark_fixtures(records, package_dir):
+    """
+    Benchmark the stages that run on the committed example runs
+    """
+    for root in FIXTURE_ROOTS:
+        for emon_file in sorted(glob.glob(os.path.join(package_dir, root, '**', 'emon_raw_data.txt'), recursive=True)):
+            run_dir = os.path.dirname(emon_file)
+            case = os.path.relpath(run_dir, package_dir).replace(os.sep, '/')
+            trace = measure(records, case, 'emon parse', emon_parser.parse, emon_file)
+            measure(records, case, 'emon metrics', compute_metrics, trace.data, trace.tsc_freq, DEFAULT_METRICS)
+            raw_file = os.path.join(run_dir, 'thermapy_raw_data.zip')
+            if os.path.isfile(raw_file):
+                measure(records, case, 'thermapy header', read_header, raw_file)
+                measure(records, case, 'thermapy stream', _stream_capture, raw_file)
+
+
+def benchmark_synthetic(records, checks, work_dir, duration, cpus, smallcores, coarse_factor, report_mode,
+                        tolerance, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Generate a synthetic run and benchmark the alignment stages on it
+    """
+    case = f'synthetic {duration:g}s'
+    run_dir = os.path.join(work_dir, f'synth_{duration:g}')
+    start = time.perf_counter()
+    run = trace_synth.generate_run(run_dir, duration=duration, cpus=cpus, smallcores=smallcores)
+    print(f'{case}: generated in {time.perf_counter() - start:.1f} sec')
+
+    emon_trace, thermalpy_trace, daq_trace = measure(records, case, 'load traces', combine_steps.load_traces,
+                                                     run['emon_file'], run['thermalpy_file'], run['daq_file'])
+    thermalpy_freq = thermalpy_trace['Frequency[MHz]']
+    sampling_period = numpy.diff(thermalpy_freq.index).mean()
+    cpu = ('package0', 'bigcore', 'CPU0')
+    emon_freq = compute_metrics(emon_trace.data, emon_trace.tsc_freq, combine_steps.ALIGNMENT_METRICS, cpus=[cpu])[
+        cpu + ('Frequency',)]
+    resampled = measure(records, case, 'step_resample', combine_steps.step_resample, emon_freq, sampling_period)
+    pattern = combine_steps.normalize(resampled.values)
+    measure(records, case, 'find_pattern', combine_steps.find_pattern, thermalpy_freq, pattern)
+    if coarse_factor:
+        measure(records, case, f'find_pattern coarse {coarse_factor}', combine_steps.find_pattern, thermalpy_freq,
+                pattern, coarse_factor=coarse_factor)
+    edges = emon_trace.data.index.values - run['shifts']['emon']
+    measure(records, case, 'bin_to_intervals', bin_to_intervals, thermalpy_trace, edges,
+            combine_steps.THERMALPY_AGGREGATION)
+
+    info = measure(records, case, 'align', combine.align, run['emon_file'], run['thermalpy_file'], run['daq_file'],
+                   os.path.join(run_dir, 'combined.csv'), coarse_factor=coarse_factor, report_mode=report_mode)
+    if chunk_rows:
+        measure(records, case, 'align chunked', combine.align, run['emon_file'], run['thermalpy_file'],
+                run['daq_file'], os.path.join(run_dir, 'combined_chunked.csv'), coarse_factor=coarse_factor,
+                report_mode=report_mode, chunk_rows=chunk_rows)
+
+    measure(records, case, 'daq pyramid', build_pyramid, run['daq_file'])
+
+    for name, index in [('emon', emon_trace.data.index), ('daq', daq_trace.index)]:
+        expected = trace_synth.expected_offset(index, thermalpy_trace.index, run['shifts'][name])
+        error = info[f'{name}_offset'] - expected
+        checks.append({'case': case, 'trace': name, 'expected': expected, 'found': info[f'{name}_offset'],
+                       'error': error, 'ok': abs(error) <= tolerance})
+
+
+def format_records(records):
+    lines = [f"{'case':<36}{'stage':<28}{'seconds':>10}{'peak MB':>10}"]
+    for record in records:
+        lines.append(f"{record['case']:<36}{record['stage']:<28}{record['seconds']:>10.3f}{record['peak_mb']:>10.1f}")
+    return '\n'.join(lines)
+
+
+def _parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the alignment pipeline on the example runs and on synthetic runs",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--durations", type=float, nargs='*', default=list(DEFAULT_DURATIONS),
+                        help="Durations of the synthetic runs [sec]")
+    parser.add_argument("--cpus", type=int, default=2, help="Number of bigcore logical CPUs of the synthetic runs")
+    parser.add_argument("--smallcores", type=int, default=0,
+                        help="Number of smallcore logical CPUs of the synthetic runs")
+    parser.add_argument("--coarse-factor", type=int, default=8,
+                        help="Coarse-to-fine pattern search factor (0 for the full rate search only)")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS,
+                        help="EMON samples per chunk of the chunked align() (0 to skip it)")
+    parser.add_argument("--report", choices=combine.REPORT_MODES, default='none',
+                        help="Health report mode of the end to end align()")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed error of the found offsets [sec]")
+    parser.add_argument("--no-fixtures", action='store_true', help="Skip the example run benchmarks")
+    parser.add_argument("--work-dir", default=None,
+                        help="Directory of the synthetic runs (default: a temporary directory, removed at the end)")
+    parser.add_argument("--output", "-o", default=None, help="JSON file of the results")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = _parse_command_line(argv)
+    records = []
+    checks = []
+    if not args.no_fixtures:
+        benchmark_fixtures(records, os.path.dirname(os.path.abspath(__file__)))
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='benchmark_align_')
+    try:
+        for duration in args.durations:
+            benchmark_synthetic(records, checks, work_dir, duration, args.cpus, args.smallcores,
+                                args.coarse_factor or None, args.report, args.tolerance, args.chunk_rows)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(format_records(records))
+    for check in checks:
+        print(f"{check['case']} {check['trace']} offset: expected {check['expected']:.4f}, found {check['found']:.4f} "
+              f"({'ok' if check['ok'] else 'FAILED'})")
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            json.dump({'records': records, 'checks': checks}, out_file, indent=4)
+    return 0 if all(check['ok'] for check in checks) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
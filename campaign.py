@@ -0,0 +1,203 @@
+"""
+Multi-iteration sampling campaign: a list of workloads, each repeated under a list of setups.
+
+The campaign file is a JSON dict:
+
+    {
+        "output_dir": "C:\\\\Users\\\\mvhlab\\\\Desktop\\\\campaign",
+        "setups": [
+            {"name": "30_degrees", "message": "Set the chamber to 30C and press Enter"},
+            {"name": "65_degrees", "message": "Set the chamber to 65C and press Enter"}
+        ],
+        "workloads": [
+            {"name": "PCMark10", "wl_dir": "C:\\\\Program Files\\\\UL\\\\PCMark 10",
+             "wl_cmd": "PCMark10Cmd.exe --definition=pcm10_express.pcmdef", "wl_duration": 600, "repeat": 3}
+        ]
+    }
+
+Any other key of a setup or a workload overrides the same key of the wl_sampler configuration for its iterations. A
+setup may also give a "setup_cmd" executed on the target, and a "message" the operator confirms, before its first
+iteration. Iterations run setup by setup, and every run is written to '<output_dir>/<workload>/<setup>/run_<i>' (the
+layout of RPL_examples).
+
+The target connection, the Thermapy daemon and the DAQ object are set up once for the whole campaign. Runs are
+collected one after another. The post-processing of every collected run (Thermapy parsing and the speed combine) is
+handed to a pool of worker processes, so it overlaps with the next collection. With 'combine_in_process' set, the
+workers import the combine step when they start and combine in process.
+
+The progress is saved to '<output_dir>/campaign_state.json' after every step. Running the same campaign again skips
+the completed iterations, re-submits the post-processing of collected runs, and collects the rest.
+
+:example:
+
+    python campaign.py --campaign pcmark_sweep.json --cfg_path wl_sampler_config.json --workers 2
+"""
+import argparse
+import json
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import wl_sampler
+from run_timeline import Timeline
+
+STATE_FILE = 'campaign_state.json'
+DEFAULT_SETUP = {'name': 'default'}
+_CAMPAIGN_KEYS = ('name', 'repeat', 'message', 'setup_cmd')
+
+COLLECTED = 'collected'
+DONE = 'done'
+COLLECT_FAILED = 'collect_failed'
+POST_FAILED = 'post_failed'
+
+
+def _overrides(entry):
+    return {key: value for key, value in entry.items() if key not in _CAMPAIGN_KEYS}
+
+
+def expand_iterations(campaign, base_cfg):
+    """
+    Expand the campaign into its ordered iterations.
+
+    :return: list of dicts with the iteration 'id', its 'setup' entry, 'cfg' and 'host_dir'
+    """
+    iterations = []
+    for setup in campaign.get('setups') or [DEFAULT_SETUP]:
+        for workload in campaign['workloads']:
+            for repeat in range(workload.get('repeat', 1)):
+                iteration_id = f"{workload['name']}/{setup['name']}/run_{repeat}"
+                iterations.append({
+                    'id': iteration_id,
+                    'setup': setup,
+                    'cfg': dict(base_cfg, **_overrides(workload), **_overrides(setup)),
+                    'host_dir': os.path.join(campaign['output_dir'], *iteration_id.split('/')),
+                })
+    return iterations
+
+
+def load_state(output_dir):
+    path = os.path.join(output_dir, STATE_FILE)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as in_file:
+        return json.load(in_file)
+
+
+def save_state(output_dir, state):
+    # Replace the file atomically so an interrupted campaign never leaves a truncated state
+    path = os.path.join(output_dir, STATE_FILE)
+    with open(path + '.tmp', 'w') as out_file:
+        json.dump(state, out_file, indent=4)
+    os.replace(path + '.tmp', path)
+
+
+def _prepare_setup(setup):
+    if setup.get('setup_cmd'):
+        wl_sampler.Communicator.ExecuteCommandOnTarget(command=setup['setup_cmd'])
+    if setup.get('message'):
+        input(f"[{setup['name']}] {setup['message']}")
+
+
+def _collect_results(futures, state, block):
+    """
+    Record the finished post-processing futures (all of them when blocking) in the state
+    """
+    done, _ = wait(list(futures), timeout=None if block else 0)
+    for future in done:
+        iteration_id = futures.pop(future)
+        try:
+            state[iteration_id].update(status=DONE, output_file=future.result(), error=None)
+        except Exception as e:
+            state[iteration_id].update(status=POST_FAILED, error=f'{type(e).__name__}: {e}')
+        print(f"{iteration_id}: {state[iteration_id]['status']}")
+    return bool(done)
+
+
+def run_campaign(campaign, base_cfg, workers=1, resolution=1):
+    """
+    Run (or resume) a campaign.
+
+    :param campaign: campaign dict (see the module description)
+    :param base_cfg: wl_sampler configuration the iterations override
+    :param workers: number of post-processing worker processes
+    :return: campaign state dict of iteration id -> progress
+    """
+    output_dir = campaign['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+    iterations = expand_iterations(campaign, base_cfg)
+    state = load_state(output_dir)
+    timeline = Timeline()
+
+    wl_sampler.connect_target(base_cfg)
+    thermapy_daemon = wl_sampler.connect_thermapy_daemon(base_cfg, timeline)
+    daq = None
+    setup_name = None
+    futures = {}
+    # In-process combines import the combine step once per worker, before the first run is handed over
+    initializer = wl_sampler.warm_combine if base_cfg.get('combine_in_process') else None
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer) as executor:
+        try:
+            for iteration in iterations:
+                iteration_id = iteration['id']
+                progress = state.setdefault(iteration_id, {'host_dir': iteration['host_dir']})
+                if progress.get('status') == DONE:
+                    continue
+
+                if progress.get('status') not in (COLLECTED, POST_FAILED):
+                    if iteration['setup']['name'] != setup_name:
+                        _prepare_setup(iteration['setup'])
+                        setup_name = iteration['setup']['name']
+                    print(f'Collecting {iteration_id}')
+                    try:
+                        with timeline.stage(f'{iteration_id} collect'):
+                            collected = wl_sampler.run_collection(iteration['cfg'], iteration['host_dir'], timeline,
+                                                                  resolution, thermapy_daemon=thermapy_daemon,
+                                                                  daq=daq)
+                    except Exception as e:
+                        traceback.print_exc()
+                        progress.update(status=COLLECT_FAILED, error=f'{type(e).__name__}: {e}')
+                        # The collectors may still be running, so the campaign stops here and can be resumed
+                        raise
+                    daq = collected.pop('daq')
+                    progress.update(status=COLLECTED, error=None, **collected)
+                    save_state(output_dir, state)
+
+                futures[executor.submit(wl_sampler.post_process_run, iteration['cfg'], progress['host_dir'],
+                                        progress['emon_file'], progress['thermapy_raw_file'],
+                                        clock_sync_file=progress.get('clock_sync_file'),
+                                        daq_file=progress.get('daq_file'))] = iteration_id
+                if _collect_results(futures, state, block=False):
+                    save_state(output_dir, state)
+        finally:
+            _collect_results(futures, state, block=True)
+            save_state(output_dir, state)
+            timeline.write(os.path.join(output_dir, 'campaign_timeline.json'))
+            timeline.write_chrome_trace(os.path.join(output_dir, 'campaign_trace.json'))
+
+    print(timeline.format())
+    return state
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Run (or resume) a multi-iteration sampling campaign')
+    parser.add_argument('--campaign', type=str, required=True, help='Campaign JSON file')
+    parser.add_argument('--cfg_path', type=str, required=False, default=wl_sampler.DEFAULT_CFG_PATH,
+                        help='wl_sampler configuration the campaign overrides')
+    parser.add_argument('--workers', type=int, required=False, default=1,
+                        help='Number of post-processing worker processes')
+    parser.add_argument('--resolution', type=int, required=False, default=1, help='.')
+    args = parser.parse_args(argv)
+
+    with open(args.campaign) as f:
+        campaign = json.load(f)
+    state = run_campaign(campaign, wl_sampler.load_config(args.cfg_path), workers=args.workers,
+                         resolution=args.resolution)
+    failed = [iteration_id for iteration_id, progress in state.items() if progress.get('status') != DONE]
+    if failed:
+        print(f'Not completed: {failed}')
+    return 0 if not failed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,107 @@
+"""
+Shape-preserving downsampling of chart series to a point budget.
+
+The health report charts only need to show the trace shape, not every sample. Two methods are provided:
+
+* 'minmax' - splits the series into equal buckets and keeps the minimum and maximum sample of every bucket (plus the
+  first and last samples), so every peak and dip of the full series stays visible. This is the default, because the
+  alignment is judged by the frequency peaks.
+* 'lttb' - Largest-Triangle-Three-Buckets, keeps one sample per bucket, chosen to preserve the visual area of the
+  series.
+
+Samples with a NaN value are dropped before decimation.
+
+:example:
+
+    >>> x, y = decimate(series.index.values, series.values, points=5000)
+"""
+import numpy
+
+DECIMATION_METHODS = ('minmax', 'lttb')
+DEFAULT_POINTS = 5000
+# Health report modes: chart every sample, chart decimated series or skip the report
+REPORT_MODES = ('full', 'decimated', 'none')
+
+
+def _valid(x, y):
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    valid = ~numpy.isnan(y)
+    if not valid.all():
+        x, y = x[valid], y[valid]
+    return x, y
+
+
+def min_max_envelope(x, y, points=DEFAULT_POINTS):
+    """
+    Keep the first, last, minimum and maximum samples of (points // 2) equal buckets.
+
+    :return: (x, y) arrays of at most points + 2 samples, in the original order
+    """
+    x, y = _valid(x, y)
+    count = y.shape[0]
+    if count <= points:
+        return x, y
+
+    buckets = max(points // 2, 1)
+    size = -(-count // buckets)
+    # pad the last bucket with NaN so that all buckets can be reduced at once
+    padded = numpy.full(buckets * size, numpy.nan)
+    padded[:count] = y
+    padded = padded.reshape(buckets, size)
+    buckets = numpy.flatnonzero(~numpy.isnan(padded).all(axis=1))
+    starts = buckets * size
+    keep = numpy.concatenate([
+        [0, count - 1],
+        starts + numpy.nanargmin(padded[buckets], axis=1),
+        starts + numpy.nanargmax(padded[buckets], axis=1)
+    ])
+    keep = numpy.unique(keep)
+    return x[keep], y[keep]
+
+
+def lttb(x, y, points=DEFAULT_POINTS):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+
+    :return: (x, y) arrays of at most "points" samples (at least 3), in the original order
+    """
+    x, y = _valid(x, y)
+    count = y.shape[0]
+    points = max(points, 3)
+    if count <= points:
+        return x, y
+
+    # the first and last samples are always kept, the others are split into (points - 2) buckets
+    edges = numpy.linspace(1, count - 1, points - 1).astype(int)
+    keep = numpy.empty(points, dtype=int)
+    keep[0], keep[-1] = 0, count - 1
+    selected = 0
+    for bucket in range(points - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        next_stop = edges[bucket + 2] if bucket + 2 < edges.shape[0] else count
+        # the third triangle point is the average of the next bucket
+        next_x = x[stop:next_stop].mean()
+        next_y = y[stop:next_stop].mean()
+        areas = numpy.abs((x[selected] - next_x) * (y[start:stop] - y[selected]) -
+                          (x[selected] - x[start:stop]) * (next_y - y[selected]))
+        selected = start + int(numpy.argmax(areas))
+        keep[bucket + 1] = selected
+    return x[keep], y[keep]
+
+
+def decimate(x, y, points=DEFAULT_POINTS, method='minmax'):
+    """
+    Downsample a series to about "points" samples.
+
+    :param x: sample positions (time)
+    :param y: sample values
+    :param points: point budget
+    :param method: one of DECIMATION_METHODS
+    :return: (x, y) arrays
+    """
+    if method == 'minmax':
+        return min_max_envelope(x, y, points)
+    if method == 'lttb':
+        return lttb(x, y, points)
+    raise ValueError(f'Unsupported decimation method: {method}')
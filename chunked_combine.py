@@ -0,0 +1,298 @@
+"""
+Out-of-core combine of long captures. Instead of holding the whole EMON trace together with the ThermaPy and DAQ
+traces and their aligned copies in memory (see thermapy_emon_combine.align), the EMON trace is parsed twice, chunk by
+chunk:
+
+1. Alignment pass: only the sample times and the alignment CPU frequency are kept from every EMON chunk. The offsets
+   are found on these series as align() finds them (and reused from the trace cache), and the EMON samples kept in
+   the output are decided from the ThermaPy frequency binned onto the aligned EMON grid and the DAQAlign peaks.
+2. Combine pass: every EMON chunk gets its derived columns and the ThermaPy/DAQ slices binned onto its intervals, and
+   is appended to the output (see trace_output.CombinedWriter) after the dtype policy is applied, and to the blocks
+   of its time-range index (see trace_index).
+
+The output holds the rows and values align() writes. The ThermaPy and DAQ traces are still read whole, so use a
+ThermaPy cache directory and the trace cache (whose entries are memory-mapped) for traces that do not fit in memory;
+without the trace cache, the traces read from CSV are narrowed with the dtype policy. The npz output format can not be
+appended to and is not supported.
+
+:example:
+
+    >>> align_chunked('emon_raw_data.txt', 'thermalpy_cache', 'daq.csv', 'combined.parquet', output_format='parquet',
+    ...               chunk_rows=100000, dtype_policy=DTYPE_POLICIES['compact'])
+"""
+import numpy
+import pandas
+
+import emon_parser
+from chart_decimation import DEFAULT_POINTS
+from clock_sync import target_to_host
+from daq_pyramid import is_pyramid
+from emon_metrics import DEFAULT_ALIGN_CPU, select_cpu
+from interval_binning import bin_to_intervals
+from run_timeline import Timeline
+from combine_steps import DAQ_AGGREGATION, DEFAULT_SYNC_WINDOW, THERMALPY_AGGREGATION, add_derived_columns, \
+    add_section, chop_bounds, chop_markers, find_offsets, flatten_columns, format_quality, input_digests, is_path, \
+    load_daq_input, load_input, load_thermalpy, new_report, offsets_cache, read_thermalpy_header, \
+    render_health_report, run_system_info, trace_charts, write_stage_trace
+from thermapy_parser import START_EPOCH, is_cache
+from time_axis import on_time_axis, rebase_time, shift_time, time_window, window_bounds
+from trace_index import DEFAULT_BLOCK_ROWS, TraceIndexer
+from trace_output import CombinedWriter, apply_dtype_policy
+
+DEFAULT_CHUNK_ROWS = 100000
+
+
+def _read_alignment_frequency(emon_file, chunk_rows, align_cpu, clock_model=None):
+    """
+    Alignment pass over the EMON trace, keeping only the sample times and the alignment CPU frequency.
+
+    :param clock_model: optional clock model mapping the EMON clock to the host clock (see clock_sync)
+    :return: (first chunk EmonTrace, for the trace information, alignment CPU, pandas.Series of the alignment
+        frequency indexed by the sample time)
+    """
+    first = alignment_cpu = None
+    times, frequency = [], []
+    for chunk in emon_parser.iter_chunks(emon_file, chunk_lines=chunk_rows):
+        if first is None:
+            first = chunk
+            alignment_cpu = select_cpu(chunk.data.columns, align_cpu)
+        add_derived_columns(chunk, alignment_cpu)
+        times.append(chunk.data.index.values)
+        frequency.append(chunk.data['Frequency0'].to_numpy())
+    if first is None:
+        raise ValueError(f'{emon_file} does not contain EMON samples')
+
+    times = numpy.concatenate(times)
+    if clock_model is not None:
+        times = target_to_host(times, clock_model)
+    return first, alignment_cpu, pandas.Series(numpy.concatenate(frequency), index=pandas.Index(times, name='Time'))
+
+
+def _resample_on(trace, edges, axis, aggregation):
+    """
+    Bin the samples of a trace onto the intervals ending at the "axis" points.
+
+    :param edges: interval edges, from the edge before the first axis point to the last axis point
+    :return: pandas.DataFrame indexed by "axis" (NaN for intervals without samples)
+    """
+    start, stop = window_bounds(trace.index.values, edges[0], edges[-1])
+    # keep the samples around the intervals, whose values hold at their ends for a time weighted mean
+    resampled = bin_to_intervals(trace.iloc[max(start - 1, 0):stop + 1], edges, aggregation)
+    return on_time_axis(resampled[resampled.index.isin(axis)], axis)
+
+
+def _combine_chunk(chunk, local, grid, edges, thermalpy_trace, daq_trace, thermalpy_aggregation, daq_aggregation):
+    """
+    Combine the kept samples of an EMON chunk with the ThermaPy and DAQ samples of their intervals.
+
+    :param chunk: EmonTrace chunk with the derived columns
+    :param local: positions of the kept samples in the chunk
+    :param grid: positions of the kept samples on the aligned EMON time axis "edges"
+    :return: (combined chunk with flattened column names, dict of column name -> column description)
+    """
+    axis = pandas.Index(edges[grid], name='Time')
+    emon_df = chunk.data.iloc[local, 2:].drop([('Duration', '', '', '')], axis=1)
+    emon_df.index = axis
+    interval_edges = edges[max(grid[0] - 1, 0):grid[-1] + 1]
+
+    thermalpy_resampled = _resample_on(thermalpy_trace, interval_edges, axis, thermalpy_aggregation)
+    concat_dfs = [emon_df, thermalpy_resampled]
+    if daq_trace is not None:
+        concat_dfs.append(_resample_on(daq_trace, interval_edges, axis, daq_aggregation))
+    combined_df = pandas.concat(concat_dfs, axis=1)
+    combined_df.columns, column_levels = flatten_columns(combined_df.columns, thermalpy_resampled.columns)
+    return combined_df, column_levels
+
+
+def align_chunked(emon_file, thermalpy_file, daq_file, output_file, coarse_factor=None,
+                  thermalpy_aggregation=THERMALPY_AGGREGATION, daq_aggregation=DAQ_AGGREGATION, output_format='csv',
+                  thermalpy_raw_file=None, cache=None, report_mode='decimated', report_points=DEFAULT_POINTS,
+                  report_method='minmax', clock_sync=None, sync_window=DEFAULT_SYNC_WINDOW,
+                  align_cpu=DEFAULT_ALIGN_CPU, metrics=None, dtype_policy=None, chunk_rows=DEFAULT_CHUNK_ROWS,
+                  daq_resolution=None, index_block_rows=DEFAULT_BLOCK_ROWS, timeline=None):
+    """
+    Aligns the EMON and thermalpy traces like thermapy_emon_combine.align, streaming the EMON trace in chunks and
+    appending the combined trace to the output chunk by chunk.
+
+    The health report charts the alignment frequency, the ThermaPy frequency and the DAQ IA power of the kept samples.
+
+    :param chunk_rows: number of EMON samples parsed and combined at once
+    :param dtype_policy: optional dtype policy of the output columns (see trace_output.apply_dtype_policy), also
+        applied to the ThermaPy and DAQ traces read from CSV when no trace cache is used
+    :return: dict of the run information (offsets, alignment quality, ...) with the output, index, report and stage
+        trace paths
+
+    See thermapy_emon_combine.align for the other parameters.
+    """
+    if output_format == 'npz':
+        raise ValueError('The npz output format can not be written chunk by chunk')
+    if not is_path(emon_file) or output_file is None:
+        raise ValueError('The chunked combine streams the EMON trace from a file into an output file')
+    timeline = Timeline() if timeline is None else timeline
+    report = new_report(report_mode)
+    chart_options = {}
+    if report_mode == 'decimated':
+        chart_options = dict(points=report_points, method=report_method)
+    digests = input_digests(cache, emon_file, thermalpy_file, daq_file)
+
+    clock_sync = clock_sync or {}
+    with timeline.stage('emon alignment pass'):
+        emon_info, alignment_cpu, emon_freq = _read_alignment_frequency(emon_file, chunk_rows, align_cpu,
+                                                                        clock_sync.get('emon'))
+
+    # A thermalpy cache directory is already a parsed, memory-mapped trace
+    thermalpy_mapped = is_path(thermalpy_file) and is_cache(thermalpy_file)
+    with timeline.stage('load thermalpy'):
+        thermalpy_trace, _ = load_input(None if thermalpy_mapped else cache, digests, 'thermalpy', load_thermalpy,
+                                         thermalpy_file)
+    daq_trace = None
+    if daq_file is not None:
+        with timeline.stage('load daq'):
+            daq_trace = load_daq_input(cache, digests, daq_file, daq_resolution, thermalpy_trace)
+    if dtype_policy and cache is None:
+        if not thermalpy_mapped:
+            thermalpy_trace = apply_dtype_policy(thermalpy_trace, dtype_policy)
+        if daq_trace is not None and not (is_path(daq_file) and is_pyramid(daq_file)):
+            daq_trace = apply_dtype_policy(daq_trace, dtype_policy)
+    if daq_trace is not None and 'daq' in clock_sync:
+        daq_trace.index = pandas.Index(target_to_host(daq_trace.index.values, clock_sync['daq']),
+                                       name=daq_trace.index.name)
+
+    thermalpy_freq_data = thermalpy_trace['Frequency[MHz]']
+    if report is not None:
+        charts = trace_charts(emon_freq, thermalpy_freq_data, None if daq_trace is None else daq_trace['P_IA'],
+                               **chart_options)
+        add_section(report, 'Initial', charts)
+
+    # The thermalpy Time axis counts from the capture start epoch [ms] of the raw capture header (host clock)
+    thermalpy_header = read_thermalpy_header(thermalpy_file, thermalpy_raw_file) if clock_sync else {}
+    thermalpy_origin = thermalpy_header.get(START_EPOCH, 0.0) / 1000
+
+    # Position of the first EMON sample on the aligned time axis, in the whole EMON trace
+    emon_first, _ = window_bounds(emon_freq.index.values, start=emon_freq.index[-1] - thermalpy_trace.index[-1])
+    emon_freq = emon_freq.iloc[emon_first:]
+    expected = {'emon': emon_freq.index[0] - thermalpy_origin if 'emon' in clock_sync else None, 'daq': None}
+    emon_freq = rebase_time(emon_freq)
+
+    if daq_trace is not None:
+        duration_diff = daq_trace.index[-1] - thermalpy_trace.index[-1]
+        daq_trace = time_window(daq_trace, start=duration_diff)
+        expected['daq'] = daq_trace.index[0] - thermalpy_origin if 'daq' in clock_sync else None
+        daq_trace = rebase_time(daq_trace)
+
+    alignment = find_offsets(thermalpy_freq_data, emon_freq, None if daq_trace is None else daq_trace['P_IA'],
+                              coarse_factor, expected, clock_sync, sync_window, align_cpu, alignment_cpu,
+                              cache=offsets_cache(cache, emon_file, thermalpy_file, daq_file), digests=digests,
+                              timeline=timeline, thermalpy_header=thermalpy_header)
+
+    emon_offset, emon_quality = alignment['emon']
+    shift_time(emon_freq, emon_offset)
+    print(f'EMON offset: {emon_offset:.6f} sec ({format_quality(emon_quality)})')
+
+    if daq_trace is not None:
+        daq_offset, daq_quality = alignment['daq']
+        shift_time(daq_trace, daq_offset)
+        print(f'DAQ offset: {daq_offset:.6f} sec ({format_quality(daq_quality)})')
+
+    if report is not None:
+        charts = trace_charts(emon_freq, thermalpy_trace['Frequency[MHz]'],
+                               None if daq_trace is None else daq_trace['P_IA'],
+                               emon_title=f'EMON {alignment_cpu[2]} frequency ({format_quality(emon_quality)})',
+                               daq_title=None if daq_trace is None else
+                               f'DAQ IA Power ({format_quality(daq_quality)})', **chart_options)
+        add_section(report, 'Alignment', charts)
+
+    shift_time(emon_freq, decimals=6)
+    shift_time(thermalpy_trace, decimals=6)
+    if daq_trace is not None:
+        shift_time(daq_trace, decimals=6)
+    edges = emon_freq.index.values
+
+    # Decide the kept EMON samples from the alignment signals only: the samples within the ThermaPy and DAQ traces
+    # whose interval received ThermaPy samples, chopped at the DAQAlign peaks
+    with timeline.stage('bin_to_intervals', trace='thermalpy'):
+        summary = [emon_freq.rename('Frequency0'),
+                   bin_to_intervals(thermalpy_trace[['Frequency[MHz]']], edges, thermalpy_aggregation)]
+    if daq_trace is not None:
+        with timeline.stage('bin_to_intervals', trace='daq'):
+            summary.append(bin_to_intervals(daq_trace[['P_IA']], edges, daq_aggregation))
+    first, last = 0, edges.shape[0]
+    for resampled in summary[1:]:
+        window = window_bounds(edges[first:last], resampled.index[0], resampled.index[-1])
+        first, last = first + window[0], first + window[1]
+    axis = emon_freq.index[first:last]
+    summary = pandas.concat([summary[0].iloc[first:last].to_frame()] +
+                            [on_time_axis(time_window(resampled, start=axis[0], stop=axis[-1]), axis)
+                             for resampled in summary[1:]], axis=1)
+    notnull = summary['Frequency[MHz]'].notnull().to_numpy()
+    summary = summary[notnull]
+    kept = first + numpy.flatnonzero(notnull)
+
+    if report is not None:
+        charts = trace_charts(summary['Frequency0'], summary['Frequency[MHz]'],
+                               None if daq_trace is None else summary['P_IA'], **chart_options)
+        add_section(report, 'Combined', charts)
+
+    with timeline.stage('chop'):
+        left_peak_ts, right_peak_ts = chop_bounds(summary['Frequency0'])
+    if report is not None:
+        cut_markers = chop_markers(left_peak_ts, right_peak_ts, summary['Frequency0'].max())
+        charts = trace_charts(summary['Frequency0'], summary['Frequency[MHz]'],
+                               None if daq_trace is None else summary['P_IA'], emon_markers=cut_markers,
+                               **chart_options)
+        add_section(report, 'Chopped', charts)
+
+    start, stop = window_bounds(summary.index.values, left_peak_ts, right_peak_ts)
+    kept = kept[start:stop]
+    summary = rebase_time(summary.iloc[start:stop])
+    if report is not None:
+        charts = trace_charts(summary['Frequency0'], summary['Frequency[MHz]'],
+                               None if daq_trace is None else summary['P_IA'], **chart_options)
+        add_section(report, 'Final', charts)
+    if not kept.shape[0]:
+        raise ValueError('No EMON samples are left between the DAQAlign peaks')
+    time_origin = edges[kept[0]]
+
+    system_info = run_system_info(emon_info, thermalpy_file, thermalpy_raw_file, alignment_cpu, alignment, clock_sync)
+    writer = None
+    indexer = TraceIndexer(block_rows=index_block_rows) if index_block_rows else None
+    position = -emon_first
+    try:
+        with timeline.stage('combine pass'):
+            for chunk in emon_parser.iter_chunks(emon_file, chunk_lines=chunk_rows):
+                chunk_start, position = position, position + chunk.data.shape[0]
+                lo, hi = numpy.searchsorted(kept, [chunk_start, position])
+                if lo == hi:
+                    if lo == kept.shape[0]:
+                        break
+                    continue
+                with timeline.stage('emon metrics'):
+                    add_derived_columns(chunk, alignment_cpu, metrics)
+                with timeline.stage('combine chunk', rows=int(hi - lo)):
+                    combined_df, column_levels = _combine_chunk(chunk, kept[lo:hi] - chunk_start, kept[lo:hi], edges,
+                                                                thermalpy_trace, daq_trace, thermalpy_aggregation,
+                                                                daq_aggregation)
+                    shift_time(combined_df, -time_origin)
+                    combined_df.index.name = 'Time[sec]'
+                    if dtype_policy:
+                        combined_df = apply_dtype_policy(combined_df, dtype_policy)
+                with timeline.stage('write output', format=output_format):
+                    if writer is None:
+                        writer = CombinedWriter(output_file, output_format, column_levels=column_levels,
+                                                system_info=system_info)
+                    writer.write(combined_df)
+                    if indexer is not None:
+                        indexer.add(combined_df)
+    finally:
+        if writer is not None:
+            writer.close()
+    print(f'Generated combined trace: {writer.path} ({writer.rows} rows)')
+    index_file = None
+    if indexer is not None:
+        with timeline.stage('write index'):
+            index_file = indexer.write(writer.path, output_format)
+
+    health_report_file = render_health_report(report, writer.path, timeline)
+    trace_file = write_stage_trace(timeline, writer.path)
+    return dict(system_info, output_file=writer.path, index_file=index_file, report_file=health_report_file,
+                trace_file=trace_file, combined=None, report=report)
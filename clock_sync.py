@@ -0,0 +1,177 @@
+"""
+NTP-style estimation of the target (DUT) clock against the host clock.
+
+EMON stamps its samples with the target clock, while ThermaPy runs on the host. A burst of timestamp exchanges is
+taken before the run and another one after it. Each exchange reads the host clock, queries the target clock over the
+communicator and reads the host clock again. Assuming a symmetric link, the target timestamp was taken at the midpoint
+of the round trip, so every exchange gives an offset (target - host) measured with an error of at most half of its
+round trip delay.
+
+Exchanges disturbed by the link (long delays) are dropped, keeping the fastest ones of every burst, and the remaining
+offsets that deviate from the burst median by more than a few median absolute deviations are rejected. A line fitted
+through the offsets of both bursts gives the offset and the linear drift of the target clock, which
+thermapy_emon_combine uses to place the EMON trace on the host time axis and to search for the DAQAlign pattern only
+around the predicted offset (or to skip the search).
+
+:example:
+
+    >>> query = communicator_query(Communicator)
+    >>> start_burst = sample_clock(query, count=20)
+    >>> ...  # run
+    >>> end_burst = sample_clock(query, count=20)
+    >>> model = estimate_clock([start_burst, end_burst])
+    >>> write_clock_sync(r'C:\\data\\clock_sync.json', {'emon': model})
+"""
+import json
+import time
+
+import numpy
+
+DEFAULT_SAMPLES = 20
+DEFAULT_KEEP_FRACTION = 0.5
+DEFAULT_MAX_DEVIATIONS = 3.0
+DEFAULT_INTERVAL = 0.05
+
+# Target UTC epoch in 100 ns ticks since 0001-01-01 (.NET DateTime ticks)
+TARGET_TIME_COMMAND = 'powershell -NoProfile -Command "[DateTime]::UtcNow.Ticks"'
+_EPOCH_TICKS = 621355968000000000
+_TICKS_PER_SECOND = 10 ** 7
+
+
+def parse_target_time(output):
+    """
+    Target epoch time [sec] from the output of TARGET_TIME_COMMAND
+    """
+    ticks = int(output.strip().splitlines()[0])
+    return (ticks - _EPOCH_TICKS) / _TICKS_PER_SECOND
+
+
+def format_target_time(epoch):
+    """
+    Output of TARGET_TIME_COMMAND for a target epoch time [sec] (the inverse of parse_target_time)
+    """
+    return f'{round(epoch * _TICKS_PER_SECOND) + _EPOCH_TICKS}\r\n'
+
+
+def communicator_query(communicator, command=TARGET_TIME_COMMAND):
+    """
+    :param communicator: evtar Communicator
+    :return: callable returning the target epoch time [sec]
+    """
+    def query():
+        return parse_target_time(communicator.ExecuteCommandOnTarget(command, logOutput=False))
+
+    return query
+
+
+def sample_clock(query, count=DEFAULT_SAMPLES, interval=DEFAULT_INTERVAL, time_func=time.time, sleep=time.sleep):
+    """
+    Take a burst of timestamp exchanges. Failed exchanges are skipped.
+
+    :param query: callable returning the target time [sec]
+    :param count: number of exchanges
+    :param interval: pause between exchanges [sec]
+    :param time_func: host clock
+    :return: list of (host send time, target time, host receive time) tuples
+    """
+    samples = []
+    for i in range(count):
+        if i:
+            sleep(interval)
+        t1 = time_func()
+        try:
+            target = query()
+        except Exception as e:
+            print(f'Clock exchange failed: {e}')
+            continue
+        t2 = time_func()
+        samples.append((t1, target, t2))
+    return samples
+
+
+def _filter_burst(samples, keep_fraction, max_deviations):
+    """
+    Fastest exchanges of a burst whose offsets are consistent with each other
+
+    :return: arrays of the host midpoints, offsets and delays of the kept exchanges
+    """
+    values = numpy.asarray(samples, dtype=float).reshape(-1, 3)
+    delays = values[:, 2] - values[:, 0]
+    fastest = numpy.argsort(delays, kind='stable')[:max(1, int(numpy.ceil(values.shape[0] * keep_fraction)))]
+    values, delays = values[fastest], delays[fastest]
+
+    midpoints = (values[:, 0] + values[:, 2]) / 2
+    offsets = values[:, 1] - midpoints
+    deviations = numpy.abs(offsets - numpy.median(offsets))
+    mad = numpy.median(deviations)
+    consistent = deviations <= max_deviations * mad if mad > 0 else numpy.ones(offsets.shape[0], dtype=bool)
+    return midpoints[consistent], offsets[consistent], delays[consistent]
+
+
+def estimate_clock(bursts, keep_fraction=DEFAULT_KEEP_FRACTION, max_deviations=DEFAULT_MAX_DEVIATIONS):
+    """
+    Estimate the target clock offset and drift from bursts of exchanges (see sample_clock).
+
+    With a single burst (or bursts taken at the same time) the drift is 0.
+
+    :param bursts: list of exchange lists, e.g. [start burst, end burst]
+    :param keep_fraction: fraction of the fastest exchanges kept from every burst
+    :param max_deviations: offsets deviating from the burst median by more than this many median absolute deviations
+        are rejected
+    :return: clock model dict: 'offset' (target - host [sec] at 'reference'), 'drift' (offset change per host second),
+        'reference' (host time), 'delay' (shortest round trip kept [sec]), 'uncertainty' (offset error bound [sec],
+        half of the longest round trip kept), 'samples' and 'used' (number of exchanges)
+    """
+    bursts = [burst for burst in bursts if burst]
+    if not bursts:
+        raise ValueError('No clock exchanges to estimate from')
+    filtered = [_filter_burst(burst, keep_fraction, max_deviations) for burst in bursts]
+    midpoints, offsets, delays = (numpy.concatenate(arrays) for arrays in zip(*filtered))
+
+    reference = float(midpoints.mean())
+    drift = 0.0
+    if len(filtered) > 1 and numpy.ptp(midpoints) > 0:
+        drift, offset = numpy.polyfit(midpoints - reference, offsets, 1)
+    else:
+        offset = numpy.median(offsets)
+    return {
+        'offset': float(offset),
+        'drift': float(drift),
+        'reference': reference,
+        'delay': float(delays.min()),
+        'uncertainty': float(delays.max() / 2),
+        'samples': sum(len(burst) for burst in bursts),
+        'used': int(offsets.shape[0]),
+    }
+
+
+def target_to_host(times, model):
+    """
+    Convert target clock times to the host clock.
+
+    :param times: target time or array of target times [sec]
+    :param model: clock model (see estimate_clock)
+    :return: host times
+    """
+    # target = host + offset + drift * (host - reference), solved for host
+    times = numpy.asarray(times, dtype=float)
+    return (times - model['offset'] + model['drift'] * model['reference']) / (1 + model['drift'])
+
+
+def write_clock_sync(path, clocks, **extra):
+    """
+    Save the clock models of the traces (and any extra run metadata) as JSON.
+
+    :param clocks: dict of trace name ('emon', 'daq') -> clock model mapping the trace clock to the host clock
+    """
+    with open(path, 'w') as out_file:
+        json.dump(dict(extra, clocks=clocks), out_file, indent=4)
+    return path
+
+
+def read_clock_sync(path):
+    """
+    :return: dict of trace name -> clock model saved by write_clock_sync
+    """
+    with open(path, 'r') as in_file:
+        return json.load(in_file)['clocks']
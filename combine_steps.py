@@ -0,0 +1,583 @@
+"""
+Steps of the EMON/ThermalPy/DAQ combine shared by the in-memory combine (thermapy_emon_combine.align) and the
+out-of-core one (chunked_combine.align_chunked): loading the traces (through the trace cache), finding the alignment
+offsets on the DAQAlign pattern, flattening and chopping the combined trace and building the health report.
+
+:example:
+
+    >>> emon_trace, thermalpy_trace, daq_trace = load_traces('emon_raw_data.txt', 'thermalpy.csv', 'daq.csv')
+    >>> alignment_cpu = select_cpu(emon_trace.data.columns)
+    >>> add_derived_columns(emon_trace, alignment_cpu)
+    >>> offset, quality = find_offsets(thermalpy_trace['Frequency[MHz]'], emon_trace.data['Frequency0'], None,
+    ...                                coarse_factor=None, expected={'emon': None}, clock_sync={}, sync_window=0,
+    ...                                align_cpu=DEFAULT_ALIGN_CPU, alignment_cpu=alignment_cpu)['emon']
+"""
+import os
+import pandas
+import numpy
+
+import emon_parser
+from emon_parser import COLUMN_LEVELS, EmonTrace, parse
+from interval_binning import step_integral
+from chart_decimation import REPORT_MODES, decimate
+from trace_cache import file_digest, trace_key
+from thermapy_parser import is_cache, load_cache, read_cache_info, read_header
+from daq_pyramid import is_pyramid, load_level, select_resolution
+from run_timeline import stage
+from emon_metrics import DEFAULT_ALIGN_CPU, compute_metrics, select_metrics
+
+
+# Per-source aggregation policies used when resampling to the EMON grid: (column pattern, aggregation) pairs, first
+# match wins and unmatched columns are dropped. See interval_binning.bin_to_intervals for the supported aggregations.
+THERMALPY_AGGREGATION = [
+    ('DTS*', 'mean'),
+    ('*ratio*', 'mean'),
+    ('*Frequency*', 'mean'),
+    ('cycles', 'sum'),
+]
+DAQ_AGGREGATION = [
+    ('*', 'mean'),
+]
+
+# Bump when a loader or the alignment changes its output, to invalidate the trace cache entries
+LOADER_VERSIONS = {
+    'emon': emon_parser.PARSER_VERSION,
+    'thermalpy': 1,
+    'daq': 1,
+}
+ALIGNMENT_VERSION = 1
+
+SIZE_HINT = 'wide'
+ALIGNMENT_METRICS = select_metrics(['Duration', 'Frequency'])
+
+# Half width of the pattern search around the offset predicted by the clock sync [sec]
+DEFAULT_SYNC_WINDOW = 2.0
+# Lag count above which a windowed correlation is computed with FFT convolution
+_DIRECT_LAGS = 128
+# The combined trace is chopped this many seconds inside the first and the last DAQAlign peaks [sec]
+CHOP_MARGIN = 14
+
+
+def _load_emon(emon_file):
+    emon_trace = parse(emon_file)
+    return emon_trace.data, {'tsc_freq': emon_trace.tsc_freq, 'system_info': emon_trace.system_info}
+
+
+def load_thermalpy(thermalpy_file):
+    if is_cache(thermalpy_file):
+        # The cache is memory-mapped and already holds the Time column in SEC
+        thermalpy_trace = load_cache(thermalpy_file)
+    else:
+        thermalpy_trace = pandas.read_csv(thermalpy_file)
+        thermalpy_trace.set_index('Frame', inplace=True)
+        thermalpy_trace.reset_index(inplace=True)
+        # Convert the Time column from MS to SEC
+        thermalpy_trace['Time'] /= 1000
+    thermalpy_trace.set_index('Time', inplace=True)
+    return thermalpy_trace, {}
+
+
+def _load_daq(daq_file):
+    daq_trace = pandas.read_csv(daq_file)
+    daq_trace.set_index('TimeStamp', inplace=True)
+    return daq_trace, {}
+
+
+def _load_cached(cache, digests, name, load, path):
+    """
+    Load a trace through the trace cache (when enabled), keyed by the input contents and the loader version
+    """
+    if cache is None:
+        return load(path)
+    key = trace_key(name, LOADER_VERSIONS[name], digests[name])
+    cached = cache.get_frame(key)
+    if cached is not None:
+        return cached
+    frame, info = load(path)
+    cache.put_frame(key, frame, info)
+    return frame, info
+
+
+def is_path(value):
+    return isinstance(value, (str, os.PathLike))
+
+
+def input_digests(cache, emon_file, thermalpy_file, daq_file):
+    """
+    :return: dict of trace name -> SHA-256 of the input traces given by path (None without a cache)
+    """
+    if cache is None:
+        return None
+    inputs = {'emon': emon_file, 'thermalpy': thermalpy_file, 'daq': daq_file}
+    return {name: file_digest(path) for name, path in inputs.items() if is_path(path)}
+
+
+def offsets_cache(cache, emon_file, thermalpy_file, daq_file):
+    """
+    The cache of the alignment offsets, which are keyed by the input digests, so only when every input is a path
+    """
+    inputs = [path for path in (emon_file, thermalpy_file, daq_file) if path is not None]
+    return cache if all(is_path(path) for path in inputs) else None
+
+
+def load_input(cache, digests, name, load, value):
+    """
+    Load a trace given by path (through the trace cache, see _load_cached), or take a trace the caller has already
+    loaded. Loaded traces are copied shallowly, as the alignment replaces their index and adds columns.
+    """
+    if isinstance(value, EmonTrace):
+        return value.data.copy(deep=False), {'tsc_freq': value.tsc_freq, 'system_info': value.system_info}
+    if not is_path(value):
+        return value.copy(deep=False), {}
+    return _load_cached(cache, digests, name, load, value)
+
+
+def load_daq_input(cache, digests, daq_file, daq_resolution, thermalpy_trace):
+    """
+    Load the DAQ trace. A DAQ pyramid (see daq_pyramid) is already aggregated and memory-mapped, so only its level of
+    the requested resolution is loaded (by default the finest one the ThermaPy sampling period needs), bypassing the
+    trace cache.
+    """
+    if not (is_path(daq_file) and is_pyramid(daq_file)):
+        daq_trace, _ = load_input(cache, digests, 'daq', _load_daq, daq_file)
+        return daq_trace
+    if daq_resolution is None:
+        index = thermalpy_trace.index
+        daq_resolution = (index[-1] - index[0]) / max(index.shape[0] - 1, 1)
+    resolution = select_resolution(daq_file, daq_resolution)
+    print(f'DAQ pyramid level: {resolution} sec')
+    return load_level(daq_file, resolution)
+
+
+def load_traces(emon_file, thermalpy_file, daq_file, cache=None, digests=None, daq_resolution=None, timeline=None):
+    with stage(timeline, 'load emon'):
+        emon_data, emon_info = load_input(cache, digests, 'emon', _load_emon, emon_file)
+    emon_trace = EmonTrace(data=emon_data, **emon_info)
+
+    # A thermalpy cache directory is already a parsed, memory-mapped trace
+    thermalpy_cache = None if is_path(thermalpy_file) and is_cache(thermalpy_file) else cache
+    with stage(timeline, 'load thermalpy'):
+        thermalpy_trace, _ = load_input(thermalpy_cache, digests, 'thermalpy', load_thermalpy, thermalpy_file)
+
+    daq_trace = None
+    if daq_file is not None:
+        with stage(timeline, 'load daq'):
+            daq_trace = load_daq_input(cache, digests, daq_file, daq_resolution, thermalpy_trace)
+
+    return emon_trace, thermalpy_trace, daq_trace
+
+
+def step_resample(series, period: float, mode='after'):
+    """
+    | Resample step function specified by "series" with specified period.
+    | In 'after' mode the steps are AFTER the index points (example: [(0, 1), (1, 2), ...] means [f=1 @ 0]
+    -> [f=2 @ 1] ...). In 'before' mode each value holds over the interval that ENDS at its index point, so the first
+    value is ignored.
+
+    The step function is integrated once with a cumulative sum and the integral is evaluated at the grid edges,
+    so the cost is linear in the number of steps and grid points (plus a binary search per grid edge).
+
+    :param series: pandas.Series (or pandas.DataFrame for several columns sharing the index) representing a step
+        function
+    :param period: resample period
+    :param mode: step mode. One of 'after' or 'before' (default: 'after')
+    :return: pandas.Series (pandas.DataFrame for DataFrame input) representing a step function with duration-weighted
+        average per step (step AFTER point)
+
+    :example:
+
+        >>> # resample specified step function with constant period of 1.0:
+        >>> res = step_resample(pandas.Series([1, 2, 1, 0], index=[1.1, 1.2, 3.2, 3.3]), period=1.0)
+            1.1 1.9,
+            2.1 2.0,
+            3.1 0.3
+    """
+    x = numpy.asarray(series.index.values, dtype=float)
+    values = numpy.asarray(series.values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, numpy.newaxis]
+
+    # number of whole grid periods inside the step function domain; the last grid step is partial
+    grid_steps = int(numpy.floor((x[-1] - x[0]) / period)) if x.shape[0] > 1 else 0
+    edges = x[0] + numpy.arange(grid_steps + 2) * period
+    result_y = numpy.diff(step_integral(x, values, edges, mode=mode), axis=0) / period
+
+    if isinstance(series, pandas.DataFrame):
+        return pandas.DataFrame(result_y, index=edges[:-1], columns=series.columns)
+    return pandas.Series(result_y[:, 0], index=edges[:-1], name=series.name)
+
+
+def normalize(array):
+    """
+    Normalize the array into 0..1 range
+    """
+    result = array - array.min()
+    return result / result.max()
+
+
+def _correlate(signal, pattern):
+    """
+    Full cross-correlation of "pattern" against "signal" (same result as numpy.correlate(..., mode='full')) computed
+    with overlap-add FFT convolution.
+    """
+    from scipy.signal import oaconvolve
+    return oaconvolve(signal, pattern[::-1], mode='full')
+
+
+def _decimate(values, factor):
+    """
+    Block-average the array by the given integer factor (the incomplete tail block is dropped)
+    """
+    usable = values.shape[0] // factor * factor
+    return values[:usable].reshape(-1, factor).mean(axis=1)
+
+
+def _peak_ratio(correlation, peak):
+    """
+    Ratio between the correlation peak and the highest correlation outside the peak main lobe (the contiguous
+    region around the peak above half of its height). Returns inf when there is no positive side lobe.
+    """
+    height = correlation[peak]
+    below = numpy.flatnonzero(correlation[:peak] <= height / 2)
+    left = below[-1] + 1 if below.shape[0] else 0
+    below = numpy.flatnonzero(correlation[peak:] <= height / 2)
+    right = peak + below[0] if below.shape[0] else correlation.shape[0]
+
+    side_lobes = numpy.concatenate([correlation[:left], correlation[right:]])
+    if side_lobes.shape[0] == 0 or side_lobes.max() <= 0:
+        return numpy.inf
+    return float(height / side_lobes.max())
+
+
+def _window_correlation(signal, pattern, first_lag, last_lag):
+    """
+    Cross-correlation for lags first_lag..last_lag only, treating the signal as zero outside its bounds
+    """
+    size = pattern.shape[0]
+    segment = numpy.zeros(last_lag - first_lag + size)
+    begin, end = max(first_lag, 0), min(last_lag + size, signal.shape[0])
+    segment[begin - first_lag:end - first_lag] = signal[begin:end]
+    if last_lag - first_lag + 1 > _DIRECT_LAGS:
+        from scipy.signal import oaconvolve
+        return oaconvolve(segment, pattern[::-1], mode='valid')
+    return numpy.correlate(segment, pattern, mode='valid')
+
+
+def _match_correlation(signal, pattern, offset):
+    """
+    Normalized correlation coefficient (-1..1) between the pattern and the overlapping signal samples at the offset
+    """
+    begin, end = max(offset, 0), min(offset + pattern.shape[0], signal.shape[0])
+    signal_part = signal[begin:end]
+    pattern_part = pattern[begin - offset:end - offset]
+    norm = numpy.sqrt(numpy.dot(signal_part, signal_part) * numpy.dot(pattern_part, pattern_part))
+    return float(numpy.dot(signal_part, pattern_part) / norm) if norm > 0 else 0.0
+
+
+def find_pattern(signal, pattern, coarse_factor=None, return_quality=False, lags=None):
+    """
+    Use correlation to find "pattern" in "values", assuming uniform sampling.
+    Will return location with the highest correlation between the pattern and the signal samples.
+
+    The correlation is computed with overlap-add FFT convolution. When "coarse_factor" is given, the offset is first
+    found on signals block-averaged by that factor and then refined at full rate within +-2 coarse samples of it.
+
+    :param signal: sequence of values representing a signal series
+    :param pattern: sequence of values representing a signal sample to find
+    :param coarse_factor: optional decimation factor for the coarse search (None or 1 searches at full rate only)
+    :param return_quality: also return a dict describing the confidence of the match: 'correlation' is the
+        normalized correlation coefficient at the offset and 'peak_ratio' is the ratio between the correlation peak
+        and the highest side lobe
+    :param lags: optional (first, last) offset range to search in, e.g. around an offset known from a clock sync
+        ("coarse_factor" is not used then, and 'peak_ratio' only considers the side lobes inside the range)
+    :return: non-zero offset of "pattern" inside "signal" (and the quality dict if return_quality is set; in coarse
+        mode 'peak_ratio' is measured on the coarse correlation)
+
+    :example:
+
+        >>> find_pattern([0, 0, 0, 2.0, 2.1, 0, 0, 0], [0, 1.3, 1.3, 0, 0])  # find approximate pattern match for 1D signal
+        >>> 2
+
+    """
+    signal = numpy.atleast_1d(numpy.asarray(signal, dtype=float))
+    signal = signal - signal.mean()
+
+    pattern = numpy.atleast_1d(numpy.asarray(pattern, dtype=float))
+    pattern = pattern - pattern.mean()
+
+    if lags is not None:
+        first_lag, last_lag = lags
+        correlation = _window_correlation(signal, pattern, first_lag, last_lag)
+        peak = int(numpy.argmax(correlation))
+        offset = first_lag + peak
+    elif coarse_factor is not None and coarse_factor > 1 and pattern.shape[0] >= 2 * coarse_factor:
+        coarse_pattern = _decimate(pattern, coarse_factor)
+        correlation = _correlate(_decimate(signal, coarse_factor), coarse_pattern)
+        peak = int(numpy.argmax(correlation))
+        coarse_offset = (peak - coarse_pattern.shape[0] + 1) * coarse_factor
+
+        first_lag = max(coarse_offset - 2 * coarse_factor, -pattern.shape[0] + 1)
+        last_lag = min(coarse_offset + 2 * coarse_factor, signal.shape[0] - 1)
+        offset = first_lag + int(numpy.argmax(_window_correlation(signal, pattern, first_lag, last_lag)))
+    else:
+        correlation = _correlate(signal, pattern)
+        peak = int(numpy.argmax(correlation))
+        offset = peak - pattern.shape[0] + 1
+
+    if not return_quality:
+        return offset
+
+    quality = {
+        'correlation': _match_correlation(signal, pattern, offset),
+        'peak_ratio': _peak_ratio(correlation, peak)
+    }
+    return offset, quality
+
+
+def read_thermalpy_header(thermalpy_file, thermalpy_raw_file):
+    if thermalpy_raw_file:
+        return read_header(thermalpy_raw_file)
+    if is_path(thermalpy_file) and is_cache(thermalpy_file):
+        return read_cache_info(thermalpy_file)['header']
+    return {}
+
+
+def _find_offset(thermalpy_freq_data, series, sampling_period, coarse_factor, expected=None,
+                 sync_window=DEFAULT_SYNC_WINDOW, timeline=None, trace=None):
+    """
+    Find the time offset of a trace series inside the thermalpy frequency trace.
+
+    :param expected: offset predicted by the clock sync [sec]. The pattern is searched within "sync_window" seconds
+        of it, or not searched at all when "sync_window" is 0
+    :param timeline: optional run_timeline.Timeline recording the resampling and the search of the trace "trace"
+    :return: (offset [sec], find_pattern quality dict, with the 'sync_error' of the found offset against the
+        prediction when one is given)
+    """
+    with stage(timeline, 'step_resample', trace=trace):
+        pattern = normalize(
+            step_resample(
+                series,
+                sampling_period
+            ).values
+        )
+    lags = None
+    if expected is not None:
+        times = thermalpy_freq_data.index.values
+        expected_lag = int(numpy.round((expected - times[0]) / sampling_period))
+        window_lags = int(numpy.ceil(max(sync_window, 0) / sampling_period))
+        lags = (max(expected_lag - window_lags, -pattern.shape[0] + 1),
+                min(expected_lag + window_lags, times.shape[0] - 1))
+        if lags[0] > lags[1]:
+            print(f'Clock sync offset {expected:.3f} is outside of the thermalpy trace, searching the whole trace')
+            lags = None
+        elif sync_window <= 0:
+            signal = numpy.asarray(thermalpy_freq_data.values, dtype=float)
+            quality = {
+                'correlation': _match_correlation(signal - signal.mean(), pattern - pattern.mean(), expected_lag),
+                'peak_ratio': float('nan'),
+                'sync_error': 0.0
+            }
+            return float(expected), quality
+
+    with stage(timeline, 'find_pattern', trace=trace):
+        offset, quality = find_pattern(signal=thermalpy_freq_data, pattern=pattern, coarse_factor=coarse_factor,
+                                       return_quality=True, lags=lags)
+    # The lag is negative when the trace starts before the thermalpy trace: it is then converted to time before the
+    # first thermalpy sample, as indexing the thermalpy time axis would wrap around to its end
+    times = thermalpy_freq_data.index
+    offset = float(times[offset]) if offset >= 0 else float(times[0] + offset * sampling_period)
+    if expected is not None:
+        quality['sync_error'] = offset - float(expected)
+    return offset, quality
+
+
+def new_report(report_mode):
+    """
+    :return: health report of the report mode (None for 'none')
+    """
+    if report_mode not in REPORT_MODES:
+        raise ValueError(f'Unsupported report mode: {report_mode}')
+    if report_mode == 'none':
+        return None
+    from reports import Report
+    return Report('EMON-Thermalpy alignment health')
+
+
+def add_section(report, title, charts):
+    from reports import ChartGroup, Section
+    report.append(Section(title, ChartGroup(*charts)))
+
+
+def _report_series(series, color, points=None, method='minmax'):
+    from reports import ScatterDataSeries
+    x, y = series.index, series
+    if points is not None:
+        x, y = decimate(series.index.values, series.values, points=points, method=method)
+    return ScatterDataSeries(x=x, y=y, step=True, color=color)
+
+
+def trace_charts(emon_freq, thermalpy_freq, daq_power=None, emon_title='EMON CPU0 frequency',
+                  daq_title='DAQ IA Power', emon_markers=(), points=None, method='minmax'):
+    """
+    Health report charts of the EMON and thermalpy frequencies and the DAQ IA power.
+
+    :param emon_markers: extra series (e.g. chop markers) drawn on the EMON chart
+    :param points: point budget of every trace series (None to chart every sample)
+    :param method: decimation method (see chart_decimation)
+    """
+    from reports import ScatterChart
+    charts = [
+        ScatterChart(emon_title, _report_series(emon_freq, 'black', points, method), *emon_markers,
+                     sizehint=SIZE_HINT, markers=False),
+        ScatterChart('ThermalPy CPU0 frequency', _report_series(thermalpy_freq, 'blue', points, method),
+                     sizehint=SIZE_HINT, markers=False)
+    ]
+    if daq_power is not None:
+        charts.insert(1,
+                      ScatterChart(daq_title, _report_series(daq_power, 'green', points, method),
+                                   sizehint=SIZE_HINT, markers=False))
+    return charts
+
+
+def format_quality(quality):
+    text = f"correlation {quality['correlation']:.3f}, peak ratio {quality['peak_ratio']:.2f}"
+    if 'sync_error' in quality:
+        text += f", clock sync error {quality['sync_error'] * 1000:.1f} ms"
+    return text
+
+
+def add_derived_columns(emon_trace, alignment_cpu, metrics=None):
+    """
+    Add the 'Duration' and 'Frequency0' columns of the alignment CPU and the derived metrics of every logical CPU to
+    the EMON trace data.
+    """
+    alignment_metrics = compute_metrics(emon_trace.data, emon_trace.tsc_freq, ALIGNMENT_METRICS, cpus=[alignment_cpu])
+    if alignment_metrics.shape[1] != len(ALIGNMENT_METRICS):
+        raise ValueError(f'{"/".join(alignment_cpu)} does not count the events of the alignment frequency')
+    emon_trace.data['Duration'] = alignment_metrics[alignment_cpu + ('Duration',)]
+    emon_trace.data['Frequency0'] = alignment_metrics[alignment_cpu + ('Frequency',)]
+    if metrics:
+        emon_trace.data = pandas.concat([emon_trace.data, compute_metrics(emon_trace.data, emon_trace.tsc_freq,
+                                                                          metrics)], axis=1)
+    return emon_trace
+
+
+def find_offsets(thermalpy_freq_data, emon_freq, daq_power, coarse_factor, expected, clock_sync, sync_window,
+                  align_cpu, alignment_cpu, cache=None, digests=None, timeline=None, thermalpy_header=None):
+    """
+    Find the offsets of the EMON alignment frequency and of the DAQ IA power inside the thermalpy frequency trace.
+
+    The offsets depend only on the input contents and the search parameters, so they are reused from the cache.
+
+    :param cache: optional trace_cache.TraceCache, only when every input trace was given by path (see digests)
+    :param thermalpy_header: raw capture header the clock sync predictions ("expected") are measured from
+
+    :return: dict of trace name ('emon', 'daq') -> (offset [sec], quality dict)
+    """
+    alignment = None
+    if cache is not None:
+        # the predictions count from the capture start epoch of the raw header, which the input digests do not cover
+        sync_parts = (clock_sync, sync_window, thermalpy_header or {}) if clock_sync else ()
+        cpu_parts = (alignment_cpu,) if align_cpu != DEFAULT_ALIGN_CPU else ()
+        # the DAQ power of a pyramid depends on the level it was read from
+        daq_parts = (daq_power.attrs['resolution'],) if daq_power is not None and 'resolution' in daq_power.attrs \
+            else ()
+        alignment_key = cache.key('alignment', ALIGNMENT_VERSION, LOADER_VERSIONS, digests, coarse_factor,
+                                  *sync_parts, *cpu_parts, *daq_parts)
+        alignment = cache.get(alignment_key)
+    if alignment is None:
+        sampling_period = numpy.diff(thermalpy_freq_data.index).mean()
+        alignment = {'emon': _find_offset(thermalpy_freq_data, emon_freq, sampling_period, coarse_factor,
+                                          expected['emon'], sync_window, timeline=timeline, trace='emon')}
+        if daq_power is not None:
+            alignment['daq'] = _find_offset(thermalpy_freq_data, daq_power, sampling_period, coarse_factor,
+                                            expected['daq'], sync_window, timeline=timeline, trace='daq')
+        if cache is not None:
+            cache.put(alignment_key, alignment)
+    return alignment
+
+
+def flatten_columns(columns, thermalpy_columns):
+    """
+    Flatten the combined trace columns to 'package-core_type-CPU-event' names.
+
+    :return: (list of column names, dict of column name -> dict describing the column, see trace_output)
+    """
+    new_cols = []
+    column_levels = {}
+    for column in columns:
+        if isinstance(column, tuple):
+            name = '-'.join(column).replace('---', '')
+            # derived columns such as ('Frequency0', '', '', '') have no counter hierarchy
+            levels = dict(zip(COLUMN_LEVELS, column)) if all(column) else {}
+            column_levels[name] = dict(levels, source='emon')
+            new_cols.append(name)
+        else:
+            column_levels[column] = {'source': 'thermalpy' if column in thermalpy_columns else 'daq'}
+            new_cols.append(column)
+    return new_cols, column_levels
+
+
+def chop_bounds(series):
+    """
+    Chop window of the combined trace: CHOP_MARGIN seconds inside the first and the last DAQAlign peaks of the EMON
+    frequency.
+
+    :return: (start, stop) [sec]
+    """
+    from scipy.signal import find_peaks
+    width = int(0.9 / numpy.diff(series.index.values).mean())
+    peaks = find_peaks(series.values, height=0.95 * series.max(), width=width)
+    peaks = list(peaks[0])
+    return series.index[peaks[0]] + CHOP_MARGIN, series.index[peaks[-1]] - CHOP_MARGIN
+
+
+def chop_markers(left_peak_ts, right_peak_ts, height):
+    from reports import ScatterDataSeries
+    return [
+        ScatterDataSeries(
+            x=[left_peak_ts, left_peak_ts], y=[0, height],
+            color='red'),
+        ScatterDataSeries(
+            x=[right_peak_ts, right_peak_ts], y=[0, height],
+            color='red')
+    ]
+
+
+def run_system_info(emon_trace, thermalpy_file, thermalpy_raw_file, alignment_cpu, alignment, clock_sync):
+    emon_offset, emon_quality = alignment['emon']
+    system_info = {
+        'tsc_freq': emon_trace.tsc_freq,
+        'emon_db': emon_trace.system_info.get('emon db'),
+        'emon_system_info': emon_trace.system_info,
+        'thermalpy_setup': read_thermalpy_header(thermalpy_file, thermalpy_raw_file).get('setup'),
+        'emon_alignment_cpu': '/'.join(alignment_cpu),
+        'emon_offset': emon_offset,
+        'emon_alignment_quality': emon_quality,
+    }
+    if clock_sync:
+        system_info['clock_sync'] = clock_sync
+    if 'daq' in alignment:
+        daq_offset, daq_quality = alignment['daq']
+        system_info.update(daq_offset=daq_offset, daq_alignment_quality=daq_quality)
+    return system_info
+
+
+def render_health_report(report, output_file, timeline=None):
+    if report is None:
+        return None
+    health_report_file = os.path.splitext(output_file)[0] + '.html'
+    from reports import render_report
+    with stage(timeline, 'report render'):
+        render_report(report=report, html_file=health_report_file)
+    print(f'Generated health report: {health_report_file}')
+    return health_report_file
+
+
+def write_stage_trace(timeline, output_file):
+    """
+    Write the Chrome trace of the combine stages next to the output file
+    """
+    trace_file = timeline.write_chrome_trace(os.path.splitext(output_file)[0] + '_trace.json')
+    print(f'Generated stage trace: {trace_file}')
+    return trace_file
@@ -0,0 +1,139 @@
+"""
+Waiting for a process on the target (DUT) to finish, with as little intrusion on the target as possible.
+
+Every target query is a round trip over the peer-to-peer link and may spawn a shell on the DUT, which disturbs the
+counters sampled by EMON. Two probes are provided:
+
+* exit watcher (start_exit_watcher) - one long-lived process on the target blocks until the watched process exits and
+  then creates a marker file. The host only checks whether the marker exists, without spawning anything on the DUT.
+* tasklist probe (tasklist_probe) - queries the process list on the target on every check.
+
+wait_for_completion checks the probe with an exponential backoff and tells an exited process apart from a failing
+probe (e.g. a communicator error), counting every round trip it made.
+
+:example:
+
+    >>> probe = start_exit_watcher(Communicator, wl_pid, marker_path=r'C:\\wl_sampler_target_data\\wl.exited')
+    >>> result = wait_for_completion(probe, timeout=60)
+    >>> result.status, result.round_trips
+    ('exited', 9)
+"""
+import time
+
+EXITED = 'exited'
+TIMEOUT = 'timeout'
+PROBE_FAILED = 'probe_failed'
+
+DEFAULT_INITIAL_INTERVAL = 0.5
+DEFAULT_MAX_INTERVAL = 10.0
+DEFAULT_BACKOFF = 2.0
+DEFAULT_MAX_FAILURES = 5
+
+
+class WaitResult:
+    """
+    Outcome of wait_for_completion.
+
+    :ivar status: EXITED, TIMEOUT or PROBE_FAILED (too many consecutive probe failures)
+    :ivar elapsed: wait duration [sec]
+    :ivar round_trips: number of target queries made, including the failed ones
+    :ivar probe_failures: number of failed target queries
+    """
+
+    def __init__(self, status, elapsed, round_trips, probe_failures):
+        self.status = status
+        self.elapsed = elapsed
+        self.round_trips = round_trips
+        self.probe_failures = probe_failures
+
+    def __str__(self):
+        return f'{self.status} after {self.elapsed:.1f} sec, {self.round_trips} round trips ' \
+               f'({self.probe_failures} failed)'
+
+
+def wait_for_completion(is_running, timeout=None, initial_interval=DEFAULT_INITIAL_INTERVAL,
+                        max_interval=DEFAULT_MAX_INTERVAL, backoff=DEFAULT_BACKOFF, max_failures=DEFAULT_MAX_FAILURES,
+                        start_time=None, between_checks=None, time_func=time.monotonic, sleep=time.sleep):
+    """
+    Wait until the probe reports that the process is no longer running, or until the timeout.
+
+    The interval between checks starts at "initial_interval" and grows by "backoff" up to "max_interval". The last
+    sleep is cut short at the timeout.
+
+    :param is_running: callable returning True while the process runs. An exception means the check itself failed
+    :param timeout: maximal wait [sec] (None to wait for the exit only)
+    :param max_failures: number of consecutive failed checks after which the wait gives up
+    :param start_time: time_func() value the timeout is measured from (default: now)
+    :param between_checks: optional callable run after every check that is followed by a sleep (e.g. an incremental
+        trace transfer). Its duration counts toward the interval
+    :return: WaitResult
+    """
+    start_time = time_func() if start_time is None else start_time
+    deadline = None if timeout is None else start_time + timeout
+    interval = initial_interval
+    round_trips = 0
+    probe_failures = 0
+    consecutive_failures = 0
+
+    while True:
+        round_trips += 1
+        try:
+            running = is_running()
+            consecutive_failures = 0
+        except Exception as e:
+            probe_failures += 1
+            consecutive_failures += 1
+            print(f'Completion probe failed ({consecutive_failures}/{max_failures}): {e}')
+            if consecutive_failures >= max_failures:
+                return WaitResult(PROBE_FAILED, time_func() - start_time, round_trips, probe_failures)
+            running = True
+
+        now = time_func()
+        if not running:
+            return WaitResult(EXITED, now - start_time, round_trips, probe_failures)
+        if deadline is not None and now >= deadline:
+            return WaitResult(TIMEOUT, now - start_time, round_trips, probe_failures)
+
+        if between_checks is not None:
+            between_checks()
+        wake_time = now + interval if deadline is None else min(now + interval, deadline)
+        remaining = wake_time - time_func()
+        if remaining > 0:
+            sleep(remaining)
+        interval = min(interval * backoff, max_interval)
+
+
+def tasklist_probe(communicator, pid):
+    """
+    Probe that queries the target process list for the pid on every check.
+
+    :param communicator: evtar Communicator
+    :return: callable for wait_for_completion
+    """
+    # Unlike 'tasklist | find', the filter succeeds whether the process runs or not, so an exception is a real failure
+    command = f'tasklist /FI "PID eq {pid}" /NH'
+
+    def is_running():
+        output = communicator.ExecuteCommandOnTarget(command, logOutput=False) or ''
+        return any(str(pid) in line.split() for line in output.splitlines())
+
+    return is_running
+
+
+def start_exit_watcher(communicator, pid, marker_path):
+    """
+    Start a watcher on the target that blocks until the process exits and then creates the marker file.
+
+    :param communicator: evtar Communicator
+    :param pid: target pid to watch
+    :param marker_path: target path of the marker file (its directory must exist)
+    :return: callable for wait_for_completion, checking for the marker without running anything on the target
+    """
+    command = f'powershell -NoProfile -Command "Wait-Process -Id {pid} -ErrorAction SilentlyContinue; ' \
+              f'New-Item -ItemType File -Force -Path \'{marker_path}\' | Out-Null"'
+    communicator.ExecuteCommandOnTargetAsync(command, bOrphan=False)
+
+    def is_running():
+        return not communicator.IsFile(path=marker_path)
+
+    return is_running
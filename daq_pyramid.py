@@ -0,0 +1,230 @@
+"""
+Multi-resolution pyramid of a NiDAQ power trace.
+
+NiDAQ traces are sampled at kHz rates with many channels, while the combine needs them at most at the ThermaPy sampling
+rate (for the DAQAlign pattern search) and reduces them to the ~15 ms EMON grid anyway. The NiDAQ CSV is therefore
+streamed once, in fixed-size row chunks, into a pyramid of pre-aggregated levels (by default 1 ms, 10 ms and 100 ms).
+Every level holds, per time bin, the time of the first sample of the bin, the sample count and the mean, min and max of
+every selected channel. Memory use of the ingestion does not depend on the capture length, and a reader loads only
+the level it needs, so it does not depend on the raw sample rate either.
+
+The pyramid is a directory with a 'pyramid.json' description and one sub-directory per level, written in the columnar
+cache layout of thermapy_parser (one raw binary file per column), so every level is loaded back as read-only memory
+maps. A level frame is indexed by 'TimeStamp' [sec] and has the mean of every channel under the channel name (so it
+reads like the NiDAQ CSV), plus '<channel>_min', '<channel>_max' and 'count' columns.
+
+:example:
+
+    >>> pyramid_dir = build_pyramid('NiDaq.csv', channels=['P_IA', 'V_IA', 'I_IA'])
+    >>> resolution = select_resolution(pyramid_dir, 0.005)
+    >>> daq_trace = load_level(pyramid_dir, resolution)
+    >>> daq_trace['P_IA']
+"""
+import json
+import os
+
+import numpy
+import pandas
+
+from thermapy_parser import CACHE_DTYPE, CACHE_INFO_FILE, load_cache
+
+PYRAMID_SUFFIX = '.pyramid'
+PYRAMID_INFO_FILE = 'pyramid.json'
+TIME_COLUMN = 'TimeStamp'
+COUNT_COLUMN = 'count'
+DEFAULT_RESOLUTIONS = (0.001, 0.01, 0.1)
+DEFAULT_CHUNK_ROWS = 262144
+
+# Fraction of a bin tolerated below a bin edge, so samples on a regular grid are not pushed into the previous bin by
+# floating point rounding
+_EDGE_TOLERANCE = 1e-6
+
+
+def pyramid_path(daq_file):
+    """
+    Default pyramid directory of a NiDAQ CSV
+    """
+    return os.path.splitext(daq_file)[0] + PYRAMID_SUFFIX
+
+
+def is_pyramid(path):
+    return os.path.isfile(os.path.join(path, PYRAMID_INFO_FILE))
+
+
+def read_pyramid_info(pyramid_dir):
+    with open(os.path.join(pyramid_dir, PYRAMID_INFO_FILE), 'r') as in_file:
+        return json.load(in_file)
+
+
+def _level_columns(channels):
+    columns = [TIME_COLUMN, COUNT_COLUMN]
+    for channel in channels:
+        columns += [channel, f'{channel}_min', f'{channel}_max']
+    return columns
+
+
+class _Level:
+    """
+    Writer of one pyramid level. The last bin of every chunk is held back, as the next chunk may continue it.
+    """
+
+    def __init__(self, level_dir, resolution, origin, channels):
+        os.makedirs(level_dir, exist_ok=True)
+        self.level_dir = level_dir
+        self.resolution = resolution
+        self.origin = origin
+        self.channels = channels
+        self.rows = 0
+        self.pending = None
+        self.outputs = [open(os.path.join(level_dir, f'column_{i}.bin'), 'wb')
+                        for i in range(len(_level_columns(channels)))]
+
+    def add(self, times, values):
+        """
+        :param times: sample times of a chunk [sec], sorted
+        :param values: samples x channels array of the chunk
+        """
+        bins = numpy.floor((times - self.origin) / self.resolution + _EDGE_TOLERANCE).astype(numpy.int64)
+        starts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(bins)) + 1])
+        counts = numpy.diff(numpy.append(starts, bins.shape[0]))
+        groups = [bins[starts], times[starts], counts,
+                  numpy.add.reduceat(values, starts, axis=0),
+                  numpy.minimum.reduceat(values, starts, axis=0),
+                  numpy.maximum.reduceat(values, starts, axis=0)]
+
+        if self.pending is not None and self.pending[0][0] == groups[0][0]:
+            _, pending_time, pending_count, pending_sum, pending_min, pending_max = self.pending
+            groups[1][0] = pending_time[0]
+            groups[2][0] += pending_count[0]
+            groups[3][0] += pending_sum[0]
+            groups[4][0] = numpy.minimum(groups[4][0], pending_min[0])
+            groups[5][0] = numpy.maximum(groups[5][0], pending_max[0])
+        elif self.pending is not None:
+            self._write(self.pending)
+        self._write([group[:-1] for group in groups])
+        self.pending = [group[-1:] for group in groups]
+
+    def _write(self, groups):
+        _, times, counts, sums, mins, maxs = groups
+        if not times.shape[0]:
+            return
+        columns = [times, counts.astype(CACHE_DTYPE)]
+        means = sums / counts[:, numpy.newaxis]
+        for position in range(len(self.channels)):
+            columns += [means[:, position], mins[:, position], maxs[:, position]]
+        for output, column in zip(self.outputs, columns):
+            output.write(numpy.ascontiguousarray(column, dtype=CACHE_DTYPE).tobytes())
+        self.rows += times.shape[0]
+
+    def close(self, complete=True):
+        """
+        :param complete: write the held back last bin
+        """
+        try:
+            if complete and self.pending is not None:
+                self._write(self.pending)
+        finally:
+            for output in self.outputs:
+                output.close()
+        info = {
+            'columns': _level_columns(self.channels),
+            'rows': self.rows,
+            'dtype': CACHE_DTYPE,
+            'time_unit': 'sec',
+            'resolution': self.resolution,
+        }
+        with open(os.path.join(self.level_dir, CACHE_INFO_FILE), 'w') as out_file:
+            json.dump(info, out_file, indent=4)
+
+
+def build_pyramid(daq_file, pyramid_dir=None, channels=None, resolutions=DEFAULT_RESOLUTIONS,
+                  chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Stream a NiDAQ CSV into a multi-resolution pyramid. Only the TimeStamp column and the selected channels are parsed.
+
+    :param daq_file: NiDAQ CSV trace, with a TimeStamp column [sec]
+    :param pyramid_dir: pyramid directory (default: the CSV path with a '.pyramid' extension)
+    :param channels: channel columns to keep (default: every numeric column)
+    :param resolutions: bin widths of the levels [sec]
+    :param chunk_rows: number of CSV rows aggregated at once
+    :return: path of the pyramid directory
+    """
+    pyramid_dir = pyramid_dir or pyramid_path(daq_file)
+    resolutions = sorted(float(resolution) for resolution in resolutions)
+    if not resolutions or resolutions[0] <= 0:
+        raise ValueError(f'Invalid pyramid resolutions: {resolutions}')
+    usecols = None if channels is None else [TIME_COLUMN] + list(channels)
+
+    levels = []
+    rows = 0
+    try:
+        for chunk in pandas.read_csv(daq_file, usecols=usecols, chunksize=chunk_rows):
+            if not levels:
+                if channels is None:
+                    channels = [column for column in chunk.select_dtypes(include='number').columns
+                                if column != TIME_COLUMN]
+                origin = float(chunk[TIME_COLUMN].iloc[0])
+                levels = [_Level(os.path.join(pyramid_dir, f'level_{position}'), resolution, origin, channels)
+                          for position, resolution in enumerate(resolutions)]
+            times = chunk[TIME_COLUMN].to_numpy(dtype=CACHE_DTYPE)
+            values = chunk[channels].to_numpy(dtype=CACHE_DTYPE)
+            for level in levels:
+                level.add(times, values)
+            rows += times.shape[0]
+    except BaseException:
+        for level in levels:
+            level.close(complete=False)
+        raise
+    if not levels:
+        raise ValueError(f'No DAQ samples in {daq_file}')
+    for level in levels:
+        level.close()
+
+    info = {
+        'source': os.path.abspath(daq_file),
+        'channels': list(channels),
+        'rows': rows,
+        'origin': levels[0].origin,
+        'levels': [{'resolution': level.resolution, 'path': os.path.basename(level.level_dir), 'rows': level.rows}
+                   for level in levels],
+    }
+    with open(os.path.join(pyramid_dir, PYRAMID_INFO_FILE), 'w') as out_file:
+        json.dump(info, out_file, indent=4)
+    return pyramid_dir
+
+
+def select_resolution(pyramid_dir, resolution=None):
+    """
+    :param resolution: finest resolution the reader needs [sec] (None for the finest level)
+    :return: resolution of the coarsest level not coarser than the requested one, or of the finest level
+    """
+    resolutions = [level['resolution'] for level in read_pyramid_info(pyramid_dir)['levels']]
+    if resolution is None:
+        return resolutions[0]
+    return max([value for value in resolutions if value <= resolution], default=resolutions[0])
+
+
+def load_level(pyramid_dir, resolution=None, stats=('mean',)):
+    """
+    Load a pyramid level as a frame of read-only memory maps.
+
+    :param resolution: resolution of the level [sec] (None for the finest level, see select_resolution)
+    :param stats: statistics to load: 'mean' (under the channel names), 'min', 'max' and 'count'
+    :return: pandas.DataFrame indexed by TimeStamp [sec], the time of the first sample of every bin, with the level
+        resolution in its 'resolution' attribute (DataFrame.attrs)
+    """
+    info = read_pyramid_info(pyramid_dir)
+    levels = {level['resolution']: level for level in info['levels']}
+    if resolution is None:
+        resolution = select_resolution(pyramid_dir)
+    if resolution not in levels:
+        raise ValueError(f'No {resolution} sec level in {pyramid_dir} (levels: {sorted(levels)})')
+
+    frame = load_cache(os.path.join(pyramid_dir, levels[resolution]['path']))
+    columns = [COUNT_COLUMN] if 'count' in stats else []
+    for channel in info['channels']:
+        columns += [channel] if 'mean' in stats else []
+        columns += [f'{channel}_{stat}' for stat in ('min', 'max') if stat in stats]
+    frame = frame.set_index(TIME_COLUMN)[columns]
+    frame.attrs['resolution'] = resolution
+    return frame
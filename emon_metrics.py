@@ -0,0 +1,170 @@
+"""
+Derived EMON metrics evaluated for every logical CPU at once.
+
+A metric is a formula over EMON event names, e.g. 'CPU_CLK_UNHALTED.THREAD / (CPU_CLK_UNHALTED.REF_TSC / tsc_freq)'.
+Besides the events, a formula may use numbers, + - * / ** and parentheses, 'tsc_freq' (the TSC frequency [Hz]) and
+'TSC' (the TSC ticks of every sample). Every event of a formula is gathered into one samples x CPUs array over the
+(package, core_type, CPU) columns that count all of the formula's events, so a formula is evaluated once for all the
+CPUs of all core types. CPUs missing an event of a formula get no column for that metric.
+
+:example:
+
+    >>> emon_trace = emon_parser.parse('emon_raw_data.txt')
+    >>> metrics = compute_metrics(emon_trace.data, emon_trace.tsc_freq, select_metrics(['Frequency', 'IPC']))
+    >>> metrics[('package0', 'bigcore', 'CPU1', 'IPC')]
+"""
+import ast
+import json
+import re
+
+import numpy
+import pandas
+
+from emon_parser import COLUMN_LEVELS, LEADING_COLUMNS
+
+DEFAULT_METRICS = {
+    'Duration': 'CPU_CLK_UNHALTED.REF_TSC / tsc_freq',
+    'Frequency': 'CPU_CLK_UNHALTED.THREAD / (CPU_CLK_UNHALTED.REF_TSC / tsc_freq) / 1e6',
+    'IPC': 'INST_RETIRED.ANY / CPU_CLK_UNHALTED.THREAD',
+    'Utilization': 'CPU_CLK_UNHALTED.REF_TSC / TSC',
+    'Slots_per_cycle': 'TOPDOWN.SLOTS:perf_metrics / CPU_CLK_UNHALTED.THREAD',
+    'DSB_uops_per_cycle': 'IDQ.DSB_UOPS:u0x2C / CPU_CLK_UNHALTED.THREAD',
+    'L1D_MPKI': 'L1D.REPLACEMENT / INST_RETIRED.ANY * 1000',
+    'L2_RPKI': 'L2_RQSTS.REFERENCES / INST_RETIRED.ANY * 1000',
+}
+DEFAULT_ALIGN_CPU = 'CPU0'
+
+_CONSTANTS = ('tsc_freq', 'TSC')
+# names, but not the exponent of a number such as 1e6
+_NAME = re.compile(r'(?<![\w.])[A-Za-z_][\w.:]*')
+_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Name, ast.Load, ast.Constant, ast.Add, ast.Sub, ast.Mult,
+          ast.Div, ast.Pow, ast.USub, ast.UAdd)
+
+
+class Formula:
+    """
+    Compiled metric formula.
+
+    :ivar events: EMON event names the formula uses
+    """
+
+    def __init__(self, text):
+        self.text = text
+        names = {}
+
+        def substitute(match):
+            return names.setdefault(match.group(0), f'_v{len(names)}')
+
+        try:
+            expression = ast.parse(_NAME.sub(substitute, text), mode='eval')
+        except SyntaxError:
+            raise ValueError(f'Invalid metric formula: {text}')
+        for node in ast.walk(expression):
+            if not isinstance(node, _NODES):
+                raise ValueError(f'Unsupported syntax in metric formula: {text}')
+        self._code = compile(expression, '<metric>', 'eval')
+        self._names = names
+        self.events = [name for name in names if name not in _CONSTANTS]
+
+    def evaluate(self, values):
+        """
+        :param values: dict of event/constant name -> array (or scalar)
+        :return: formula value array
+        """
+        variables = {variable: values[name] for name, variable in self._names.items()}
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return eval(self._code, {'__builtins__': {}}, variables)
+
+
+def select_metrics(names, definitions=DEFAULT_METRICS):
+    """
+    :param names: metric names to produce
+    :param definitions: dict of metric name -> formula to select from
+    :return: dict of the selected metric name -> formula
+    """
+    unknown = [name for name in names if name not in definitions]
+    if unknown:
+        raise ValueError(f'Unknown metrics: {unknown}')
+    return {name: definitions[name] for name in names}
+
+
+def load_metrics(path):
+    """
+    Read metric definitions from a JSON dict of metric name -> formula
+    """
+    with open(path, 'r') as in_file:
+        definitions = json.load(in_file)
+    for formula in definitions.values():
+        Formula(formula)
+    return definitions
+
+
+def _cpu_columns(columns):
+    """
+    Map of event name -> {(package, core_type, CPU) -> column position}
+    """
+    events = {}
+    for position, column in enumerate(columns):
+        if isinstance(column, tuple) and len(column) == len(COLUMN_LEVELS) and all(column):
+            events.setdefault(column[-1], {})[column[:-1]] = position
+    return events
+
+
+def list_cpus(columns):
+    """
+    :return: (package, core_type, CPU) tuples of the trace columns, in column order
+    """
+    cpus = {}
+    for column in columns:
+        if isinstance(column, tuple) and len(column) == len(COLUMN_LEVELS) and all(column):
+            cpus.setdefault(column[:-1], None)
+    return list(cpus)
+
+
+def select_cpu(columns, cpu=DEFAULT_ALIGN_CPU):
+    """
+    Find a logical CPU of the trace by name.
+
+    :param cpu: 'CPU3', 'bigcore/CPU3' or 'package0/bigcore/CPU3'
+    :return: (package, core_type, CPU) tuple of the first match
+    """
+    parts = tuple(cpu.split('/'))
+    for candidate in list_cpus(columns):
+        if candidate[-len(parts):] == parts:
+            return candidate
+    raise ValueError(f'CPU {cpu} is not in the EMON trace')
+
+
+def compute_metrics(data, tsc_freq, metrics=DEFAULT_METRICS, cpus=None):
+    """
+    Evaluate metric formulas for all (or the given) logical CPUs.
+
+    :param data: EmonTrace.data
+    :param tsc_freq: TSC frequency [Hz]
+    :param metrics: dict of metric name -> formula
+    :param cpus: optional (package, core_type, CPU) tuples to evaluate for (default: every CPU of the trace)
+    :return: pandas.DataFrame on the trace index with (package, core_type, CPU, metric) columns, ordered by CPU
+    """
+    event_columns = _cpu_columns(data.columns)
+    cpus = list_cpus(data.columns) if cpus is None else list(cpus)
+    constants = {'tsc_freq': tsc_freq, 'TSC': data[(LEADING_COLUMNS[1], '', '', '')].to_numpy(dtype=float)[:, None]}
+
+    results = {}
+    for name, text in metrics.items():
+        formula = Formula(text)
+        metric_cpus = [cpu for cpu in cpus if all(cpu in event_columns.get(event, {}) for event in formula.events)]
+        if not metric_cpus:
+            continue
+        values = dict(constants)
+        for event in formula.events:
+            positions = [event_columns[event][cpu] for cpu in metric_cpus]
+            values[event] = data.iloc[:, positions].to_numpy(dtype=float)
+        result = numpy.broadcast_to(formula.evaluate(values), (data.shape[0], len(metric_cpus)))
+        for i, cpu in enumerate(metric_cpus):
+            results[cpu + (name,)] = result[:, i]
+
+    order = {cpu: i for i, cpu in enumerate(cpus)}
+    names = list(metrics)
+    columns = sorted(results, key=lambda column: (order[column[:-1]], names.index(column[-1])))
+    return pandas.DataFrame({column: results[column] for column in columns}, index=data.index,
+                            columns=pandas.MultiIndex.from_tuples(columns, names=COLUMN_LEVELS) if columns else None)
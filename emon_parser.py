@@ -0,0 +1,253 @@
+"""
+Single-pass parser for EMON traces collected with the -V switch.
+
+The -V layout is a '# SYSTEM INFORMATION' block of "key : value" comment lines, followed by a four-row header
+(package / core type / CPU / event, where the first two columns are the epoch and TSC timestamp) and ';'-separated
+sample rows. EMON pads the event header row with trailing ';' separators; they are stripped in memory while reading
+instead of rewriting the file. iter_chunks parses a trace chunk by chunk for traces that do not fit in memory.
+
+:example:
+
+    >>> emon_trace = parse('emon_raw_data.txt')
+    >>> emon_trace.tsc_freq
+    2419200000.0
+    >>> emon_trace.data[('package0', 'bigcore', 'CPU0', 'CPU_CLK_UNHALTED.THREAD')]
+"""
+import itertools
+import warnings
+
+import numpy
+import pandas
+
+# Bump when the parsed output changes (used to invalidate cached traces)
+PARSER_VERSION = 1
+SYSTEM_INFO_START = '# SYSTEM INFORMATION FOLLOWS'
+SYSTEM_INFO_END = '# END OF SYSTEM INFORMATION'
+HEADER_ROWS = 4
+LEADING_COLUMNS = ('epoch', 'timestamp')
+COLUMN_LEVELS = ['package', 'core_type', 'CPU', 'event']
+DEFAULT_CHUNK_LINES = 65536
+
+_FREQ_UNITS = {'hz': 1.0, 'khz': 1e3, 'mhz': 1e6, 'ghz': 1e9}
+
+
+class EmonTrace:
+    """
+    Parsed EMON trace.
+
+    :ivar data: pandas.DataFrame indexed by sample time [sec] with (package, core_type, CPU, event) columns. The first
+        two columns are the raw epoch [ms] and TSC timestamp delta.
+    :ivar tsc_freq: TSC frequency [Hz]
+    :ivar system_info: dict of the '# SYSTEM INFORMATION' key/value pairs
+    """
+
+    def __init__(self, data, tsc_freq, system_info):
+        self.data = data
+        self.tsc_freq = tsc_freq
+        self.system_info = system_info
+
+
+def _parse_frequency(value):
+    """
+    Convert an EMON frequency string such as "2419.20 MHz" into Hz. Returns None for "N/A".
+    """
+    parts = value.split()
+    try:
+        number = float(parts[0])
+    except (IndexError, ValueError):
+        return None
+    unit = parts[1].lower() if len(parts) > 1 else 'hz'
+    return number * _FREQ_UNITS.get(unit, 1.0)
+
+
+def _split_row(line):
+    return line.rstrip().rstrip(';').split(';')
+
+
+def _forward_fill(labels, width):
+    result = []
+    current = ''
+    for index in range(width):
+        label = labels[index] if index < len(labels) else ''
+        if label:
+            current = label
+        result.append(current)
+    return result
+
+
+def _build_columns(header):
+    """
+    Build the column tuples from the four -V header rows.
+    """
+    package_row, core_type_row, cpu_row, event_row = header
+    width = len(event_row)
+    packages = _forward_fill(package_row, width)
+    core_types = _forward_fill(core_type_row, width)
+    cpus = _forward_fill(cpu_row, width)
+
+    columns = [(name, '', '', '') for name in LEADING_COLUMNS]
+    for index in range(len(LEADING_COLUMNS), width):
+        columns.append((packages[index], core_types[index], cpus[index], event_row[index]))
+    return columns
+
+
+def _rows_to_array(rows, width):
+    """
+    Convert a chunk of stripped sample rows into a (len(rows), width) array without splitting each row in Python.
+    """
+    text = ';'.join(rows)
+    for dtype in (numpy.int64, numpy.float64):
+        with warnings.catch_warnings():
+            # numpy warns (instead of raising) when the text stops parsing early; the size check below handles it
+            warnings.simplefilter('ignore', DeprecationWarning)
+            values = numpy.fromstring(text, dtype=dtype, sep=';')
+        if values.size == len(rows) * width:
+            return values.reshape(len(rows), width)
+    raise ValueError('EMON sample rows contain non-numeric values')
+
+
+class EmonStreamParser:
+    """
+    Incremental EMON -V parser: text is fed as it becomes available (e.g. while the trace is still being written) and
+    the complete sample rows are converted to NumPy in chunks. A line cut at the end of a fed text is kept until the
+    rest of it arrives.
+
+    :example:
+
+        >>> parser = EmonStreamParser()
+        >>> parser.feed(first_part)
+        >>> parser.feed(second_part)
+        >>> trace = parser.finish()
+    """
+
+    def __init__(self, chunk_lines=DEFAULT_CHUNK_LINES):
+        self.chunk_lines = chunk_lines
+        self.system_info = {}
+        self.header = []
+        self.chunks = []
+        self.rows = []
+        self.width = None
+        self._in_system_info = False
+        self._partial = ''
+
+    @property
+    def sample_count(self):
+        return sum(chunk.shape[0] for chunk in self.chunks) + len(self.rows)
+
+    def feed_lines(self, lines):
+        """
+        Parse complete lines.
+        """
+        for line in lines:
+            if self.width is None:
+                line = line.strip()
+                if line.startswith('#'):
+                    if line.startswith(SYSTEM_INFO_START):
+                        self._in_system_info = True
+                    elif line.startswith(SYSTEM_INFO_END):
+                        self._in_system_info = False
+                    elif self._in_system_info and ':' in line:
+                        key, value = line[1:].split(':', 1)
+                        self.system_info[key.strip()] = value.strip()
+                    continue
+                if not line:
+                    continue
+                self.header.append(_split_row(line))
+                if len(self.header) == HEADER_ROWS:
+                    self.width = len(self.header[-1])
+                continue
+
+            line = line.rstrip().rstrip(';')
+            if not line or line.startswith('#'):
+                continue
+            if line.count(';') != self.width - 1:
+                continue
+            self.rows.append(line)
+            if len(self.rows) >= self.chunk_lines:
+                self.chunks.append(_rows_to_array(self.rows, self.width))
+                self.rows = []
+
+    def feed(self, text):
+        """
+        Parse a piece of the trace text, which may start or end in the middle of a line.
+        """
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        self.feed_lines(lines)
+
+    def _trace(self, values):
+        columns = pandas.MultiIndex.from_tuples(_build_columns(self.header), names=COLUMN_LEVELS)
+        index = pandas.Index(values[:, 0] / 1000, name='Time')
+        data = pandas.DataFrame(values, index=index, columns=columns)
+
+        tsc_freq = _parse_frequency(self.system_info.get('tsc_freq', ''))
+        return EmonTrace(data=data, tsc_freq=tsc_freq, system_info=self.system_info)
+
+    def _flush(self, source):
+        if self._partial:
+            self.feed_lines([self._partial])
+            self._partial = ''
+        if self.width is None:
+            raise ValueError(f'{source} does not contain an EMON -V header')
+        if self.rows:
+            self.chunks.append(_rows_to_array(self.rows, self.width))
+            self.rows = []
+
+    def take_chunks(self, final=False, source='EMON trace'):
+        """
+        Hand over the sample rows converted so far as traces of one chunk each, dropping them from the parser.
+
+        :param final: also parse the remaining text and rows (the trace is complete)
+        :param source: trace name used in errors
+        :return: list of EmonTrace
+        """
+        if final:
+            self._flush(source)
+        traces = [self._trace(values) for values in self.chunks]
+        self.chunks = []
+        return traces
+
+    def finish(self, source='EMON trace'):
+        """
+        Parse the remaining text and build the trace.
+
+        :param source: trace name used in errors
+        :return: EmonTrace
+        """
+        self._flush(source)
+        values = numpy.concatenate(self.chunks) if self.chunks else numpy.empty((0, self.width), dtype=numpy.int64)
+        return self._trace(values)
+
+
+def parse(emon_file, chunk_lines=DEFAULT_CHUNK_LINES):
+    """
+    Parse an EMON -V trace in a single pass over the file.
+
+    Rows with an unexpected number of fields (e.g. the last line of a trace cut when EMON was killed) are dropped.
+
+    :param emon_file: path to EMON trace file generated with -V switch
+    :param chunk_lines: number of sample rows converted to NumPy at once
+    :return: EmonTrace
+    """
+    parser = EmonStreamParser(chunk_lines=chunk_lines)
+    with open(emon_file, 'r') as in_file:
+        parser.feed_lines(in_file)
+    return parser.finish(source=emon_file)
+
+
+def iter_chunks(emon_file, chunk_lines=DEFAULT_CHUNK_LINES):
+    """
+    Parse an EMON -V trace chunk by chunk, without holding the whole trace in memory.
+
+    :param emon_file: path to EMON trace file generated with -V switch
+    :param chunk_lines: number of sample rows of every chunk
+    :return: generator of EmonTrace, one per chunk of samples, all with the same columns
+    """
+    parser = EmonStreamParser(chunk_lines=chunk_lines)
+    with open(emon_file, 'r') as in_file:
+        while True:
+            lines = list(itertools.islice(in_file, chunk_lines))
+            parser.feed_lines(lines)
+            yield from parser.take_chunks(final=not lines, source=emon_file)
+            if not lines:
+                return
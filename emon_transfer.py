@@ -0,0 +1,164 @@
+"""
+Incremental transfer of the EMON trace from the target while it is being written.
+
+The communicator can only copy whole files, so every pull runs a small PowerShell step on the target that copies the
+bytes appended since the previous pull (opening the trace with read/write sharing, as EMON keeps it open) into a chunk
+file, gzip-compressed by default. The chunk is copied to the host, appended to the local trace and fed to an
+incremental EMON parser, so when the workload ends the trace is already local and parsed. The final pull is verified
+against the SHA-256 of the complete target file; on a mismatch the whole file is copied again, as before.
+
+:example:
+
+    >>> transfer = EmonTransfer(Communicator, target_path, host_path, chunk_path=r'C:\\data\\emon_chunk.gz')
+    >>> transfer.poll()  # periodically while the workload runs
+    >>> host_path, emon_trace = transfer.finish()
+"""
+import gzip
+import hashlib
+import os
+import time
+
+import emon_parser
+from run_timeline import stage
+from trace_cache import trace_key
+
+DEFAULT_INTERVAL = 10.0
+
+_COPY_RANGE = (
+    "$s=[IO.File]::Open('{source}','Open','Read','ReadWrite'); $s.Seek({offset},'Begin')|Out-Null; "
+    "$b=New-Object byte[] {length}; $n=0; "
+    "while($n -lt {length}){{ $r=$s.Read($b,$n,{length}-$n); if($r -le 0){{break}}; $n+=$r }}; $s.Close(); "
+    "$o=[IO.File]::Create('{chunk}'); {writer}; $o.Close()"
+)
+_PLAIN_WRITER = "$o.Write($b,0,$n)"
+_GZIP_WRITER = ("$z=New-Object IO.Compression.GZipStream($o,[IO.Compression.CompressionMode]::Compress); "
+                "$z.Write($b,0,$n); $z.Close()")
+_FILE_HASH = "(Get-FileHash -Algorithm SHA256 -Path '{path}').Hash"
+
+
+def _powershell(script):
+    return f'powershell -NoProfile -Command "{script}"'
+
+
+class EmonTransfer:
+    """
+    Pulls the appended byte ranges of a growing target file into a host copy and parses them as they arrive.
+
+    :ivar offset: number of bytes transferred so far
+    :ivar pulls: number of range pulls made
+    :ivar transferred: number of bytes copied over the link (compressed size)
+    """
+
+    def __init__(self, communicator, target_path, host_path, chunk_path, compress=True, interval=DEFAULT_INTERVAL,
+                 parse=True, timeline=None):
+        """
+        :param communicator: evtar Communicator
+        :param target_path: trace path on the target
+        :param host_path: trace copy path on the host
+        :param chunk_path: temporary chunk path on the target
+        :param compress: gzip the chunks on the target
+        :param interval: minimal time between two pulls [sec]
+        :param parse: feed the transferred text to an EmonStreamParser
+        :param timeline: optional run_timeline.Timeline recording every pull
+        """
+        self.communicator = communicator
+        self.target_path = target_path
+        self.host_path = host_path
+        self.chunk_path = chunk_path
+        self.compress = compress
+        self.interval = interval
+        self.parser = emon_parser.EmonStreamParser() if parse else None
+        self.timeline = timeline
+        self.offset = 0
+        self.pulls = 0
+        self.transferred = 0
+        self._digest = hashlib.sha256()
+        self._last_pull = None
+        self._failed = False
+        self._host_chunk = host_path + '.chunk'
+        open(host_path, 'wb').close()
+
+    def _pull(self):
+        if not self.communicator.IsFile(path=self.target_path):
+            return 0
+        size = int(self.communicator.GetFileSize(sFilePath=self.target_path))
+        length = size - self.offset
+        if length <= 0:
+            return 0
+
+        script = _COPY_RANGE.format(source=self.target_path, offset=self.offset, length=length,
+                                    chunk=self.chunk_path, writer=_GZIP_WRITER if self.compress else _PLAIN_WRITER)
+        self.communicator.ExecuteCommandOnTarget(_powershell(script), logOutput=False)
+        self.communicator.GetFileFromTarget(sourceFileLocation=self.chunk_path, whereToStore=self._host_chunk)
+        self.transferred += os.path.getsize(self._host_chunk)
+        with open(self._host_chunk, 'rb') as in_file:
+            data = gzip.decompress(in_file.read()) if self.compress else in_file.read()
+        os.remove(self._host_chunk)
+
+        with open(self.host_path, 'ab') as out_file:
+            out_file.write(data)
+        self._digest.update(data)
+        self.offset += len(data)
+        self.pulls += 1
+        if self.parser is not None:
+            # EMON writes ASCII, so a chunk never splits a character
+            self.parser.feed(data.decode('ascii', errors='replace'))
+        return len(data)
+
+    def poll(self):
+        """
+        Pull the appended bytes if the interval since the previous pull has passed. A failing pull is reported and
+        the transfer falls back to copying the whole file at the end.
+        """
+        now = time.monotonic()
+        if self._failed or (self._last_pull is not None and now - self._last_pull < self.interval):
+            return
+        self._last_pull = now
+        try:
+            with stage(self.timeline, 'emon pull'):
+                self._pull()
+        except Exception as e:
+            print(f'EMON incremental transfer failed, the trace will be copied at the end: {e}')
+            self._failed = True
+
+    def _target_digest(self):
+        output = self.communicator.ExecuteCommandOnTarget(_powershell(_FILE_HASH.format(path=self.target_path)),
+                                                          logOutput=False) or ''
+        return output.strip().lower()
+
+    def finish(self):
+        """
+        Pull the rest of the (complete) trace and verify the host copy.
+
+        :return: (host path, emon_parser.EmonTrace or None when not parsing or after a fallback to a full copy)
+        """
+        try:
+            if not self._failed:
+                while self._pull():
+                    pass
+                if self._target_digest() != self._digest.hexdigest():
+                    print('EMON incremental transfer does not match the target trace, copying the whole trace')
+                    self._failed = True
+        except Exception as e:
+            print(f'EMON incremental transfer failed, copying the whole trace: {e}')
+            self._failed = True
+
+        if self._failed:
+            self.communicator.GetFileFromTarget(sourceFileLocation=self.target_path, whereToStore=self.host_path)
+            return self.host_path, None
+        print(f'EMON trace transferred in {self.pulls} pulls: {self.offset} bytes, {self.transferred} over the link')
+        return self.host_path, None if self.parser is None else self.parser.finish(source=self.target_path)
+
+    @property
+    def digest(self):
+        """
+        SHA-256 of the host copy (valid after a successful finish)
+        """
+        return self._digest.hexdigest()
+
+    def store(self, cache, trace):
+        """
+        Store the parsed trace in the trace cache under the key the combine step looks up, so it is not parsed again.
+        """
+        cache.put_frame(trace_key('emon', emon_parser.PARSER_VERSION, self.digest), trace.data,
+                        {'tsc_freq': trace.tsc_freq, 'system_info': trace.system_info})
@@ -0,0 +1,90 @@
+"""
+Host resources shared by the DUTs sampled from one host.
+
+A NiDAQ device and a PythonSV session (the ThermaPy collector, local or behind a ThermaPy daemon) can serve one DUT
+collection at a time. A DUT uses the NiDAQ device its 'nidaq_calibration_file' describes (the file DAQ.DAQ is
+created from) and the PythonSV session of its 'thermapy_daemon_address' (or the local session); DUTs using the same
+device or session take turns on it through a lock, and DUTs with resources of their own collect concurrently. The
+locks of a collection are always acquired in the same order, so two collections never wait on each other.
+
+The PythonSV session is released as soon as the collectors stop. The NiDAQ device is held until its output file has
+been brought to the host, as the next recording on the device overwrites it (so DUTs recording different devices must
+not share a 'nidaq_output_file', see nidaq_output_conflicts).
+
+:example:
+
+    >>> manager = multiprocessing.Manager()
+    >>> locks = {key: manager.Lock() for key in resource_keys(cfg).values()}
+    >>> resources = HostResources({kind: locks[key] for kind, key in resource_keys(cfg).items()})
+    >>> resources.acquire()
+    >>> resources.release(PYTHONSV)
+    >>> resources.release()
+"""
+import ntpath
+
+NIDAQ = 'nidaq'
+PYTHONSV = 'pythonsv'
+# acquisition order of the resource kinds
+RESOURCE_KINDS = (NIDAQ, PYTHONSV)
+LOCAL_SESSION = 'local'
+
+
+def resource_keys(cfg):
+    """
+    :param cfg: wl_sampler configuration of a DUT
+    :return: dict of resource kind -> host-wide name of the resource the DUT uses
+    """
+    return {
+        NIDAQ: f"{NIDAQ}:{_normpath(cfg.get('nidaq_calibration_file'))}",
+        PYTHONSV: f"{PYTHONSV}:{cfg.get('thermapy_daemon_address') or LOCAL_SESSION}",
+    }
+
+
+def _normpath(path):
+    # the lab host paths are Windows paths
+    return ntpath.normcase(ntpath.normpath(path)) if path else ''
+
+
+def nidaq_output_conflicts(cfgs):
+    """
+    :param cfgs: wl_sampler configurations of the DUTs sampled together
+    :return: sorted NiDAQ output files that DUTs using different NiDAQ devices would record into at the same time
+    """
+    devices = {}
+    for cfg in cfgs:
+        devices.setdefault(_normpath(cfg.get('nidaq_output_file')), set()).add(resource_keys(cfg)[NIDAQ])
+    return sorted(output for output, keys in devices.items() if len(keys) > 1)
+
+
+class HostResources:
+    """
+    The shared host resources of one DUT.
+
+    :ivar held: resource kinds currently held
+    """
+
+    def __init__(self, locks):
+        """
+        :param locks: dict of resource kind -> lock (e.g. a multiprocessing.Manager lock shared with the other DUTs)
+        """
+        self.locks = locks
+        self.held = []
+
+    def acquire(self):
+        """
+        Wait for every resource of the DUT
+        """
+        for kind in RESOURCE_KINDS:
+            if kind in self.locks and kind not in self.held:
+                self.locks[kind].acquire()
+                self.held.append(kind)
+
+    def release(self, *kinds):
+        """
+        Release the given resource kinds (default: every held resource). Releasing a resource that is not held does
+        nothing, so it is safe on error paths.
+        """
+        for kind in kinds or list(self.held):
+            if kind in self.held:
+                self.held.remove(kind)
+                self.locks[kind].release()
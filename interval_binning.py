@@ -0,0 +1,133 @@
+"""
+Interval binning of sampled traces onto another trace's sample grid (the EMON sample times).
+
+A sample at time t belongs to the interval (left, right] of consecutive grid edges and is labeled by the interval's
+right edge. Samples at or before the first edge or after the last edge are dropped. Every column is reduced per
+interval with the aggregation assigned to it by a declarative policy: an ordered list of (column pattern, aggregation)
+pairs, where the first matching fnmatch pattern wins and columns without a match are dropped.
+
+:example:
+
+    >>> policy = [('DTS*', 'mean'), ('cycles', 'sum')]
+    >>> bin_to_intervals(thermalpy_df, edges=emon_df.index.values, policy=policy)
+"""
+import fnmatch
+
+import numpy
+import pandas
+
+AGGREGATIONS = ('mean', 'sum', 'last', 'min', 'max', 'time_weighted_mean')
+
+
+def step_integral(x, values, points, mode='after'):
+    """
+    Integral of a step function from its first point to each of the given points, computed with one cumulative sum.
+    Points outside [x[0], x[-1]] are clipped to the step function domain.
+
+    :param x: sorted step points
+    :param values: 2D array (len(x), columns) of step values
+    :param points: points to evaluate the integral at
+    :param mode: step mode. 'after' - values[i] holds on [x[i], x[i + 1]); 'before' - values[i] holds on
+        (x[i - 1], x[i]]
+    :return: 2D array (len(points), columns)
+    """
+    if mode not in ('after', 'before'):
+        raise ValueError(f'Unsupported step mode: {mode}')
+
+    points = numpy.asarray(points, dtype=float)
+    if x.shape[0] < 2:
+        return numpy.zeros((points.shape[0], values.shape[1]))
+
+    step_values = values[:-1] if mode == 'after' else values[1:]
+    integral = numpy.zeros((x.shape[0], values.shape[1]))
+    numpy.cumsum(step_values * numpy.diff(x)[:, numpy.newaxis], axis=0, out=integral[1:])
+
+    points = numpy.clip(points, x[0], x[-1])
+    step_index = numpy.clip(numpy.searchsorted(x, points, side='right') - 1, 0, x.shape[0] - 2)
+    return integral[step_index] + step_values[step_index] * (points - x[step_index])[:, numpy.newaxis]
+
+
+def resolve_policy(columns, policy):
+    """
+    Map every column to its aggregation using the first matching pattern of the policy.
+
+    :param columns: column names
+    :param policy: ordered sequence of (fnmatch pattern, aggregation) pairs
+    :return: dict of column -> aggregation, in column order, without unmatched columns
+    """
+    resolved = {}
+    for column in columns:
+        for pattern, aggregation in policy:
+            if fnmatch.fnmatchcase(str(column), pattern):
+                if aggregation not in AGGREGATIONS:
+                    raise ValueError(f'Unsupported aggregation "{aggregation}" for column {column}')
+                resolved[column] = aggregation
+                break
+    return resolved
+
+
+def _reduce(aggregation, values, starts, ends):
+    if aggregation == 'sum':
+        return numpy.add.reduceat(numpy.nan_to_num(values), starts, axis=0)
+    if aggregation == 'mean':
+        valid = ~numpy.isnan(values)
+        totals = numpy.add.reduceat(numpy.where(valid, values, 0), starts, axis=0)
+        valid_counts = numpy.add.reduceat(valid, starts, axis=0)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return totals / valid_counts
+    if aggregation == 'min':
+        return numpy.fmin.reduceat(values, starts, axis=0)
+    if aggregation == 'max':
+        return numpy.fmax.reduceat(values, starts, axis=0)
+    if aggregation == 'last':
+        return values[ends - 1]
+    raise ValueError(f'Unsupported aggregation "{aggregation}"')
+
+
+def bin_to_intervals(df, edges, policy):
+    """
+    Reduce the samples of "df" into the intervals between consecutive "edges".
+
+    Samples are assigned to intervals with a single binary search and every aggregation is applied to all of its
+    columns at once on contiguous interval segments, so the cost is O(n log m) for n samples and m edges.
+
+    :param df: pandas.DataFrame indexed by sample time
+    :param edges: sorted interval edges
+    :param policy: ordered sequence of (fnmatch pattern, aggregation) pairs. Aggregation is one of 'mean', 'sum',
+        'last', 'min', 'max' or 'time_weighted_mean' (the source is treated as a step function holding each value
+        until the next sample and averaged over the whole interval)
+    :return: pandas.DataFrame indexed by the right edge ('Time') of every interval that received samples
+    """
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index(kind='stable')
+
+    edges = numpy.asarray(edges, dtype=float)
+    x = numpy.asarray(df.index.values, dtype=float)
+    columns = resolve_policy(df.columns, policy)
+
+    first = numpy.searchsorted(x, edges[0], side='right')
+    last = numpy.searchsorted(x, edges[-1], side='right')
+    bins = numpy.searchsorted(edges, x[first:last], side='left')
+
+    starts = numpy.flatnonzero(numpy.diff(bins)) + 1
+    starts = numpy.concatenate([[0], starts]) if bins.shape[0] else starts
+    ends = numpy.append(starts[1:], bins.shape[0])
+    right = edges[bins[starts]]
+    index = pandas.Index(right, name='Time')
+
+    result = {}
+    for aggregation in set(columns.values()):
+        names = [c for c, a in columns.items() if a == aggregation]
+        values = df[names].to_numpy(dtype=float)
+        if aggregation == 'time_weighted_mean':
+            left = edges[bins[starts] - 1]
+            integral = step_integral(x, values, numpy.concatenate([left, right]))
+            reduced = (integral[left.shape[0]:] - integral[:left.shape[0]]) / (right - left)[:, numpy.newaxis]
+        elif starts.shape[0]:
+            reduced = _reduce(aggregation, values[first:last], starts, ends)
+        else:
+            reduced = numpy.empty((0, len(names)))
+        for position, name in enumerate(names):
+            result[name] = reduced[:, position]
+
+    return pandas.DataFrame({name: result[name] for name in columns}, index=index)
@@ -0,0 +1,248 @@
+"""
+Concurrent sampling of several DUTs from a single host.
+
+The fleet file is a JSON dict with the output directory and one entry per DUT:
+
+    {
+        "output_dir": "C:\\\\Users\\\\mvhlab\\\\Desktop\\\\fleet",
+        "runs": 3,
+        "targets": [
+            {"name": "rpl_s_1", "Target.DefaultPeer2PeerIP": "192.168.137.5",
+             "target_dir": "C:\\\\wl_sampler_target_data", "thermapy_ip_target": "core0_t0",
+             "nidaq_calibration_file": "C:\\\\calibration\\\\RPL-S_1.xml"},
+            {"name": "adl_s_2", "Target.DefaultPeer2PeerIP": "192.168.138.5",
+             "target_dir": "C:\\\\wl_sampler_target_data", "thermapy_ip_target": "core0_t0",
+             "nidaq_calibration_file": "C:\\\\calibration\\\\ADL-S_2.xml",
+             "nidaq_output_file": "D:\\\\temp\\\\NiDaq_2.csv", "thermapy_daemon_address": "127.0.0.1:6002"}
+        ]
+    }
+
+Any other key of a target overrides the same key of the wl_sampler configuration for that DUT, and a target may set its
+own number of "runs". Every DUT is run end to end (collection and post-processing of each of its runs) in a worker
+process of its own, so the process-global Communicator configuration of one DUT never leaks into another, and its runs
+are written to '<output_dir>/<target>/run_<i>'.
+
+The NiDAQ devices and PythonSV sessions of the host are scheduled between the DUTs (see host_resources): DUTs sharing
+a device or session take turns on it for the sampled part of their runs, while their other steps (target setup, clock
+sync, EMON transfer, post-processing) overlap.
+
+Every DUT writes its timeline ('target_timeline.json' and the 'target_trace.json' Chrome trace) to its directory. The
+per-target status, failures and throughput (runs per hour, collection time and time spent waiting for the shared
+resources) are printed as a table and saved to '<output_dir>/fleet_report.json'.
+
+:example:
+
+    python multi_dut.py --fleet lab_fleet.json --cfg_path wl_sampler_config.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import wl_sampler
+from host_resources import HostResources, nidaq_output_conflicts, resource_keys
+from run_timeline import Timeline
+
+REPORT_FILE = 'fleet_report.json'
+_FLEET_KEYS = ('name', 'runs')
+
+DONE = 'done'
+COLLECT_FAILED = 'collect_failed'
+POST_FAILED = 'post_failed'
+FAILED = 'failed'
+
+
+def _overrides(entry):
+    return {key: value for key, value in entry.items() if key not in _FLEET_KEYS}
+
+
+def expand_targets(fleet, base_cfg):
+    """
+    Expand the fleet into its DUTs.
+
+    :raise ValueError: if two targets have the same name or target IP, or record different NiDAQ devices into the same
+        NiDAQ output file
+    :return: list of dicts with the target 'name', its 'cfg', 'host_dir' and number of 'runs'
+    """
+    targets = []
+    for entry in fleet['targets']:
+        targets.append({
+            'name': entry['name'],
+            'cfg': dict(base_cfg, **_overrides(entry)),
+            'host_dir': os.path.join(fleet['output_dir'], entry['name']),
+            'runs': entry.get('runs', fleet.get('runs', 1)),
+        })
+    for key in ('name', 'Target.DefaultPeer2PeerIP'):
+        values = [target['name'] if key == 'name' else target['cfg'].get(key) for target in targets]
+        duplicates = sorted({value for value in values if values.count(value) > 1})
+        if duplicates:
+            raise ValueError(f'Targets with the same {key}: {duplicates}')
+    conflicts = nidaq_output_conflicts([target['cfg'] for target in targets])
+    if conflicts:
+        raise ValueError(f'Targets with different NiDAQ devices recording into the same nidaq_output_file: {conflicts}')
+    return targets
+
+
+def _stage_seconds(timeline, name):
+    return sum(record['duration'] or 0.0 for record in timeline.stages if record['name'] == name)
+
+
+def run_target(target, locks, resolution=1):
+    """
+    Collect and post-process all the runs of one DUT. Runs in a worker process of its own.
+
+    A failed collection ends the DUT (its collectors may still be running), a failed post-processing only its run.
+
+    :param target: target dict (see expand_targets)
+    :param locks: dict of resource kind -> lock of the shared host resource the DUT uses (see host_resources)
+    :return: dict of the target 'name', 'status', 'runs' (their collected files, output file, status and error) and
+        throughput
+    """
+    cfg = target['cfg']
+    host_dir = target['host_dir']
+    os.makedirs(host_dir, exist_ok=True)
+    timeline = Timeline()
+    resources = HostResources(locks)
+    runs = []
+    start = time.monotonic()
+    try:
+        # The Communicator configuration is process-global: this worker only ever talks to its own DUT
+        wl_sampler.connect_target(cfg)
+        thermapy_daemon = wl_sampler.connect_thermapy_daemon(cfg, timeline)
+        daq = None
+        for run_index in range(target['runs']):
+            run = {'host_dir': os.path.join(host_dir, f'run_{run_index}')}
+            runs.append(run)
+            try:
+                with timeline.stage('collect', run=run_index):
+                    collected = wl_sampler.run_collection(cfg, run['host_dir'], timeline, resolution,
+                                                          thermapy_daemon=thermapy_daemon, daq=daq,
+                                                          resources=resources)
+            except Exception as e:
+                resources.release()
+                traceback.print_exc()
+                run.update(status=COLLECT_FAILED, error=f'{type(e).__name__}: {e}')
+                break
+            daq = collected.pop('daq')
+            run.update(collected)
+
+            try:
+                with timeline.stage('post-process', run=run_index):
+                    run['output_file'] = wl_sampler.post_process_run(cfg, run['host_dir'], run['emon_file'],
+                                                                     run['thermapy_raw_file'], timeline=timeline,
+                                                                     clock_sync_file=run['clock_sync_file'],
+                                                                     daq_file=run['daq_file'])
+                run.update(status=DONE, error=None)
+            except Exception as e:
+                traceback.print_exc()
+                run.update(status=POST_FAILED, error=f'{type(e).__name__}: {e}')
+            print(f"{target['name']} run_{run_index}: {run['status']}")
+    except Exception as e:
+        traceback.print_exc()
+        runs.append({'status': FAILED, 'error': f'{type(e).__name__}: {e}'})
+    finally:
+        resources.release()
+        timeline.write(os.path.join(host_dir, 'target_timeline.json'))
+        timeline.write_chrome_trace(os.path.join(host_dir, 'target_trace.json'))
+
+    wall = time.monotonic() - start
+    done = sum(run.get('status') == DONE for run in runs)
+    failed = [run for run in runs if run.get('status') != DONE]
+    return {
+        'name': target['name'],
+        'status': DONE if done == target['runs'] else (failed[-1]['status'] if failed else FAILED),
+        'runs': runs,
+        'runs_done': done,
+        'runs_failed': len(failed),
+        'errors': [run['error'] for run in failed if run.get('error')],
+        'wall_seconds': wall,
+        'collect_seconds': _stage_seconds(timeline, 'collect'),
+        'post_process_seconds': _stage_seconds(timeline, 'post-process'),
+        'resource_wait_seconds': _stage_seconds(timeline, 'host resources wait'),
+        'runs_per_hour': done * 3600 / wall if wall else 0.0,
+    }
+
+
+def format_report(report):
+    lines = [f"{'target':<20}{'status':<16}{'done':>6}{'failed':>8}{'wall':>10}{'collect':>10}{'wait':>10}"
+             f"{'runs/h':>8}"]
+    for result in report['targets']:
+        lines.append(f"{result['name']:<20}{result['status']:<16}{result['runs_done']:>6}{result['runs_failed']:>8}"
+                     f"{result['wall_seconds']:>10.1f}{result['collect_seconds']:>10.1f}"
+                     f"{result['resource_wait_seconds']:>10.1f}{result['runs_per_hour']:>8.1f}")
+        for error in result['errors']:
+            lines.append(f"    {error}")
+    return '\n'.join(lines)
+
+
+def run_fleet(fleet, base_cfg, resolution=1):
+    """
+    Sample all the DUTs of the fleet concurrently.
+
+    :param fleet: fleet dict (see the module description)
+    :param base_cfg: wl_sampler configuration the targets override
+    :return: report dict with the fleet 'wall_seconds' and the per-target results (see run_target)
+    """
+    targets = expand_targets(fleet, base_cfg)
+    output_dir = fleet['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Launch the ThermaPy daemons up front, so that DUTs sharing one do not race to start it
+    timeline = Timeline()
+    addresses = set()
+    for target in targets:
+        address = target['cfg'].get('thermapy_daemon_address')
+        if address and address not in addresses:
+            addresses.add(address)
+            wl_sampler.connect_thermapy_daemon(target['cfg'], timeline)
+
+    start = time.monotonic()
+    results = {}
+    with multiprocessing.Manager() as manager:
+        locks = {key: manager.Lock() for target in targets for key in resource_keys(target['cfg']).values()}
+        with ProcessPoolExecutor(max_workers=len(targets)) as executor:
+            futures = {}
+            for target in targets:
+                target_locks = {kind: locks[key] for kind, key in resource_keys(target['cfg']).items()}
+                futures[executor.submit(run_target, target, target_locks, resolution)] = target['name']
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    # the worker process itself failed
+                    results[name] = {'name': name, 'status': FAILED, 'runs': [], 'runs_done': 0, 'runs_failed': 0,
+                                     'errors': [f'{type(e).__name__}: {e}'], 'wall_seconds': 0.0,
+                                     'collect_seconds': 0.0, 'post_process_seconds': 0.0,
+                                     'resource_wait_seconds': 0.0, 'runs_per_hour': 0.0}
+                print(f"{name}: {results[name]['status']}")
+
+    report = {'wall_seconds': time.monotonic() - start,
+              'targets': [results[target['name']] for target in targets]}
+    with open(os.path.join(output_dir, REPORT_FILE), 'w') as out_file:
+        json.dump(report, out_file, indent=4)
+    return report
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Sample several DUTs concurrently from this host')
+    parser.add_argument('--fleet', type=str, required=True, help='Fleet JSON file')
+    parser.add_argument('--cfg_path', type=str, required=False, default=wl_sampler.DEFAULT_CFG_PATH,
+                        help='wl_sampler configuration the targets override')
+    parser.add_argument('--resolution', type=int, required=False, default=1, help='.')
+    args = parser.parse_args(argv)
+
+    with open(args.fleet) as f:
+        fleet = json.load(f)
+    report = run_fleet(fleet, wl_sampler.load_config(args.cfg_path), resolution=args.resolution)
+    print(format_report(report))
+    print(f"Fleet wall time: {report['wall_seconds']:.1f} sec")
+    return 0 if all(result['status'] == DONE for result in report['targets']) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,695 @@
+"""
+Local replay of a recorded run, standing in for the lab setup of wl_sampler (the 'replay' backend of sampler_backends).
+
+The whole sampler -> transfer -> parse -> combine pipeline of wl_sampler runs unchanged against local stand-ins, so its
+orchestration (fixed sleeps, polling, transfers, parsing and combining) can be timed and optimized without a lab board:
+
+* ReplayCommunicator emulates the target: its Windows paths are mapped into a local directory, and the commands
+  wl_sampler issues (mkdir/rmdir, the target clock query, tasklist, the exit watcher, the ranged copies and hash of the
+  EMON transfer, DAQAlign and the workload) are carried out locally. Every call takes the configured round trip
+  "latency", and file copies are limited by the optional "bandwidth". The EMON command streams the recorded EMON trace
+  into its output file at the recorded sample times until it is killed
+* the NiDAQ stand-in writes the part of the recorded NiDAQ trace it recorded for when its recording stops
+* the ThermaPy stand-in is ready after the configured PythonSV start-up time and writes the recorded raw capture when
+  it is stopped. Decoding copies the part of the recorded parsed ThermaPy CSV it collected for into the ThermaPy cache
+
+A recording is a run directory: the examples/ and RPL_examples/ runs, a wl_sampler host directory or a trace_synth
+run. It needs the EMON trace (emon_raw_data.txt) and may hold the raw ThermaPy capture (thermapy_raw_data.zip or
+.csv), the parsed ThermaPy CSV (parsed_thermapy_raw_data.csv), the NiDAQ trace (NiDaq.csv or daq.csv) and the clock
+sync of the run (clock_sync.json, or the 'shifts' of a trace_synth synth.json). Decoding a raw capture needs the
+ThermaPy lab code, so a recording without a parsed ThermaPy CSV (as the examples) is served a ThermaPy trace derived
+from the frequency of its EMON alignment CPU. A missing raw capture is replaced by its header, and a missing NiDAQ trace
+by an empty one. The target clock runs at the recorded offset from the host clock, so the clock sync of the replay
+places the recorded EMON trace where it belongs on the ThermaPy time axis.
+
+With a "speed" above 1 the workload, the DAQAlign pattern, the EMON stream and the PythonSV start-up are replayed that
+many times faster; the latency, the bandwidth and the fixed sleeps of wl_sampler are not scaled. Every replayed trace
+ends when its collector is stopped (each covers the recorded time from its own start to its stop), so the combine sees
+the start and stop order of the replayed run.
+
+The replay prints the timeline of the run and a per-stage table of its overhead: the stage time minus the replayed
+(recorded) time spent in it, and saves them as 'replay_report.json', 'timeline.json' and 'timeline_trace.json' in the
+host directory.
+
+:example:
+
+    python replay_backend.py --recording examples/Prime95 --output-dir /tmp/replay --latency 0.005 --speed 10
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import ntpath
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import types
+import zipfile
+
+import numpy
+import pandas
+
+import emon_parser
+from clock_sync import TARGET_TIME_COMMAND, format_target_time
+from emon_metrics import compute_metrics, select_cpu, select_metrics
+from sampler_backends import REPLAY
+from thermapy_parser import ARCHIVE_SUFFIX, START_EPOCH, START_TOKEN, build_cache, open_capture, read_header
+from trace_synth import ALIGN_PULSE_DURATION, ALIGN_PULSE_GAP, ALIGN_PULSES
+
+DEFAULT_LATENCY = 0.005
+DEFAULT_SPEED = 1.0
+# Duration of the DAQAlign pattern [sec]
+DEFAULT_ALIGN_DURATION = ALIGN_PULSES * (ALIGN_PULSE_DURATION + ALIGN_PULSE_GAP)
+# Sample period of a ThermaPy trace derived from EMON [sec]
+DEFAULT_DERIVED_PERIOD = 0.001
+DEFAULT_RESOLUTION = 1000
+DEFAULT_CFG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wl_sampler_config.json')
+
+EMON_FILE = 'emon_raw_data.txt'
+RAW_CAPTURE_FILES = ('thermapy_raw_data.zip', 'thermapy_raw_data.csv')
+PARSED_FILE = 'parsed_thermapy_raw_data.csv'
+DAQ_FILES = ('NiDaq.csv', 'daq.csv')
+CLOCK_SYNC_FILE = 'clock_sync.json'
+SYNTH_FILE = 'synth.json'
+REPORT_FILE = 'replay_report.json'
+
+_FIRST_PID = 4000
+_EMON_OUTPUT = re.compile(r'\s-f\s+(\S+)')
+_WATCHER = re.compile(r"Wait-Process -Id (\d+).*-Path '([^']*)'")
+_TASKLIST = re.compile(r'PID eq (\d+)')
+_COPY_RANGE = re.compile(r"Open\('([^']*)'.*Seek\((\d+),.*byte\[\] (\d+);.*Create\('([^']*)'\)")
+_FILE_HASH = re.compile(r"Get-FileHash .*-Path '([^']*)'")
+
+
+def _find(recording_dir, names):
+    for name in names:
+        path = os.path.join(recording_dir, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _line_epoch(line):
+    """
+    Sample epoch [ms] of an EMON -V data line, None for the other lines
+    """
+    field, separator, _ = line.partition(b';')
+    return int(field) if separator and field.isdigit() else None
+
+
+class Recording:
+    """
+    Files and clocks of a recorded run directory (see the module description).
+
+    :ivar emon_start: target epoch of the first EMON sample [sec]
+    :ivar duration: duration of the EMON trace [sec]
+    :ivar start_epoch: host epoch of the ThermaPy capture start [sec]
+    :ivar clock_offset: target clock - host clock [sec]
+    """
+
+    def __init__(self, recording_dir, emon_filename=EMON_FILE):
+        self.recording_dir = recording_dir
+        self.emon_file = os.path.join(recording_dir, emon_filename)
+        if not os.path.isfile(self.emon_file):
+            raise ValueError(f'No EMON trace {emon_filename} in the recording {recording_dir}')
+        self.raw_file = _find(recording_dir, RAW_CAPTURE_FILES)
+        self.parsed_file = _find(recording_dir, [PARSED_FILE])
+        self.daq_file = _find(recording_dir, DAQ_FILES)
+
+        with open(self.emon_file, 'rb') as in_file:
+            epochs = [epoch for epoch in map(_line_epoch, in_file) if epoch is not None]
+        if not epochs:
+            raise ValueError(f'No samples in {self.emon_file}')
+        self.emon_start = epochs[0] / 1000
+        self.duration = max(epochs) / 1000 - self.emon_start
+        self.start_epoch = read_header(self.raw_file).get(START_EPOCH, epochs[0]) / 1000 if self.raw_file else \
+            self.emon_start
+        self.clock_offset = self._clock_offset()
+
+    def _clock_offset(self):
+        clock_sync_file = _find(self.recording_dir, [CLOCK_SYNC_FILE])
+        if clock_sync_file:
+            with open(clock_sync_file, 'r') as in_file:
+                return json.load(in_file)['clocks']['emon']['offset']
+        synth_file = _find(self.recording_dir, [SYNTH_FILE])
+        if synth_file:
+            # EMON time - ThermaPy time of the same instant, the ThermaPy time counting from the capture start
+            with open(synth_file, 'r') as in_file:
+                return json.load(in_file)['shifts']['emon'] - self.start_epoch
+        # EMON and ThermaPy started together (exact for a ThermaPy trace derived from EMON)
+        return self.emon_start - self.start_epoch
+
+
+def _copy_head(source, destination, column, duration, unit=1.0):
+    """
+    Copy the rows of a CSV trace up to "duration" after its first row.
+
+    :param column: time column
+    :param duration: time to copy [sec]
+    :param unit: seconds per unit of the time column
+    """
+    with open(source, 'r', newline='') as in_file, open(destination, 'w', newline='') as out_file:
+        header = in_file.readline()
+        out_file.write(header)
+        index = header.rstrip('\r\n').split(',').index(column)
+        first = None
+        for line in in_file:
+            sample = float(line.split(',')[index]) * unit
+            first = sample if first is None else first
+            if sample - first > duration:
+                break
+            out_file.write(line)
+    return destination
+
+
+def derive_thermalpy(emon_file, period=DEFAULT_DERIVED_PERIOD):
+    """
+    A parsed ThermaPy trace following the frequency of the EMON alignment CPU, for recordings without one.
+
+    :param period: sample period [sec]
+    :return: pandas.DataFrame with the ThermapyDataParser 'Frame', 'Time' (in ms from the first EMON sample), 'ratio'
+        and 'Frequency[MHz]' columns
+    """
+    emon_trace = emon_parser.parse(emon_file)
+    cpu = select_cpu(emon_trace.data.columns)
+    frequency = compute_metrics(emon_trace.data, emon_trace.tsc_freq, select_metrics(['Frequency']),
+                                cpus=[cpu])[cpu + ('Frequency',)]
+    times = frequency.index.to_numpy() - frequency.index[0]
+    samples = numpy.arange(0.0, times[-1], period)
+    # an EMON sample counts the interval that ends at its time stamp
+    values = frequency.to_numpy()[numpy.searchsorted(times, samples, side='left')]
+    return pandas.DataFrame({'Frame': numpy.arange(samples.shape[0]) // 1000, 'Time': samples * 1000,
+                             'ratio': values / 100, 'Frequency[MHz]': values})
+
+
+def write_capture(path, raw_file, ip, start_epoch):
+    """
+    Write a raw ThermaPy capture starting at "start_epoch": the recorded capture with its start moved, or only the
+    header block when there is no recorded capture. A path ending with '.zip' writes a zip archive holding the capture.
+
+    :param raw_file: recorded raw capture (CSV or zip archive), None to write the header only
+    :param start_epoch: host epoch of the capture start [sec]
+    :return: path
+    """
+    start_line = f'{START_EPOCH},{start_epoch * 1000}\r\n'
+
+    def write(out_file):
+        if raw_file is None:
+            lines = [f'ip,{ip}', 'time_freq,38400000.0', 'setup,"{\'Product name\': \'replay\'}"', START_TOKEN]
+            out_file.write('\r\n'.join(lines) + '\r\n' + start_line)
+            return
+        with open_capture(raw_file) as in_file:
+            for line in in_file:
+                if line.startswith(START_EPOCH + ','):
+                    out_file.write(start_line)
+                    break
+                out_file.write(line)
+            shutil.copyfileobj(in_file, out_file)
+
+    if path.lower().endswith(ARCHIVE_SUFFIX):
+        with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            with archive.open(RAW_CAPTURE_FILES[1], 'w') as member:
+                with io.TextIOWrapper(member, newline='') as out_file:
+                    write(out_file)
+    else:
+        with open(path, 'w', newline='') as out_file:
+            write(out_file)
+    return path
+
+
+class _Process:
+    """
+    A process on the replayed target: a thread running until it ends or is killed.
+    """
+
+    def __init__(self, pid, target=None):
+        self.pid = pid
+        self.killed = threading.Event()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(target,), daemon=True)
+        self.thread.start()
+
+    def _run(self, target):
+        try:
+            if target is not None:
+                target(self.killed)
+        finally:
+            self.done.set()
+
+    def kill(self):
+        self.killed.set()
+        self.thread.join()
+
+
+class ReplayCommunicator:
+    """
+    Stand-in of the evtar Communicator running the target side of a replay on the host.
+
+    :ivar config: stand-in of CommunicatorConfig
+    :ivar calls: number of calls made (round trips)
+    """
+
+    def __init__(self, target_root, recording, latency=DEFAULT_LATENCY, speed=DEFAULT_SPEED, bandwidth=None,
+                 emon_cmd='emon', align_cmd=None, align_duration=DEFAULT_ALIGN_DURATION, wl_cmd=None,
+                 wl_seconds=None, time_shift=0):
+        """
+        :param target_root: local directory holding the target file system (one sub-directory per drive)
+        :param recording: Recording replayed
+        :param latency: round trip of every call [sec]
+        :param speed: time acceleration of the replayed processes
+        :param bandwidth: file copy rate [bytes/sec] (None for no limit)
+        :param emon_cmd: EMON executable of the EMON command
+        :param align_cmd: DAQAlign command, running for "align_duration" [recorded sec]
+        :param wl_cmd: workload command, running for "wl_seconds" [recorded sec]
+        :param time_shift: time added to the recorded EMON time stamps [sec]
+        """
+        self.target_root = target_root
+        self.recording = recording
+        self.latency = latency
+        self.speed = speed
+        self.bandwidth = bandwidth
+        self.emon_cmd = emon_cmd
+        self.align_cmd = align_cmd
+        self.align_duration = align_duration
+        self.wl_cmd = wl_cmd
+        self.wl_seconds = wl_seconds
+        self.time_shift = time_shift
+        self.config = types.SimpleNamespace(Target=types.SimpleNamespace(IsConnectedTimeoutSec=None,
+                                                                         DefaultPeer2PeerIP=None))
+        self.calls = 0
+        self.processes = {}
+        self._lock = threading.Lock()
+        self._next_pid = _FIRST_PID
+
+    def local_path(self, path):
+        """
+        Host path of a target path: 'C:\\data\\x.txt' is '<target_root>/C/data/x.txt'
+        """
+        parts = [part.rstrip(':') for part in re.split(r'[\\/]+', path) if part]
+        return os.path.join(self.target_root, *parts)
+
+    def _round_trip(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+    def _copy_delay(self, size):
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    def _replay_seconds(self, recorded):
+        return recorded / self.speed
+
+    def IsConnected(self):
+        self._round_trip()
+        return True
+
+    def IsFile(self, path):
+        self._round_trip()
+        return os.path.isfile(self.local_path(path))
+
+    def GetFileSize(self, sFilePath):
+        self._round_trip()
+        return os.path.getsize(self.local_path(sFilePath))
+
+    def GetFileFromTarget(self, sourceFileLocation, whereToStore):
+        self._round_trip()
+        source = self.local_path(sourceFileLocation)
+        self._copy_delay(os.path.getsize(source))
+        shutil.copyfile(source, whereToStore)
+
+    def KillCommandOnTarget(self, pid):
+        self._round_trip()
+        process = self.processes.get(int(pid))
+        if process is not None:
+            process.kill()
+
+    def ExecuteCommandOnTarget(self, command, sCommandCwd=None, logOutput=True):
+        if command == TARGET_TIME_COMMAND:
+            # read the clock at the middle of the round trip
+            with self._lock:
+                self.calls += 1
+            time.sleep(self.latency / 2)
+            output = format_target_time(time.time() + self.recording.clock_offset)
+            time.sleep(self.latency / 2)
+            return output
+
+        self._round_trip()
+        if command.startswith('mkdir '):
+            os.makedirs(self.local_path(command[len('mkdir '):].strip()), exist_ok=True)
+        elif command.startswith('rmdir '):
+            shutil.rmtree(self.local_path(command.split()[-1]), ignore_errors=True)
+        elif command.startswith('tasklist '):
+            pid = int(_TASKLIST.search(command).group(1))
+            process = self.processes.get(pid)
+            if process is not None and not process.done.is_set():
+                return f'replay.exe {pid} Console 1 1,024 K\r\n'
+            return 'INFO: No tasks are running which match the specified criteria.\r\n'
+        elif _FILE_HASH.search(command):
+            with open(self.local_path(_FILE_HASH.search(command).group(1)), 'rb') as in_file:
+                return hashlib.sha256(in_file.read()).hexdigest().upper() + '\r\n'
+        elif _COPY_RANGE.search(command):
+            self._copy_range(command)
+        elif command == self.align_cmd:
+            time.sleep(self._replay_seconds(self.align_duration))
+        return ''
+
+    def _copy_range(self, command):
+        source, offset, length, chunk = _COPY_RANGE.search(command).groups()
+        with open(self.local_path(source), 'rb') as in_file:
+            in_file.seek(int(offset))
+            data = in_file.read(int(length))
+        with open(self.local_path(chunk), 'wb') as out_file:
+            out_file.write(gzip.compress(data) if 'GZipStream' in command else data)
+
+    def ExecuteCommandOnTargetAsync(self, command, bOrphan=False, sCommandCwd=None):
+        self._round_trip()
+        target = None
+        if self.emon_cmd in command and _EMON_OUTPUT.search(command):
+            output_path = self.local_path(_EMON_OUTPUT.search(command).group(1))
+            target = lambda killed: self._stream_emon(output_path, killed)
+        elif _WATCHER.search(command):
+            watched_pid, marker_path = _WATCHER.search(command).groups()
+            target = lambda killed: self._watch(int(watched_pid), self.local_path(marker_path), killed)
+        elif command == self.wl_cmd:
+            target = lambda killed: killed.wait(self._replay_seconds(self.wl_seconds))
+
+        with self._lock:
+            pid = self._next_pid
+            self._next_pid += 4
+        self.processes[pid] = _Process(pid, target)
+        return pid
+
+    def _watch(self, pid, marker_path, killed):
+        process = self.processes.get(pid)
+        while process is not None and not process.done.wait(0.05):
+            if killed.is_set():
+                return
+        open(marker_path, 'w').close()
+
+    def _stream_emon(self, output_path, killed):
+        # Every sample is written at its recorded time from the stream start, until EMON is killed
+        start = time.monotonic()
+        first = None
+        with open(self.recording.emon_file, 'rb') as in_file, open(output_path, 'wb') as out_file:
+            for line in in_file:
+                epoch = _line_epoch(line)
+                if epoch is None:
+                    out_file.write(line)
+                    continue
+                first = epoch if first is None else first
+                delay = start + self._replay_seconds((epoch - first) / 1000) - time.monotonic()
+                if delay > 0:
+                    out_file.flush()
+                    if killed.wait(delay):
+                        break
+                out_file.write(b'%d;' % (epoch + self.time_shift * 1000) + line.split(b';', 1)[1])
+
+
+class ReplayDaq:
+    """
+    NiDAQ stand-in writing the recorded NiDAQ trace (or an empty one) when its recording stops, up to the recorded time
+    it recorded for.
+    """
+
+    def __init__(self, recording, output_file, latency=DEFAULT_LATENCY, speed=DEFAULT_SPEED):
+        self.recording = recording
+        self.output_file = output_file
+        self.latency = latency
+        self.speed = speed
+        self._started = None
+
+    def record(self):
+        time.sleep(self.latency)
+        self._started = time.monotonic()
+
+    def stop_record(self):
+        recorded = (time.monotonic() - self._started) * self.speed if self._started is not None else 0.0
+        time.sleep(self.latency)
+        os.makedirs(os.path.dirname(os.path.abspath(self.output_file)), exist_ok=True)
+        if self.recording.daq_file:
+            _copy_head(self.recording.daq_file, self.output_file, 'TimeStamp', recorded)
+        else:
+            with open(self.output_file, 'w') as out_file:
+                out_file.write('TimeStamp\n')
+
+
+class ReplayCollector(threading.Thread):
+    """
+    ThermaPy collection stand-in: ready after the PythonSV start-up time, writes the recorded raw capture (or its
+    header) when it is killed. Has the interface of the collection process of the lab backend.
+
+    :ivar collected: recorded time collected from the ready event to the kill [sec]
+    """
+
+    def __init__(self, recording, ip, raw_data_path, startup=0.0, time_shift=0, speed=DEFAULT_SPEED):
+        """
+        :param startup: PythonSV start-up time [sec]
+        :param time_shift: time added to the recorded time stamps [sec]
+        :param speed: time acceleration of the collection
+        """
+        super().__init__(daemon=True)
+        self.recording = recording
+        self.time_shift = time_shift
+        self.ip = ip
+        self.raw_data_path = raw_data_path
+        self.startup = startup
+        self.speed = speed
+        self.collected = 0.0
+        self.ready = threading.Event()
+        self.killed = threading.Event()
+        self.exitcode = None
+        self.pid = os.getpid()
+
+    def run(self):
+        if not self.killed.wait(self.startup):
+            self.ready.set()
+            started = time.monotonic()
+            self.killed.wait()
+            self.collected = (time.monotonic() - started) * self.speed
+        write_capture(self.raw_data_path, self.recording.raw_file, self.ip,
+                      self.recording.start_epoch + self.time_shift)
+        self.exitcode = 0
+
+    def kill(self):
+        self.killed.set()
+
+
+class ReplayBackend:
+    """
+    Backend replaying a recorded run locally (see sampler_backends for the interface).
+    """
+    name = REPLAY
+
+    def __init__(self, recording_dir, target_root, nidaq_output_file, latency=DEFAULT_LATENCY, speed=DEFAULT_SPEED,
+                 bandwidth=None, emon_cmd='emon', align_cmd=None, align_duration=DEFAULT_ALIGN_DURATION, wl_cmd=None,
+                 wl_seconds=None, thermapy_startup=0.0, emon_filename=EMON_FILE):
+        """
+        :param recording_dir: recorded run directory
+        :param target_root: local directory holding the target file system
+        :param nidaq_output_file: path the NiDAQ stand-in writes its trace to
+        :param latency: round trip of every communicator call and NiDAQ command [sec]
+        :param speed: time acceleration of the replayed processes
+        :param bandwidth: target file copy rate [bytes/sec] (None for no limit)
+        :param align_duration: duration of the DAQAlign pattern [recorded sec]
+        :param wl_seconds: duration of the workload [recorded sec] (default: the recording minus the two align
+            patterns)
+        :param thermapy_startup: PythonSV start-up time [recorded sec]
+        """
+        self.recording = Recording(recording_dir, emon_filename)
+        self.nidaq_output_file = nidaq_output_file
+        self.latency = latency
+        self.speed = speed
+        self.align_duration = align_duration
+        self.wl_seconds = max(self.recording.duration - 2 * align_duration, 0.0) if wl_seconds is None else \
+            wl_seconds
+        self.thermapy_startup = thermapy_startup
+        self._collector = None
+        # The recording is replayed on the current clock (in whole seconds, keeping the EMON time stamps integral),
+        # as a clock model only holds near the time it was measured at
+        self.time_shift = round(time.time() - self.recording.start_epoch)
+        self._communicator = ReplayCommunicator(target_root, self.recording, latency=latency, speed=speed,
+                                                bandwidth=bandwidth, emon_cmd=emon_cmd, align_cmd=align_cmd,
+                                                align_duration=align_duration, wl_cmd=wl_cmd,
+                                                wl_seconds=self.wl_seconds, time_shift=self.time_shift)
+
+    @classmethod
+    def from_config(cls, cfg):
+        """
+        :param cfg: wl_sampler configuration with the 'replay_recording' directory and optionally 'replay_latency',
+            'replay_speed', 'replay_bandwidth', 'replay_target_root', 'replay_wl_seconds' and
+            'replay_thermapy_startup'
+        """
+        if not cfg.get('replay_recording'):
+            raise ValueError('The replay backend needs a replay_recording directory')
+        return cls(cfg['replay_recording'],
+                   target_root=cfg.get('replay_target_root') or os.path.join(cfg['host_dir'], 'replay_target'),
+                   nidaq_output_file=cfg['nidaq_output_file'],
+                   latency=cfg.get('replay_latency', DEFAULT_LATENCY), speed=cfg.get('replay_speed') or DEFAULT_SPEED,
+                   bandwidth=cfg.get('replay_bandwidth'), emon_cmd=cfg['emon_cmd_params']['emon_cmd'].split()[0],
+                   align_cmd=cfg.get('alignment_exe_cmd'), wl_cmd=cfg.get('wl_cmd'),
+                   wl_seconds=cfg.get('replay_wl_seconds'), thermapy_startup=cfg.get('replay_thermapy_startup', 0.0),
+                   emon_filename=cfg.get('emon_output_filename') or EMON_FILE)
+
+    def communicator(self):
+        return self._communicator, self._communicator.config
+
+    def create_daq(self, nidaq_script_dir, nidaq_calibration_file):
+        return ReplayDaq(self.recording, self.nidaq_output_file, latency=self.latency, speed=self.speed)
+
+    def start_thermapy(self, ip, raw_data_path, duration, lab_path, resolution):
+        collector = ReplayCollector(self.recording, ip, raw_data_path, startup=self.thermapy_startup / self.speed,
+                                    time_shift=self.time_shift, speed=self.speed)
+        collector.start()
+        self._collector = collector
+        return collector, collector.ready
+
+    def connect_thermapy_daemon(self, lab_path, address):
+        # The stand-in collector starts in the sampler process, there is no warm session to connect to
+        return None
+
+    def parse_thermapy(self, lab_path, raw_data_path, parsed_output_file):
+        # Only the part of the recording the last collection ran for ('Time' is in ms)
+        collected = self._collector.collected if self._collector is not None else 0.0
+        if self.recording.parsed_file:
+            _copy_head(self.recording.parsed_file, parsed_output_file, 'Time', collected, unit=1 / 1000)
+        else:
+            trace = derive_thermalpy(self.recording.emon_file)
+            trace[trace['Time'] <= collected * 1000].to_csv(parsed_output_file, index=False)
+        return build_cache(parsed_output_file, header=read_header(raw_data_path))
+
+    def replayed_seconds(self):
+        """
+        :return: dict of stage name -> time the stage spends replaying the recording (not overhead) [sec]
+        """
+        align = self.align_duration / self.speed
+        return {'daq align (start)': align, 'daq align (end)': align, 'wl wait': self.wl_seconds / self.speed}
+
+
+def replay_config(cfg, recording_dir, output_dir, latency=DEFAULT_LATENCY, speed=DEFAULT_SPEED, bandwidth=None):
+    """
+    The wl_sampler configuration replaying a recording into a local output directory. The sampling policies of the
+    configuration (intervals, timeouts, sample counts, sleeps) are kept, so their cost shows in the replay.
+
+    :return: configuration dict
+    """
+    recording = Recording(recording_dir, cfg.get('emon_output_filename') or EMON_FILE)
+    wl_seconds = max(recording.duration - 2 * DEFAULT_ALIGN_DURATION, 0.0)
+    return dict(
+        cfg, backend=REPLAY, replay_recording=recording_dir, replay_latency=latency, replay_speed=speed,
+        replay_bandwidth=bandwidth, replay_target_root=os.path.join(output_dir, 'target'),
+        host_dir=os.path.join(output_dir, 'host'),
+        nidaq_output_file=os.path.join(output_dir, 'nidaq', ntpath.basename(cfg['nidaq_output_file'])),
+        # the workload is stopped by the completion wait, the timeout only guards against a stuck probe
+        wl_duration=wl_seconds / speed * 2 + 60,
+        # the speed tool is Windows only, and the health report needs the lab reports package
+        combine_in_process=True,
+        combine_report='none',
+        daq_pyramid_resolutions=cfg.get('daq_pyramid_resolutions') if recording.daq_file else None,
+    )
+
+
+def overhead_report(timeline, replayed):
+    """
+    :param timeline: Timeline of the replayed run
+    :param replayed: dict of stage name -> replayed time per occurrence (see ReplayBackend.replayed_seconds)
+    :return: dict with the end to end 'wall_seconds', the total 'replayed_seconds' and 'overhead_seconds', and the
+        per-stage 'stages' (name, count, total, replayed and overhead seconds) in order of first start
+    """
+    stages = {}
+    for record in sorted(timeline.stages, key=lambda item: item['start']):
+        if record['duration'] is None or (record['duration'] == 0 and record.get('cpu') is None):
+            continue
+        row = stages.setdefault(record['name'], {'name': record['name'], 'count': 0, 'seconds': 0.0,
+                                                 'replayed_seconds': 0.0})
+        row['count'] += 1
+        row['seconds'] += record['duration']
+        row['replayed_seconds'] += replayed.get(record['name'], 0.0)
+    for row in stages.values():
+        row['overhead_seconds'] = row['seconds'] - row['replayed_seconds']
+
+    wall = max((record['end'] for record in timeline.stages if record['end'] is not None), default=0.0)
+    replayed_total = sum(row['replayed_seconds'] for row in stages.values())
+    return {'wall_seconds': wall, 'replayed_seconds': replayed_total, 'overhead_seconds': wall - replayed_total,
+            'stages': list(stages.values())}
+
+
+def format_report(report):
+    lines = [f"{'stage':<32}{'count':>6}{'total':>10}{'replayed':>10}{'overhead':>10}"]
+    for row in report['stages']:
+        lines.append(f"{row['name']:<32}{row['count']:>6}{row['seconds']:>10.2f}{row['replayed_seconds']:>10.2f}"
+                     f"{row['overhead_seconds']:>10.2f}")
+    wall = report['wall_seconds']
+    lines.append(f"End to end {wall:.2f} sec: {report['replayed_seconds']:.2f} sec replayed, "
+                 f"{report['overhead_seconds']:.2f} sec overhead "
+                 f"({100 * report['overhead_seconds'] / wall if wall else 0.0:.0f}%)")
+    return '\n'.join(lines)
+
+
+def run_replay(cfg, resolution=DEFAULT_RESOLUTION, profile=None):
+    """
+    Collect and post-process one run of the replay configuration (see replay_config) with wl_sampler.
+
+    :return: dict with the combined 'output_file', the overhead 'report' (see overhead_report) and the 'timeline'
+    """
+    import wl_sampler
+    from run_timeline import Timeline
+
+    host_dir = cfg['host_dir']
+    os.makedirs(host_dir, exist_ok=True)
+    timeline = Timeline(profile=profile, profile_dir=host_dir)
+    backend = wl_sampler.use_backend(ReplayBackend.from_config(cfg))
+    wl_sampler.connect_target(cfg)
+    thermapy_daemon = wl_sampler.connect_thermapy_daemon(cfg, timeline)
+    collected = wl_sampler.run_collection(cfg, host_dir, timeline, resolution, thermapy_daemon=thermapy_daemon)
+    output_file = wl_sampler.post_process_run(cfg, host_dir, collected['emon_file'], collected['thermapy_raw_file'],
+                                              timeline=timeline, clock_sync_file=collected['clock_sync_file'],
+                                              # the NiDAQ stand-in of a recording without DAQ writes an empty trace
+                                              daq_file=collected['daq_file'] if backend.recording.daq_file else None)
+
+    report = overhead_report(timeline, backend.replayed_seconds())
+    report.update(recording=cfg['replay_recording'], latency=cfg['replay_latency'], speed=cfg['replay_speed'],
+                  round_trips=backend.communicator()[0].calls)
+    timeline.write(os.path.join(host_dir, 'timeline.json'))
+    timeline.write_chrome_trace(os.path.join(host_dir, 'timeline_trace.json'))
+    with open(os.path.join(host_dir, REPORT_FILE), 'w') as out_file:
+        json.dump(report, out_file, indent=4)
+    return {'output_file': output_file, 'report': report, 'timeline': timeline}
+
+
+def _parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded run through wl_sampler locally and report the orchestration overhead",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--recording", required=True, help="Recorded run directory (e.g. examples/Prime95)")
+    parser.add_argument("--output-dir", "-o", required=True,
+                        help="Directory of the replayed target, DAQ and host files")
+    parser.add_argument("--cfg_path", default=DEFAULT_CFG_PATH, help="wl_sampler configuration replayed")
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY, help="Communicator round trip [sec]")
+    parser.add_argument("--speed", type=float, default=DEFAULT_SPEED, help="Time acceleration of the replay")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Target file copy rate [bytes/sec]")
+    parser.add_argument("--resolution", type=int, default=DEFAULT_RESOLUTION,
+                        help="ThermaPy time stamp resolution (1000 for ms)")
+    parser.add_argument("--profile", default=None, help="Profile every occurrence of this timeline stage")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = _parse_command_line(argv=argv)
+    with open(args.cfg_path) as f:
+        cfg = replay_config(json.load(f), args.recording, args.output_dir, latency=args.latency, speed=args.speed,
+                            bandwidth=args.bandwidth)
+    result = run_replay(cfg, resolution=args.resolution, profile=args.profile)
+    print(result['timeline'].format())
+    print(format_report(result['report']))
+    print(f"Combined trace: {result['output_file']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,231 @@
+"""
+Per-stage timeline of a sampling run.
+
+Stages are recorded with their start and end times relative to the timeline start, so overlapping (concurrent) stages
+show up as such. Every stage also records the process CPU time spent while it ran (which includes the concurrent
+stages) and the peak resident set size of the process when it ended. The timeline can be printed as a table, saved as
+JSON next to the run outputs and exported as a Chrome trace (open it in Perfetto or chrome://tracing) to compare runs.
+
+One stage can be profiled with cProfile: every occurrence of the chosen stage name is dumped to a '<stage>.prof' file
+(read it with pstats or snakeviz). cProfile only sees the thread it is enabled in, so a stage running its work in a
+worker thread (e.g. with asyncio.to_thread) is declared 'threaded' and profiles the function it hands to the thread.
+
+:example:
+
+    >>> timeline = Timeline(profile='find_pattern', profile_dir=r'C:\\data')
+    >>> with timeline.stage('emon start'):
+    ...     start_emon()
+    >>> with timeline.stage('emon fetch', threaded=True) as record:
+    ...     await asyncio.to_thread(timeline.in_thread(record, fetch_emon), path)
+    >>> print(timeline.format())
+    >>> timeline.write('timeline.json')
+    >>> timeline.write_chrome_trace('timeline_trace.json')
+"""
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import re
+import sys
+import time
+
+
+def peak_rss():
+    """
+    Peak resident set size of the process [bytes], or None where it can not be read
+    """
+    try:
+        import resource
+    except ImportError:
+        return _windows_peak_rss()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _windows_peak_rss():
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize
+    except (AttributeError, OSError):
+        return None
+
+
+def stage(timeline, name, **args):
+    """
+    Timeline.stage of the timeline, or a context that records nothing when there is no timeline
+    """
+    return contextlib.nullcontext() if timeline is None else timeline.stage(name, **args)
+
+
+class Timeline:
+    """
+    Recorder of named run stages.
+
+    :ivar stages: list of dicts with the stage name, start, end and duration [sec], the process CPU time [sec] and
+        peak RSS [bytes] of the stage, its status, optional arguments and the profile file of a profiled stage
+    """
+
+    def __init__(self, time_func=time.monotonic, profile=None, profile_dir=None, cpu_func=time.process_time):
+        """
+        :param profile: name of the stage to profile with cProfile
+        :param profile_dir: directory of the profile files (default: the working directory)
+        """
+        self.time_func = time_func
+        self.cpu_func = cpu_func
+        self.origin = time_func()
+        self.stages = []
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self._profiled = 0
+
+    def _now(self):
+        return self.time_func() - self.origin
+
+    def _profile_path(self, name):
+        self._profiled += 1
+        file_name = re.sub(r'\W+', '_', name).strip('_') or 'stage'
+        if self._profiled > 1:
+            file_name += f'_{self._profiled}'
+        return os.path.join(self.profile_dir or '', f'{file_name}.prof')
+
+    @contextlib.contextmanager
+    def _profiling(self, record):
+        """
+        Profile the enclosed block in the calling thread if the stage of the record is the profiled one
+        """
+        name = record['name']
+        profiler = None
+        if name == self.profile:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # another profiler (e.g. of an enclosing stage of the same name) is active
+                print(f'Stage {name} is not profiled: {e}')
+                profiler = None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                record['profile'] = self._profile_path(name)
+                profiler.dump_stats(record['profile'])
+                print(f'Profile of {name}: {record["profile"]}')
+
+    @contextlib.contextmanager
+    def stage(self, name, threaded=False, **args):
+        """
+        Record the duration of the enclosed block (also usable around awaits in a coroutine). A stage that raises is
+        recorded with a 'failed' status.
+
+        :param threaded: the block runs its work in a worker thread: the function handed to the thread is profiled
+            (see in_thread) instead of the calling thread
+        :param args: extra values stored with the stage (e.g. the trace a step runs on)
+        """
+        record = {'name': name, 'start': self._now(), 'end': None, 'duration': None, 'cpu': None, 'peak_rss': None,
+                  'status': 'ok'}
+        if args:
+            record['args'] = args
+        self.stages.append(record)
+        cpu_start = self.cpu_func()
+        try:
+            with contextlib.nullcontext() if threaded else self._profiling(record):
+                yield record
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            record['cpu'] = self.cpu_func() - cpu_start
+            record['end'] = self._now()
+            record['duration'] = record['end'] - record['start']
+            record['peak_rss'] = peak_rss()
+
+    def in_thread(self, record, func):
+        """
+        :param record: record of a threaded stage (as yielded by stage)
+        :return: "func", profiled as the stage in the thread that calls it
+        """
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            with self._profiling(record):
+                return func(*args, **kwargs)
+        return run
+
+    def mark(self, name):
+        """
+        Record an instantaneous event
+        """
+        now = self._now()
+        self.stages.append({'name': name, 'start': now, 'end': now, 'duration': 0.0, 'status': 'ok'})
+
+    def format(self):
+        lines = [f"{'stage':<32}{'start':>10}{'end':>10}{'duration':>10}{'cpu':>10}{'peak MB':>10}  status"]
+        for record in sorted(self.stages, key=lambda item: item['start']):
+            end = '' if record['end'] is None else f"{record['end']:.2f}"
+            duration = '' if record['duration'] is None else f"{record['duration']:.2f}"
+            cpu = '' if record.get('cpu') is None else f"{record['cpu']:.2f}"
+            rss = '' if record.get('peak_rss') is None else f"{record['peak_rss'] / 1024 ** 2:.0f}"
+            lines.append(f"{record['name']:<32}{record['start']:>10.2f}{end:>10}{duration:>10}{cpu:>10}{rss:>10}  "
+                         f"{record['status']}")
+        return '\n'.join(lines)
+
+    def write(self, path):
+        with open(path, 'w') as out_file:
+            json.dump({'stages': self.stages}, out_file, indent=4)
+        return path
+
+    def chrome_trace(self):
+        """
+        The stages as Chrome trace events: complete ('X') events for the stages and instant ('i') events for the
+        marks. Stages that overlap without nesting (concurrent stages) are put on separate tracks.
+
+        :return: dict with the 'traceEvents' list
+        """
+        pid = os.getpid()
+        tracks = []
+        events = []
+        for record in sorted(self.stages, key=lambda item: (item['start'], -(item['duration'] or 0))):
+            end = record['end'] if record['end'] is not None else self._now()
+            args = {key: record[key] for key in ('status', 'cpu', 'profile') if record.get(key) is not None}
+            if record.get('peak_rss') is not None:
+                args['peak_rss_mb'] = record['peak_rss'] / 1024 ** 2
+            args.update(record.get('args', {}))
+            event = {'name': record['name'], 'cat': 'stage', 'pid': pid, 'ts': record['start'] * 1e6, 'args': args}
+            if record.get('cpu') is None and record['duration'] == 0:
+                events.append(dict(event, ph='i', s='p', tid=0))
+                continue
+
+            # A track is the stack of the open stages on it: a stage goes on the first track whose innermost open
+            # stage contains it (or that has no open stage left)
+            for tid, track in enumerate(tracks):
+                while track and track[-1] <= record['start']:
+                    track.pop()
+                if not track or end <= track[-1]:
+                    break
+            else:
+                tid, track = len(tracks), []
+                tracks.append(track)
+            track.append(end)
+            events.append(dict(event, ph='X', dur=(end - record['start']) * 1e6, tid=tid))
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w') as out_file:
+            json.dump(self.chrome_trace(), out_file)
+        return path
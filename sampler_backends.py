@@ -0,0 +1,107 @@
+"""
+Backends of the lab dependencies of wl_sampler: the target Communicator, the NiDAQ recorder and PythonSV (the ThermaPy
+collection and the decoding of its captures).
+
+wl_sampler reaches these only through the active backend, selected by the 'backend' key of its configuration:
+
+* 'lab' (default) - evtar Communicator, DAQ.DAQ and PythonSV, imported when the backend is first used
+* 'replay' - local stand-ins serving a recorded run as if it was produced live (see replay_backend), so the
+  orchestration runs and can be timed on a plain Linux box
+
+A backend provides:
+
+* communicator() - (Communicator, CommunicatorConfig) used for every target command and file transfer
+* create_daq(nidaq_script_dir, nidaq_calibration_file) - NiDAQ recorder with record() and stop_record()
+* start_thermapy(ip, raw_data_path, duration, lab_path, resolution) - start a ThermaPy collection, returning the
+  collector (is_alive(), exitcode, pid, kill() and join(), like a process) and the event it sets once it collects
+* connect_thermapy_daemon(lab_path, address) - ThermapyDaemonClient of a warm collector (None to collect with
+  start_thermapy)
+* parse_thermapy(lab_path, raw_data_path, parsed_output_file) - decode a capture into a ThermaPy cache directory
+
+:example:
+
+    >>> backend = create_backend(cfg)
+    >>> Communicator, CommunicatorConfig = backend.communicator()
+    >>> daq = backend.create_daq(cfg['nidaq_script_dir'], cfg['nidaq_calibration_file'])
+"""
+import os
+import sys
+
+from thermapy_daemon import ensure_daemon
+from thermapy_parser import parse_capture
+
+LAB = 'lab'
+REPLAY = 'replay'
+BACKENDS = (LAB, REPLAY)
+
+
+def thermapy_func_wrapper(ip, duration, output_path, app_flow_path, resolution, ready=None):
+    import __main__
+    import sys
+    import time
+    sys.path.append(app_flow_path)
+    if "cpu" not in __main__.__dict__.keys():
+
+        from raptorlake import startrpl_rpp
+        startrpl_rpp.main()
+
+        cpu = __main__.cpu
+    else:
+        cpu = __main__.cpu
+
+    import application_collection as appf
+    time_func = lambda: time.time() * resolution
+    # PythonSV is up - tell the host that the collection starts now
+    if ready is not None:
+        ready.set()
+    # cannot receive lambda function from outside.
+    appf.collect_application_dts_time_freq(ip=ip, duration=duration, output_path=output_path, time_func=time_func)
+
+
+class LabBackend:
+    """
+    The lab setup: evtar Communicator to the target, DAQ.DAQ and PythonSV on the host.
+    """
+    name = LAB
+
+    def communicator(self):
+        from evtar.services.communicator.ux import Communicator, CommunicatorConfig
+        return Communicator, CommunicatorConfig
+
+    def create_daq(self, nidaq_script_dir, nidaq_calibration_file):
+        sys.path.append(r"C:\Intel\DAQ Controller")
+        sys.path.append(nidaq_script_dir)
+        import DAQ
+        return DAQ.DAQ(nidaq_calibration_file)
+
+    def start_thermapy(self, ip, raw_data_path, duration, lab_path, resolution):
+        # Launch PythonSV in a new process, which signals the event right before it starts collecting
+        from multiprocess import Event, Process
+        thermapy_app_flow_path = os.path.join(lab_path, r'flows\application')
+        ready = Event()
+        thermapy_process = Process(target=thermapy_func_wrapper, kwargs={
+            'ip': ip, 'duration': duration, 'output_path': raw_data_path, 'app_flow_path': thermapy_app_flow_path,
+            'resolution': resolution, 'ready': ready})
+        thermapy_process.start()
+        return thermapy_process, ready
+
+    def connect_thermapy_daemon(self, lab_path, address):
+        return ensure_daemon(lab_path, address=address)
+
+    def parse_thermapy(self, lab_path, raw_data_path, parsed_output_file):
+        return parse_capture(raw_data_path, parsed_output_file, lab_path)
+
+
+def create_backend(cfg):
+    """
+    :param cfg: wl_sampler configuration
+    :raise ValueError: for an unknown 'backend'
+    :return: backend named by the 'backend' key (default: the lab backend)
+    """
+    name = cfg.get('backend') or LAB
+    if name == LAB:
+        return LabBackend()
+    if name == REPLAY:
+        from replay_backend import ReplayBackend
+        return ReplayBackend.from_config(cfg)
+    raise ValueError(f'Unknown backend {name}, expected one of {BACKENDS}')
@@ -0,0 +1,92 @@
+"""
+step_resample against the per-step loop it replaced, on the docstring example and the EMON Frequency0 of the examples/
+traces, in both step modes.
+"""
+import os
+
+import numpy
+import pandas
+import pytest
+
+import emon_parser
+from emon_metrics import compute_metrics, select_cpu, select_metrics
+from combine_steps import step_resample
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+EXAMPLES = sorted(name for name in os.listdir(EXAMPLES_DIR)
+                  if os.path.isfile(os.path.join(EXAMPLES_DIR, name, 'emon_raw_data.txt')))
+MODES = ('after', 'before')
+
+
+def loop_step_resample(series, period, mode='after'):
+    """
+    The original interval intersection loop ('after' mode only). A 'before' step function is the 'after' step
+    function of the values moved one step back.
+    """
+    if mode == 'before':
+        series = pandas.Series(numpy.append(series.values[1:], series.values[-1]), index=series.index)
+
+    left = series.index[0]
+    right = left + period
+
+    result_x = [left]
+    result_y = [0]
+
+    for step_left, step_right, value in zip(series.index.values[:-1], series.index.values[1:], series.values[:-1]):
+        while True:
+            # interval intersection:
+            ileft, iright = max(left, step_left), min(step_right, right)
+            if ileft < iright:
+                result_y[-1] = result_y[-1] + (iright - ileft) * value
+
+            if step_right >= right:
+                # shift the grid, keep the step interval
+                left = right
+                right = left + period
+
+                result_x.append(left)
+                result_y.append(0)
+            else:
+                break  # shift interval
+
+    result = pandas.Series(result_y, index=result_x)
+    result /= period
+    return result
+
+
+def assert_same_resample(series, period, mode):
+    expected = loop_step_resample(series, period, mode=mode)
+    result = step_resample(series, period, mode=mode)
+    assert result.shape == expected.shape
+    numpy.testing.assert_allclose(result.index.values, expected.index.values, rtol=0, atol=1e-9)
+    # The loop accumulates its grid edges (left + period, over and over), which drift a few ulps from the exact edges
+    # of step_resample, moving a step at an edge by value * drift / period
+    scale = numpy.abs(series.values).max()
+    numpy.testing.assert_allclose(result.values, expected.values, rtol=1e-6, atol=1e-6 * scale)
+
+
+@pytest.fixture(scope='module', params=EXAMPLES)
+def emon_frequency(request):
+    emon_trace = emon_parser.parse(os.path.join(EXAMPLES_DIR, request.param, 'emon_raw_data.txt'))
+    cpu = select_cpu(emon_trace.data.columns)
+    frequency = compute_metrics(emon_trace.data, emon_trace.tsc_freq, select_metrics(['Frequency']),
+                                cpus=[cpu])[cpu + ('Frequency',)]
+    # on the time axis of the run, as align() resamples it (the loop grid drifts on epoch time stamps)
+    return pandas.Series(frequency.values, index=frequency.index - frequency.index[0])
+
+
+def test_docstring_example():
+    result = step_resample(pandas.Series([1, 2, 1, 0], index=[1.1, 1.2, 3.2, 3.3]), period=1.0)
+    numpy.testing.assert_allclose(result.index.values, [1.1, 2.1, 3.1])
+    numpy.testing.assert_allclose(result.values, [1.9, 2.0, 0.3])
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_docstring_example_matches_loop(mode):
+    assert_same_resample(pandas.Series([1, 2, 1, 0], index=[1.1, 1.2, 3.2, 3.3]), 1.0, mode)
+
+
+@pytest.mark.parametrize('period', [0.001, 0.0153, 0.1])
+@pytest.mark.parametrize('mode', MODES)
+def test_examples_frequency_matches_loop(emon_frequency, period, mode):
+    assert_same_resample(emon_frequency, period, mode)
@@ -0,0 +1,317 @@
+"""
+Long-lived ThermaPy collector service that keeps PythonSV initialized across runs.
+
+Bringing up PythonSV (raptorlake.startrpl_rpp) takes about a minute, so instead of initializing it in a new process for
+every run, the daemon initializes it once and then collects on request. wl_sampler talks to it over a local
+multiprocessing.connection channel with dict requests:
+
+* {'command': 'health'} - session state (initialized, collecting, number of collections, last error). 'ok' is False
+  while the session is dropped
+* {'command': 'start', 'ip': ..., 'output_path': ..., 'duration': ..., 'resolution': ...} - start a collection and
+  reply once collect_application_dts_time_freq is running. A dropped session is re-initialized first
+* {'command': 'stop'} - stop the running collection and reply when it ended
+* {'command': 'shutdown'} - stop the daemon
+
+PythonSV and the collection run on the daemon's main thread (PythonSV sessions should not move between threads). The
+requests are served by a background thread, which stops a collection by raising KeyboardInterrupt in the main thread.
+A collection that fails with any other error marks the session as dropped, and the next start re-initializes PythonSV.
+
+:example:
+
+    python thermapy_daemon.py --lab-path D:\\ThermaPy\\lab --address 127.0.0.1:6001
+
+    >>> client = ThermapyDaemonClient('127.0.0.1:6001')
+    >>> client.start(ip='core0_t0', output_path=r'C:\\data\\thermapy_raw_data.csv')
+    >>> client.stop()
+"""
+import _thread
+import argparse
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+
+DEFAULT_ADDRESS = '127.0.0.1:6001'
+DEFAULT_AUTHKEY = 'wl_sampler'
+DEFAULT_START_TIMEOUT = 120
+DEFAULT_STOP_TIMEOUT = 60
+_JOB_POLL_INTERVAL = 0.5
+
+
+class DaemonError(RuntimeError):
+    pass
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+class CollectorService:
+    """
+    State of the PythonSV session and of the running collection. Jobs are executed by run() on the main thread.
+    """
+
+    def __init__(self, app_flow_path):
+        self.app_flow_path = app_flow_path
+        self.appf = None
+        self.session_error = None
+        self.init_seconds = None
+        self.collections = 0
+        self.last_error = None
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.collecting = False
+        self.started = threading.Event()
+        self.finished = threading.Event()
+        self.finished.set()
+        self.running = True
+
+    def health(self):
+        return {
+            'ok': self.session_error is None,
+            'initialized': self.appf is not None,
+            'session_error': self.session_error,
+            'init_seconds': self.init_seconds,
+            'collecting': self.collecting,
+            'collections': self.collections,
+            'last_error': self.last_error,
+        }
+
+    def _initialize(self):
+        import __main__
+        start = time.perf_counter()
+        if self.app_flow_path not in sys.path:
+            sys.path.append(self.app_flow_path)
+        if self.session_error is not None or "cpu" not in __main__.__dict__.keys():
+            from raptorlake import startrpl_rpp
+            startrpl_rpp.main()
+        import application_collection as appf
+        self.appf = appf
+        self.session_error = None
+        self.init_seconds = time.perf_counter() - start
+        print(f'PythonSV session initialized in {self.init_seconds:.1f} sec')
+
+    def _collect(self, ip, output_path, duration, resolution):
+        time_func = lambda: time.time() * resolution
+        try:
+            # inside the try, so the finally also ends a collection stopped before it got to collect
+            with self.lock:
+                self.collecting = True
+            self.started.set()
+            self.appf.collect_application_dts_time_freq(ip=ip, duration=duration, output_path=output_path,
+                                                        time_func=time_func)
+        except KeyboardInterrupt:
+            # stop request
+            pass
+        except Exception as e:
+            traceback.print_exc()
+            self.last_error = self.session_error = f'{type(e).__name__}: {e}'
+        finally:
+            with self.lock:
+                self.collecting = False
+            self.collections += 1
+            self.finished.set()
+
+    def warmup(self):
+        """
+        Initialize the session, recording (not raising) a failure
+        """
+        try:
+            if self.appf is None or self.session_error is not None:
+                self._initialize()
+        except Exception as e:
+            traceback.print_exc()
+            self.last_error = self.session_error = f'{type(e).__name__}: {e}'
+            return False
+        return True
+
+    def _start_job(self, ip, output_path, duration, resolution):
+        if self.started.is_set():
+            # the start was already answered (interrupted before the job ran)
+            return
+        if not self.warmup():
+            self.finished.set()
+            self.started.set()
+            return
+        self._collect(ip, output_path, duration, resolution)
+
+    def start(self, ip, output_path, duration=None, resolution=1, timeout=DEFAULT_START_TIMEOUT):
+        if not self.finished.is_set():
+            raise DaemonError('A collection is already running')
+        self.started.clear()
+        self.finished.clear()
+        self.last_error = None
+        self.jobs.put(lambda: self._start_job(ip, output_path, duration, resolution))
+        if not self.started.wait(timeout):
+            raise DaemonError(f'Collection did not start within {timeout} sec')
+        if self.last_error is not None:
+            raise DaemonError(self.last_error)
+        return {'ok': True, 'init_seconds': self.init_seconds}
+
+    def stop(self, timeout=DEFAULT_STOP_TIMEOUT):
+        with self.lock:
+            if self.collecting:
+                _thread.interrupt_main()
+        if not self.finished.wait(timeout):
+            raise DaemonError(f'Collection did not stop within {timeout} sec')
+        return {'ok': True, 'error': self.last_error}
+
+    def run(self):
+        """
+        Execute jobs on the calling (main) thread until shutdown
+        """
+        while self.running:
+            try:
+                job = self.jobs.get(timeout=_JOB_POLL_INTERVAL)
+                job()
+            except queue.Empty:
+                continue
+            except KeyboardInterrupt:
+                # a stop request that landed outside the collection (right before or after it)
+                with self.lock:
+                    self.collecting = False
+                if not self.started.is_set():
+                    self.last_error = 'Collection interrupted before it started'
+                    self.started.set()
+                self.finished.set()
+
+
+def _serve(service, listener):
+    handlers = {
+        'health': lambda request: service.health(),
+        'start': lambda request: service.start(ip=request['ip'], output_path=request['output_path'],
+                                               duration=request.get('duration'),
+                                               resolution=request.get('resolution', 1),
+                                               timeout=request.get('timeout', DEFAULT_START_TIMEOUT)),
+        'stop': lambda request: service.stop(),
+    }
+    while service.running:
+        with listener.accept() as connection:
+            try:
+                request = connection.recv()
+                command = request.get('command')
+                if command == 'shutdown':
+                    service.stop()
+                    service.running = False
+                    reply = {'ok': True}
+                elif command in handlers:
+                    reply = handlers[command](request)
+                else:
+                    reply = {'ok': False, 'error': f'Unknown command: {command}'}
+            except Exception as e:
+                reply = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+            connection.send(reply)
+
+
+class ThermapyDaemonClient:
+    """
+    Client of a running thermapy_daemon. Every request uses its own connection.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=DEFAULT_AUTHKEY):
+        self.address = parse_address(address)
+        self.authkey = authkey.encode()
+
+    def _send(self, command, **kwargs):
+        with Client(self.address, authkey=self.authkey) as connection:
+            connection.send(dict(kwargs, command=command))
+            return connection.recv()
+
+    def request(self, command, **kwargs):
+        reply = self._send(command, **kwargs)
+        if not reply.get('ok'):
+            raise DaemonError(reply.get('error'))
+        return reply
+
+    def is_running(self):
+        try:
+            self._send('health')
+        except (OSError, EOFError):
+            return False
+        return True
+
+    def health(self):
+        """
+        :return: the session state. Not raising for a dropped session ('ok' False), which the next start re-initializes
+        """
+        return self._send('health')
+
+    def start(self, ip, output_path, duration=None, resolution=1, timeout=DEFAULT_START_TIMEOUT):
+        """
+        Start a collection, returning once it runs (PythonSV is initialized first if needed, within the timeout)
+        """
+        return self.request('start', ip=ip, output_path=output_path, duration=duration, resolution=resolution,
+                            timeout=timeout)
+
+    def stop(self):
+        return self.request('stop')
+
+    def shutdown(self):
+        return self.request('shutdown')
+
+
+def ensure_daemon(lab_path, address=DEFAULT_ADDRESS, authkey=DEFAULT_AUTHKEY, timeout=30):
+    """
+    Connect to the daemon, launching it in the background (detached from the caller) if it is not running.
+
+    :return: ThermapyDaemonClient
+    """
+    client = ThermapyDaemonClient(address, authkey)
+    if client.is_running():
+        return client
+
+    command = [sys.executable, os.path.abspath(__file__), '--lab-path', lab_path, '--address', address,
+               '--authkey', authkey]
+    if os.name == 'nt':
+        subprocess.Popen(command, creationflags=subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP)
+    else:
+        subprocess.Popen(command, start_new_session=True)
+    deadline = time.monotonic() + timeout
+    while not client.is_running():
+        if time.monotonic() >= deadline:
+            raise DaemonError(f'Thermapy daemon did not come up at {address} within {timeout} sec')
+        time.sleep(0.5)
+    return client
+
+
+def _parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description="Persistent ThermaPy collector keeping PythonSV initialized",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--lab-path", help="ThermaPy lab code path", required=True)
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="host:port to listen on")
+    parser.add_argument("--authkey", default=DEFAULT_AUTHKEY, help="Connection authentication key")
+    parser.add_argument("--no-warmup", action='store_true',
+                        help="Initialize PythonSV on the first collection instead of at startup")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = _parse_command_line(argv=argv)
+    # Stop requests interrupt the collection with SIGINT (KeyboardInterrupt), which is ignored in background/detached
+    # processes unless Python's handler is installed explicitly
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    service = CollectorService(app_flow_path=os.path.join(args.lab_path, r'flows\application'))
+    if not args.no_warmup:
+        service.jobs.put(service.warmup)
+
+    listener = Listener(parse_address(args.address), authkey=args.authkey.encode())
+    print(f'Thermapy daemon listening on {args.address}')
+    server = threading.Thread(target=_serve, args=(service, listener), daemon=True)
+    server.start()
+    try:
+        service.run()
+    finally:
+        listener.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -12,29 +12,51 @@ Then take the result emon.csv and thermalpy.csv and run:
 C:\\Program Files\\SPEED\\speed.exe run emon_thermalpy_align.py --emon-file emon.csv --thermalpy_file thermalpy.csv
     --output-file out.csv
 
+Use --output-format parquet/feather/npz to write a binary columnar trace that also keeps the EMON column hierarchy
+and the run system info (see trace_output).
+
 The script will also generate health report as HTML file in the same location as the output file that shows the
-alignment accuracy
-"""
-import argparse
-import sys
-import pandas
-import numpy
+alignment accuracy. The report charts are downsampled by default (--report decimated); use --report full to chart
+every sample or --report none to skip the report.
 
-from scipy.signal import find_peaks
-from tracedm.emon import parse
-from reports import *
+Use --clock-sync with the clock_sync.json of the run (see clock_sync) to put the EMON trace on the host clock and search
+for the DAQAlign pattern only within --sync-window seconds of the offset predicted by the clock sync (0 places the
+trace at the predicted offset without a search).
 
+The traces are aligned on the frequency of --align-cpu (CPU0 by default). Use --metrics (built-in metrics, see
+emon_metrics) and --metrics-file (JSON of metric name -> formula) to add derived metrics of every logical CPU to the
+output, e.g. --metrics Frequency IPC Utilization.
 
-def is_mean_column(column):
-    if column.startswith('DTS') or 'ratio' in column or 'Frequency' in column:
-        return True
-    return False
+The combine stages (wall time, CPU time and peak RSS) are written as a Chrome trace next to the output file, to be
+opened in Perfetto; --profile profiles one of the stages with cProfile.
 
+For multi-hour captures use --chunk-rows to combine out of core (see chunked_combine) and --dtype-policy compact to
+narrow the output columns. A time-range index is written next to the output, so a phase of the run can be read
+without loading the whole trace (see trace_index). A DAQ pyramid directory (see daq_pyramid) can be given as
+--daq-file; only its level of the --daq-resolution the alignment needs is read.
+
+The loading, alignment, chop and report steps are shared with the out-of-core combine, in combine_steps.
+"""
+import argparse
+import os
+import sys
+import pandas
 
-def is_sum_column(column):
-    if column == 'cycles':
-        return True
-    return False
+from interval_binning import bin_to_intervals
+from time_axis import time_window, shift_time, rebase_time, on_time_axis
+from trace_index import DEFAULT_BLOCK_ROWS, write_index
+from trace_output import DTYPE_POLICIES, OUTPUT_FORMATS, apply_dtype_policy, write_combined
+from chart_decimation import DECIMATION_METHODS, DEFAULT_POINTS, REPORT_MODES
+from trace_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, TraceCache
+from thermapy_parser import START_EPOCH
+from clock_sync import read_clock_sync, target_to_host
+from run_timeline import Timeline
+from emon_metrics import DEFAULT_ALIGN_CPU, DEFAULT_METRICS, load_metrics, select_cpu, select_metrics
+# find_pattern and step_resample are also imported from here, where they were defined before combine_steps
+from combine_steps import DAQ_AGGREGATION, DEFAULT_SYNC_WINDOW, THERMALPY_AGGREGATION, add_derived_columns, \
+    add_section, chop_bounds, chop_markers, find_offsets, find_pattern, flatten_columns, format_quality, \
+    input_digests, load_traces, new_report, offsets_cache, read_thermalpy_header, render_health_report, \
+    run_system_info, step_resample, trace_charts, write_stage_trace
 
 
 def _parse_command_line(argv):
@@ -45,430 +67,272 @@ def _parse_command_line(argv):
 
     parser.add_argument("--emon-file", "-e", help="Path to emon CSV data file (generated from EMON "
                                                   "with -V switch)", required=True)
-    parser.add_argument("--thermalpy-file", "-t", help="Path to thermalpy trace file", required=True)
-    parser.add_argument("--daq-file", "-d", help="Path to DAQ CSV trace file", required=False)
-    parser.add_argument("--output-file", "-o", help="Path to output CSV file", required=True)
+    parser.add_argument("--thermalpy-file", "-t", help="Path to thermalpy trace file (parsed CSV or its cache "
+                                                       "directory)", required=True)
+    parser.add_argument("--daq-file", "-d", help="Path to DAQ CSV trace file (or its pyramid directory)",
+                        required=False)
+    parser.add_argument("--daq-resolution", type=float, default=None,
+                        help="Finest resolution [sec] read from a DAQ pyramid (default: the thermalpy sampling "
+                             "period)")
+    parser.add_argument("--output-file", "-o", help="Path to output file", required=True)
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default='csv',
+                        help="Format of the combined trace. Binary formats also store the column hierarchy and the "
+                             "run system info")
+    parser.add_argument("--thermalpy-raw-file", help="Path to the raw thermalpy capture, used to store its setup "
+                                                     "information with the output", required=False)
+    parser.add_argument("--report", choices=REPORT_MODES, default='decimated',
+                        help="Health report charts: every sample, downsampled to --report-points, or no report")
+    parser.add_argument("--report-points", type=int, default=DEFAULT_POINTS,
+                        help="Point budget of every decimated report chart series")
+    parser.add_argument("--report-method", choices=DECIMATION_METHODS, default='minmax',
+                        help="Decimation method of the report charts (min/max envelope or LTTB)")
+    parser.add_argument("--no-cache", action='store_true',
+                        help="Do not use the parsed trace/alignment cache")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory of the parsed trace cache")
+    parser.add_argument("--cache-size-mb", type=int, default=DEFAULT_MAX_BYTES // 1024 ** 2,
+                        help="Size budget of the parsed trace cache; least recently used entries are evicted")
+    parser.add_argument("--coarse-factor", type=int, default=None,
+                        help="Decimation factor for a coarse pattern search refined at full rate")
+    parser.add_argument("--align-cpu", default=DEFAULT_ALIGN_CPU,
+                        help="Logical CPU whose frequency is aligned: 'CPU3', 'bigcore/CPU3' or "
+                             "'package0/bigcore/CPU3'")
+    parser.add_argument("--metrics", nargs='*', choices=sorted(DEFAULT_METRICS), default=[],
+                        help="Built-in derived metrics added to the output for every logical CPU")
+    parser.add_argument("--metrics-file", default=None,
+                        help="JSON dict of metric name -> formula over EMON events, added to the output for every "
+                             "logical CPU")
+    parser.add_argument("--clock-sync", default=None,
+                        help="clock_sync.json of the run, mapping the EMON (and DAQ) clock to the host clock")
+    parser.add_argument("--sync-window", type=float, default=DEFAULT_SYNC_WINDOW,
+                        help="Search the pattern within this many seconds of the clock sync prediction (0 to place "
+                             "the traces at the predicted offsets)")
+    parser.add_argument("--chunk-rows", type=int, default=None,
+                        help="Combine out of core: stream the EMON trace in chunks of this many samples and append "
+                             "the output chunk by chunk (csv, parquet and feather outputs)")
+    parser.add_argument("--dtype-policy", choices=sorted(DTYPE_POLICIES), default='keep',
+                        help="Output column dtypes: keep them, or 'compact' (uint32 EMON counter deltas, float32 "
+                             "values)")
+    parser.add_argument("--index-block-rows", type=int, default=DEFAULT_BLOCK_ROWS,
+                        help="Rows per block of the time-range index written next to the output (0 for no index, "
+                             "see trace_index)")
+    parser.add_argument("--profile", default=None,
+                        help="Profile every occurrence of this stage with cProfile (e.g. 'load emon', 'emon metrics', "
+                             "'step_resample', 'find_pattern', 'bin_to_intervals', 'write output', 'report render'); "
+                             "the profiles are written next to the output file")
 
     # add your arguments here
     return parser.parse_args(args=argv)
 
-
-def _load_traces(emon_file, thermalpy_file, daq_file):
-    # This code fixes the EMON
-    with open(emon_file, 'r') as in_file:
-        with open(r'C:\Temp\emon.txt', 'w') as out_file:
-            next_line = False
-            for line in in_file:
-                line = line.strip()
-                if next_line:
-                    while line[-2] == ';':
-                        line = line[:-1]
-
-                out_file.write(line + '\n')
-                if line.startswith('epoch'):
-                    next_line = True
-                else:
-                    next_line = False
-
-    emon_file = r'C:\Temp\emon.txt'
-    emon_trace = parse(emon_file)
-
-    thermalpy_trace = pandas.read_csv(thermalpy_file)
-    thermalpy_trace.set_index('Frame', inplace=True)
-    thermalpy_trace.reset_index(inplace=True)
-    # Convert the Time column from MS to SEC
-    thermalpy_trace['Time'] /= 1000
-    thermalpy_trace.set_index('Time', inplace=True)
-
-    daq_trace = None
-    if daq_file is not None:
-        daq_trace = pandas.read_csv(daq_file)
-        daq_trace.set_index('TimeStamp', inplace=True)
-
-    return emon_trace, thermalpy_trace, daq_trace
-
-
-def step_resample(series: pandas.Series, period: float, mode='after') -> pandas.Series:
-    """
-    | Resample step function specified by "series" with specified period.
-    | The step function is assumed to have steps AFTER the index points (example: [(0, 1), (1, 2), ...] means [f=1 @ 0]
-    -> [f=2 @ 1] ...)
-
-    :param series: pandas.Series representing a step function
-    :param period: resample period
-    :param mode: step mode. One of 'after' or 'before' (default: 'after')
-    :return: pandas.Series representing a step function with duration-weighted average per step (step AFTER point)
-
-    :example:
-
-        >>> # resample specified step function with constant period of 1.0:
-        >>> res = step_resample(pandas.Series([1, 2, 1, 0], index=[1.1, 1.2, 3.2, 3.3]), period=1.0)
-            1.1 2.9,
-            2.1 2.0,
-            3.1 0.3
-    """
-    if mode != 'after':
-        raise NotImplementedError()
-
-    # implemented using interval intersection between grid and step intervals
-    left = series.index[0]
-    right = left + period
-
-    result_x = [left]
-    result_y = [0]
-
-    for step_left, step_right, value in zip(series.index.values[:-1], series.index.values[1:], series.values[:-1]):
-        while True:
-            # interval intersection:
-            ileft, iright = max(left, step_left), min(step_right, right)
-            if ileft < iright:
-                result_y[-1] = result_y[-1] + (iright - ileft) * value
-
-            if step_right >= right:
-                # shift the grid, keep the step interval
-                left = right
-                right = left + period
-
-                result_x.append(left)
-                result_y.append(0)
-            else:
-                break  # shift interval
-
-    result = pandas.Series(result_y, index=result_x)
-    result /= period
-    return result
-
-
-def normalize(array):
-    """
-    Normalize the array into 0..1 range
-    """
-    result = array - array.min()
-    return result / result.max()
-
-
-def find_pattern(signal, pattern):
-    """
-    Use correlation to find "pattern" in "values", assuming uniform sampling.
-    Will return location with the highest correlation between the pattern and the signal samples.
-
-    :param signal: sequence of values representing a signal series
-    :param pattern: sequence of values representing a signal sample to find
-    :return: non-zero offset of "pattern" inside "signal"
-
-    :example:
-
-        >>> find_pattern([0, 0, 0, 2.0, 2.1, 0, 0, 0], [0, 1.3, 1.3, 0, 0])  # find approximate pattern match for 1D signal
-        >>> 2
-
-    """
-    signal = numpy.atleast_1d(signal)
-    signal = signal - signal.mean()
-
-    pattern = numpy.atleast_1d(pattern)
-    pattern = pattern - pattern.mean()
-
-    return numpy.argmax(numpy.correlate(signal, pattern, mode='full')) - pattern.shape[0] + 1
-
-
-def _resample_thermalpy(emon_df, thermalpy_df):
-    """
-    Resamples Thermalpy trace based on EMON samples.
-    :return: the thermalpy data frame resamples by the given emon index
-    """
-    emon_ranges = list(zip(emon_df.index[:-1], emon_df.index[1:]))
-
-    # Create new thermalpy index
-    new_thermalpy_index_col = []
-    emon_range_index = 0
-    thermalpy_row_index = 0
-    while thermalpy_row_index < thermalpy_df.shape[0]:
-        left, right = emon_ranges[emon_range_index]
-        value = thermalpy_df.index.values[thermalpy_row_index]
-        if value <= left:
-            new_thermalpy_index_col.append(left)
-            thermalpy_row_index += 1
-            continue
-
-        if value <= right:
-            new_thermalpy_index_col.append(right)
-            thermalpy_row_index += 1
-            continue
-
-        emon_range_index += 1
-
-    thermalpy_df.index = new_thermalpy_index_col
-    thermalpy_df.index.name = 'Time'
-    mean_columns = [c for c in thermalpy_df.columns if is_mean_column(c)]
-    grouped_thermalpy_trace_mean = thermalpy_df[mean_columns].groupby('Time').mean().copy()
-    grouped_thermalpy_trace_mean = grouped_thermalpy_trace_mean.iloc[1:]
-
-    sum_columns = [c for c in thermalpy_df.columns if is_sum_column(c)]
-    grouped_thermalpy_trace_sum = thermalpy_df[sum_columns].groupby('Time').sum().copy()
-    grouped_thermalpy_trace_sum = grouped_thermalpy_trace_sum.iloc[1:]
-
-    return pandas.concat([grouped_thermalpy_trace_mean, grouped_thermalpy_trace_sum], axis=1)
-
-
-def _resample_daq(emon_df, daq_df):
-    """
-    Resamples NiDAQ trace based on EMON samples.
-    :return: the NiDAQ data frame resamples by the given emon index
-    """
-    emon_ranges = list(zip(emon_df.index[:-1], emon_df.index[1:]))
-
-    # Create new daq index
-    new_daq_index_col = []
-    emon_range_index = 0
-    daq_row_index = 0
-    while daq_row_index < daq_df.shape[0] and emon_range_index < len(emon_ranges):
-        left, right = emon_ranges[emon_range_index]
-        value = daq_df.index.values[daq_row_index]
-        if value <= left:
-            new_daq_index_col.append(left)
-            daq_row_index += 1
-            continue
-
-        if value <= right:
-            new_daq_index_col.append(right)
-            daq_row_index += 1
-            continue
-
-        emon_range_index += 1
-
-    daq_df = daq_df.iloc[:len(new_daq_index_col)]
-    daq_df.index = new_daq_index_col
-    daq_df.index.name = 'Time'
-    mean_columns = daq_df.columns
-    grouped_daq_trace_mean = daq_df[mean_columns].groupby('Time').mean().copy()
-    grouped_daq_trace_mean = grouped_daq_trace_mean.iloc[1:]
-
-    return grouped_daq_trace_mean
-
-
-def align(emon_file, thermalpy_file, daq_file, output_file):
+def align(emon_file, thermalpy_file, daq_file, output_file, coarse_factor=None,
+          thermalpy_aggregation=THERMALPY_AGGREGATION, daq_aggregation=DAQ_AGGREGATION, output_format='csv',
+          thermalpy_raw_file=None, cache=None, report_mode='decimated', report_points=DEFAULT_POINTS,
+          report_method='minmax', clock_sync=None, sync_window=DEFAULT_SYNC_WINDOW, align_cpu=DEFAULT_ALIGN_CPU,
+          metrics=None, dtype_policy=None, chunk_rows=None, daq_resolution=None, index_block_rows=DEFAULT_BLOCK_ROWS,
+          timeline=None):
     """
     Aligns EMON csv file and thermalpy trace. The DAQAlign.exe software should be executed before and after the
     workload. It generates the output to the given output file
 
-    :param emon_file: Path to EMON CSV file generated from EMON with -V switch
-    :param thermalpy_file: path to file generated using thermalpy tool
+    The traces can also be handed over already loaded, e.g. by a caller that has just parsed them, and the combined
+    frame and the report are returned, so the combine can run in-process without writing or re-reading files.
+
+    :param emon_file: Path to EMON CSV file generated from EMON with -V switch, or an emon_parser.EmonTrace
+    :param thermalpy_file: path to file generated using thermalpy tool, or its cache directory (see thermapy_parser),
+        or a thermalpy frame indexed by Time [sec]
+    :param daq_file: optional path to the DAQ CSV trace or to its pyramid directory (see daq_pyramid), or a DAQ frame
+        indexed by TimeStamp [sec]
+    :param output_file: output path, or None to only return the combined frame (no output, report or stage trace
+        files are written)
+    :param coarse_factor: optional decimation factor for a coarse-to-fine pattern search (see find_pattern)
+    :param thermalpy_aggregation: aggregation policy for resampling thermalpy columns to the EMON grid
+    :param daq_aggregation: aggregation policy for resampling DAQ columns to the EMON grid
+    :param output_format: format of the combined trace, one of trace_output.OUTPUT_FORMATS
+    :param thermalpy_raw_file: optional raw thermalpy capture; its setup is stored with binary outputs
+    :param cache: optional trace_cache.TraceCache for the parsed traces and the alignment offsets
+    :param report_mode: one of REPORT_MODES. 'full' charts every sample, 'decimated' downsamples every chart series to
+        "report_points" samples with "report_method" (see chart_decimation) and 'none' skips the health report
+    :param clock_sync: optional dict of trace name ('emon', 'daq') -> clock model mapping the trace clock to the host
+        (thermalpy) clock (see clock_sync). The mapped traces are searched for within "sync_window" seconds of their
+        predicted offsets, or placed at them when "sync_window" is 0
+    :param align_cpu: logical CPU whose frequency is aligned (see emon_metrics.select_cpu)
+    :param metrics: optional dict of metric name -> formula (see emon_metrics) added to the output for every logical
+        CPU
+    :param dtype_policy: optional dtype policy of the output columns (see trace_output.apply_dtype_policy)
+    :param chunk_rows: stream the EMON trace in chunks of this many samples and append the output chunk by chunk
+        instead of combining the traces in memory (see chunked_combine)
+    :param daq_resolution: finest resolution [sec] read from a DAQ pyramid (default: the ThermaPy sampling period)
+    :param index_block_rows: rows per block of the time-range index written next to the output (see trace_index), or
+        None to write no index
+    :param timeline: optional run_timeline.Timeline recording the combine stages (e.g. one profiling a stage). The
+        stages are written as a Chrome trace next to the output file
+    :return: dict of the run information (offsets, alignment quality, ...) with the output, index, report and stage
+        trace paths, the 'combined' frame (None when chunked) and the health 'report' object (None without a report)
     """
-    SIZE_HINT = 'wide'
-
-    report = Report('EMON-Thermalpy alignment health')
-    emon_trace, thermalpy_trace, daq_trace = _load_traces(
-        emon_file=emon_file, thermalpy_file=thermalpy_file, daq_file=daq_file)
-
-    for core_type in ['bigcore', 'core', 'atom']:
-        try:
-            emon_trace.data['Duration'] = emon_trace.data[
-                                              ('package0', core_type, 'CPU0', 'CPU_CLK_UNHALTED.REF_TSC')] / (
-                                              emon_trace.tsc_freq)
-            emon_trace.data['Frequency0'] = emon_trace.data[
-                                                ('package0', core_type, 'CPU0', 'CPU_CLK_UNHALTED.THREAD')] / \
-                                            emon_trace.data['Duration'] / 1e6
-        except:
-            pass
-
-    thermalpy_freq_data = thermalpy_trace['Frequency[MHz]'].copy()
-    emon_freq_data = emon_trace.data['Frequency0'].copy()
-    charts = [
-        ScatterChart('EMON CPU0 frequency', ScatterDataSeries(
-            x=emon_freq_data.index, y=emon_freq_data, step=True,
-            color='black'), sizehint=SIZE_HINT, markers=False),
-        ScatterChart('ThermalPy CPU0 frequency', ScatterDataSeries(
-            x=thermalpy_freq_data.index,
-            y=thermalpy_freq_data, step=True, color='blue'),
-                     sizehint=SIZE_HINT, markers=False)
-    ]
-    if daq_trace is not None:
-        daq_power_data = daq_trace['P_IA']
-        charts.insert(1,
-                      ScatterChart('DAQ IA Power', ScatterDataSeries(
-                          x=daq_trace.index, y=daq_power_data, step=True,
-                          color='green'), sizehint=SIZE_HINT, markers=False))
-    initial_state_section = Section('Initial',
-                                    ChartGroup(*charts))
-    report.append(initial_state_section)
+    if chunk_rows:
+        from chunked_combine import align_chunked
+        return align_chunked(emon_file, thermalpy_file, daq_file, output_file, coarse_factor=coarse_factor,
+                             thermalpy_aggregation=thermalpy_aggregation, daq_aggregation=daq_aggregation,
+                             output_format=output_format, thermalpy_raw_file=thermalpy_raw_file, cache=cache,
+                             report_mode=report_mode, report_points=report_points, report_method=report_method,
+                             clock_sync=clock_sync, sync_window=sync_window, align_cpu=align_cpu, metrics=metrics,
+                             dtype_policy=dtype_policy, chunk_rows=chunk_rows, daq_resolution=daq_resolution,
+                             index_block_rows=index_block_rows, timeline=timeline)
+    timeline = Timeline() if timeline is None else timeline
+    report = new_report(report_mode)
+    chart_options = {}
+    if report_mode == 'decimated':
+        chart_options = dict(points=report_points, method=report_method)
+    digests = input_digests(cache, emon_file, thermalpy_file, daq_file)
+    emon_trace, thermalpy_trace, daq_trace = load_traces(
+        emon_file=emon_file, thermalpy_file=thermalpy_file, daq_file=daq_file, cache=cache, digests=digests,
+        daq_resolution=daq_resolution, timeline=timeline)
+
+    alignment_cpu = select_cpu(emon_trace.data.columns, align_cpu)
+    with timeline.stage('emon metrics'):
+        add_derived_columns(emon_trace, alignment_cpu, metrics)
+
+    clock_sync = clock_sync or {}
+    if 'emon' in clock_sync:
+        emon_trace.data.index = pandas.Index(target_to_host(emon_trace.data.index.values, clock_sync['emon']),
+                                             name=emon_trace.data.index.name)
+    if daq_trace is not None and 'daq' in clock_sync:
+        daq_trace.index = pandas.Index(target_to_host(daq_trace.index.values, clock_sync['daq']),
+                                       name=daq_trace.index.name)
+
+    thermalpy_freq_data = thermalpy_trace['Frequency[MHz]']
+    if report is not None:
+        charts = trace_charts(emon_trace.data['Frequency0'], thermalpy_freq_data,
+                               None if daq_trace is None else daq_trace['P_IA'], **chart_options)
+        add_section(report, 'Initial', charts)
+
+    # The thermalpy Time axis counts from the capture start epoch [ms] of the raw capture header (host clock)
+    thermalpy_header = read_thermalpy_header(thermalpy_file, thermalpy_raw_file) if clock_sync else {}
+    thermalpy_origin = thermalpy_header.get(START_EPOCH, 0.0) / 1000
 
     duration_diff = emon_trace.data.index[-1] - thermalpy_trace.index[-1]
-    emon_df = emon_trace.data
-    emon_df = emon_df.loc[[x for x in emon_df.index if x >= duration_diff]]
-
-    emon_df = emon_df[emon_df.columns[2:]]
-    emon_df.index -= emon_df.index[0]
+    emon_df = time_window(emon_trace.data, start=duration_diff)
+    # Host time of the first sample, where a trace on the host clock belongs on the thermalpy time axis
+    expected = {'emon': emon_df.index[0] - thermalpy_origin if 'emon' in clock_sync else None, 'daq': None}
+    emon_df = rebase_time(emon_df.iloc[:, 2:])
 
     if daq_trace is not None:
         duration_diff = daq_trace.index[-1] - thermalpy_trace.index[-1]
-        daq_trace = daq_trace.loc[[x for x in daq_trace.index if x >= duration_diff]]
-        daq_trace.index -= daq_trace.index[0]
-
-    thermalpy_freq_data = thermalpy_trace['Frequency[MHz]'].copy()
-    sampling_period = numpy.diff(thermalpy_freq_data.index).mean()
-    pattern = normalize(
-        step_resample(
-            emon_df['Frequency0'],
-            sampling_period
-        ).values
-    )
-    offset = find_pattern(signal=thermalpy_freq_data, pattern=pattern)
-    emon_df.index += thermalpy_freq_data.index[offset]
+        daq_trace = time_window(daq_trace, start=duration_diff)
+        expected['daq'] = daq_trace.index[0] - thermalpy_origin if 'daq' in clock_sync else None
+        daq_trace = rebase_time(daq_trace)
 
-    if daq_trace is not None:
-        pattern = normalize(
-            step_resample(
-                daq_trace['P_IA'],
-                sampling_period
-            ).values
-        )
-        offset = find_pattern(signal=thermalpy_freq_data, pattern=pattern)
-        daq_trace.index += thermalpy_freq_data.index[offset]
-
-    charts = [
-        ScatterChart('EMON CPU0 frequency', ScatterDataSeries(
-            x=emon_df['Frequency0'].index, y=emon_df['Frequency0'], step=True,
-            color='black'), sizehint=SIZE_HINT, markers=False),
-        ScatterChart('ThermalPy CPU0 frequency', ScatterDataSeries(
-            x=thermalpy_trace['Frequency[MHz]'].index,
-            y=thermalpy_trace['Frequency[MHz]'], step=True, color='blue'),
-                     sizehint=SIZE_HINT, markers=False)
-    ]
-    if daq_trace is not None:
-        charts.insert(1,
-                      ScatterChart('DAQ IA Power', ScatterDataSeries(
-                          x=daq_trace['P_IA'].index, y=daq_trace['P_IA'], step=True,
-                          color='green'), sizehint=SIZE_HINT, markers=False))
+    alignment = find_offsets(thermalpy_freq_data, emon_df['Frequency0'], None if daq_trace is None else
+                              daq_trace['P_IA'], coarse_factor, expected, clock_sync, sync_window, align_cpu,
+                              alignment_cpu, cache=offsets_cache(cache, emon_file, thermalpy_file, daq_file),
+                              digests=digests, timeline=timeline, thermalpy_header=thermalpy_header)
 
-    alignment_state_section = Section('Alignment',
-                                      ChartGroup(*charts))
-    report.append(alignment_state_section)
+    emon_offset, emon_quality = alignment['emon']
+    shift_time(emon_df, emon_offset)
+    print(f'EMON offset: {emon_offset:.6f} sec ({format_quality(emon_quality)})')
+
+    if daq_trace is not None:
+        daq_offset, daq_quality = alignment['daq']
+        shift_time(daq_trace, daq_offset)
+        print(f'DAQ offset: {daq_offset:.6f} sec ({format_quality(daq_quality)})')
+
+    if report is not None:
+        charts = trace_charts(emon_df['Frequency0'], thermalpy_trace['Frequency[MHz]'],
+                               None if daq_trace is None else daq_trace['P_IA'],
+                               emon_title=f'EMON {alignment_cpu[2]} frequency ({format_quality(emon_quality)})',
+                               daq_title=None if daq_trace is None else
+                               f'DAQ IA Power ({format_quality(daq_quality)})', **chart_options)
+        add_section(report, 'Alignment', charts)
 
     # Combine the traces
-    emon_df.index = numpy.round(emon_df.index, 6)
-    thermalpy_trace.index = numpy.round(thermalpy_trace.index, 6)
+    shift_time(emon_df, decimals=6)
+    shift_time(thermalpy_trace, decimals=6)
     if daq_trace is not None:
-        daq_trace.index = numpy.round(daq_trace.index, 6)
+        shift_time(daq_trace, decimals=6)
 
-    thermalpy_resampled = _resample_thermalpy(emon_df=emon_df, thermalpy_df=thermalpy_trace)
+    with timeline.stage('bin_to_intervals', trace='thermalpy'):
+        thermalpy_resampled = bin_to_intervals(thermalpy_trace, edges=emon_df.index.values,
+                                               policy=thermalpy_aggregation)
 
     daq_resampled = None
     if daq_trace is not None:
-        daq_resampled = _resample_daq(emon_df=emon_df, daq_df=daq_trace)
+        with timeline.stage('bin_to_intervals', trace='daq'):
+            daq_resampled = bin_to_intervals(daq_trace, edges=emon_df.index.values, policy=daq_aggregation)
 
-    emon_df = emon_df.loc[
-        [x for x in emon_df.index if thermalpy_resampled.index[0] <= x <= thermalpy_resampled.index[-1]]]
+    emon_df = time_window(emon_df, start=thermalpy_resampled.index[0], stop=thermalpy_resampled.index[-1])
 
     if daq_trace is not None:
-        emon_df = emon_df.loc[
-            [x for x in emon_df.index if daq_resampled.index[0] <= x <= daq_resampled.index[-1]]]
+        emon_df = time_window(emon_df, start=daq_resampled.index[0], stop=daq_resampled.index[-1])
 
+    # The resampled traces are indexed by EMON sample times, so all frames share the EMON time axis
     emon_df = emon_df.drop([('Duration', '', '', '')], axis=1)
-    concat_dfs = [emon_df, thermalpy_resampled, daq_resampled] if daq_trace is not None else [emon_df,
-                                                                                              thermalpy_resampled]
+    concat_dfs = [emon_df]
+    for resampled in [thermalpy_resampled, daq_resampled]:
+        if resampled is not None:
+            resampled = time_window(resampled, start=emon_df.index[0], stop=emon_df.index[-1])
+            concat_dfs.append(on_time_axis(resampled, emon_df.index))
     combined_df = pandas.concat(concat_dfs, axis=1)
-    new_cols = []
-    for column in combined_df.columns:
-        if isinstance(column, tuple):
-            new_cols.append('-'.join(column))
-        else:
-            new_cols.append(column)
-    combined_df.columns = new_cols
+    combined_df.columns, column_levels = flatten_columns(combined_df.columns, thermalpy_resampled.columns)
     combined_df = combined_df[combined_df['Frequency[MHz]'].notnull()]
-    combined_df.columns = [c.replace('---', '') for c in combined_df.columns]
-
-    charts = [
-        ScatterChart('EMON CPU0 frequency', ScatterDataSeries(
-            x=combined_df['Frequency0'].index, y=combined_df['Frequency0'],
-            step=True, color='black'), sizehint=SIZE_HINT, markers=False),
-        ScatterChart('ThermalPy CPU0 frequency', ScatterDataSeries(
-            x=combined_df['Frequency[MHz]'].index,
-            y=combined_df['Frequency[MHz]'], step=True, color='blue'),
-                     sizehint=SIZE_HINT, markers=False)
-    ]
-    if daq_trace is not None:
-        charts.insert(1,
-                      ScatterChart('DAQ IA Power', ScatterDataSeries(
-                          x=combined_df['P_IA'].index, y=combined_df['P_IA'],
-                          step=True, color='green'), sizehint=SIZE_HINT, markers=False))
-    combined_state_section = Section('Combined',
-                                     ChartGroup(*charts))
-    report.append(combined_state_section)
-
-    width = int(0.9 / combined_df.index.to_frame().diff().mean())
-    series = combined_df['Frequency0']
-    peaks = find_peaks(series.values, height=0.95 * series.max(), width=width)
-    peaks = list(peaks[0])
-    left_peak_ts = series.index[peaks[0]] + 14
-    right_peak_ts = series.index[peaks[-1]] - 14
-
-    charts = [
-        ScatterChart('EMON CPU0 frequency',
-                     ScatterDataSeries(
-                         x=combined_df['Frequency0'].index, y=combined_df['Frequency0'],
-                         step=True, color='black'),
-                     ScatterDataSeries(
-                         x=[left_peak_ts, left_peak_ts], y=[0, series.max()],
-                         color='red'),
-                     ScatterDataSeries(
-                         x=[right_peak_ts, right_peak_ts], y=[0, series.max()],
-                         color='red'), sizehint=SIZE_HINT, markers=False
-                     ),
-        ScatterChart('ThermalPy CPU0 frequency', ScatterDataSeries(
-            x=combined_df['Frequency[MHz]'].index,
-            y=combined_df['Frequency[MHz]'], step=True, color='blue'),
-                     sizehint=SIZE_HINT, markers=False)
-    ]
-    if daq_trace is not None:
-        charts.insert(1,
-                      ScatterChart('DAQ IA Power',
-                                   ScatterDataSeries(
-                                       x=combined_df['P_IA'].index, y=combined_df['P_IA'],
-                                       step=True, color='green'), sizehint=SIZE_HINT, markers=False
-                                   ))
-
-    chopped_state_section = Section('Chopped',
-                                    ChartGroup(*charts))
-    report.append(chopped_state_section)
-
-    combined_df = combined_df.loc[[x for x in combined_df.index if left_peak_ts <= x <= right_peak_ts]]
-    combined_df.index.name = 'Time[sec]'
-    combined_df.index -= combined_df.index[0]
-
-    charts = [
-        ScatterChart('EMON CPU0 frequency', ScatterDataSeries(
-            x=combined_df['Frequency0'].index, y=combined_df['Frequency0'],
-            step=True, color='black'), sizehint=SIZE_HINT, markers=False),
-        ScatterChart('ThermalPy CPU0 frequency', ScatterDataSeries(
-            x=combined_df['Frequency[MHz]'].index,
-            y=combined_df['Frequency[MHz]'], step=True, color='blue'),
-                     sizehint=SIZE_HINT, markers=False)
-    ]
-    if daq_trace is not None:
-        charts.insert(1,
-                      ScatterChart('DAQ IA Power', ScatterDataSeries(
-                          x=combined_df['P_IA'].index, y=combined_df['P_IA'],
-                          step=True, color='green'), sizehint=SIZE_HINT, markers=False))
-    final_state_section = Section('Final',
-                                  ChartGroup(*charts))
-    report.append(final_state_section)
 
-    if not output_file.endswith('.csv'):
-        output_file += '.csv'
+    if report is not None:
+        charts = trace_charts(combined_df['Frequency0'], combined_df['Frequency[MHz]'],
+                               None if daq_trace is None else combined_df['P_IA'], **chart_options)
+        add_section(report, 'Combined', charts)
 
-    combined_df.to_csv(output_file)
-    print(f'Generated combined trace: {output_file}')
+    with timeline.stage('chop'):
+        left_peak_ts, right_peak_ts = chop_bounds(combined_df['Frequency0'])
 
-    health_report_file = output_file[:-4] + '.html'
-    render_report(report=report, html_file=health_report_file)
-    print(f'Generated health report: {health_report_file}')
+    if report is not None:
+        cut_markers = chop_markers(left_peak_ts, right_peak_ts, combined_df['Frequency0'].max())
+        charts = trace_charts(combined_df['Frequency0'], combined_df['Frequency[MHz]'],
+                               None if daq_trace is None else combined_df['P_IA'], emon_markers=cut_markers,
+                               **chart_options)
+        add_section(report, 'Chopped', charts)
+
+    combined_df = rebase_time(time_window(combined_df, start=left_peak_ts, stop=right_peak_ts))
+    combined_df.index.name = 'Time[sec]'
+
+    if report is not None:
+        charts = trace_charts(combined_df['Frequency0'], combined_df['Frequency[MHz]'],
+                               None if daq_trace is None else combined_df['P_IA'], **chart_options)
+        add_section(report, 'Final', charts)
+
+    system_info = run_system_info(emon_trace, thermalpy_file, thermalpy_raw_file, alignment_cpu, alignment, clock_sync)
+    if dtype_policy:
+        combined_df = apply_dtype_policy(combined_df, dtype_policy)
+    health_report_file = trace_file = index_file = None
+    if output_file is not None:
+        with timeline.stage('write output', format=output_format):
+            output_file = write_combined(combined_df, output_file, output_format=output_format,
+                                         column_levels=column_levels, system_info=system_info)
+        print(f'Generated combined trace: {output_file}')
+        if index_block_rows:
+            with timeline.stage('write index'):
+                index_file = write_index(combined_df, output_file, output_format, block_rows=index_block_rows)
+        health_report_file = render_health_report(report, output_file, timeline)
+        trace_file = write_stage_trace(timeline, output_file)
+    return dict(system_info, output_file=output_file, index_file=index_file, report_file=health_report_file,
+                trace_file=trace_file, combined=combined_df, report=report)
 
 
 def main(argv):
     args = _parse_command_line(argv=argv)
+    cache = None if args.no_cache else TraceCache(args.cache_dir, max_bytes=args.cache_size_mb * 1024 ** 2)
+    clock_sync = None if args.clock_sync is None else read_clock_sync(args.clock_sync)
+    metrics = select_metrics(args.metrics)
+    if args.metrics_file is not None:
+        metrics.update(load_metrics(args.metrics_file))
+
+    timeline = Timeline(profile=args.profile, profile_dir=os.path.dirname(os.path.abspath(args.output_file)))
 
     align(emon_file=args.emon_file, thermalpy_file=args.thermalpy_file, daq_file=args.daq_file,
-          output_file=args.output_file)
+          output_file=args.output_file, coarse_factor=args.coarse_factor, output_format=args.output_format,
+          thermalpy_raw_file=args.thermalpy_raw_file, cache=cache, report_mode=args.report,
+          report_points=args.report_points, report_method=args.report_method, clock_sync=clock_sync,
+          sync_window=args.sync_window, align_cpu=args.align_cpu, metrics=metrics,
+          dtype_policy=DTYPE_POLICIES[args.dtype_policy], chunk_rows=args.chunk_rows,
+          daq_resolution=args.daq_resolution, index_block_rows=args.index_block_rows, timeline=timeline)
+    print(timeline.format())
     return 0
 
 
@@ -0,0 +1,229 @@
+"""
+Readers for ThermaPy captures.
+
+A raw capture (thermapy_raw_data.csv) starts with a key/value header block (ip, thermal_sensors, time_freq, setup, ...)
+terminated by the 'Start token' and 'Start Epoch' lines, followed by the sampled frames. The frames are decoded into a
+per-sample CSV by ThermapyDataParser (from the ThermaPy lab code). Raw captures are often archived as a zip holding
+the single capture CSV; open_capture reads them in place, without extracting the archive.
+
+The parsed CSV is converted once into a columnar cache: a directory with one raw binary file per column and a
+'cache.json' description (column names, row count and the raw capture header). The cache is written in fixed-size
+row chunks, so memory use does not depend on the capture length, and is loaded back as read-only memory maps.
+
+:example:
+
+    >>> header = read_header('thermapy_raw_data.csv')
+    >>> header['time_freq'], header['setup']['Product name']
+    (38400000.0, 'ADL-S C1 (Q8YE)')
+    >>> cache_dir = build_cache('parsed_thermapy_raw_data.csv', header=header)
+    >>> thermalpy_trace = load_cache(cache_dir)
+"""
+import ast
+import csv
+import io
+import json
+import os
+import shutil
+import sys
+import zipfile
+
+import numpy
+import pandas
+
+START_TOKEN = 'Start token'
+START_EPOCH = 'Start Epoch'
+FRAME_KEY = 'IP'
+ARCHIVE_SUFFIX = '.zip'
+
+_FLOAT_KEYS = ('time_freq', START_EPOCH)
+_INT_KEYS = ('chainLength', 'cntrall_numOfBits', 'padding_bits', 'number_of_samples', 'active_idvs',
+             'time_padding_bits')
+
+
+def _convert(key, values):
+    if key == 'setup':
+        try:
+            return ast.literal_eval(values[0])
+        except (ValueError, SyntaxError):
+            return values[0]
+    if key in _FLOAT_KEYS:
+        return float(values[0])
+    if key in _INT_KEYS:
+        return int(values[0])
+    if key == 'thermal_sensors':
+        # name, bit offset pairs
+        return {name: int(offset) for name, offset in zip(values[::2], values[1::2])}
+    if key in ('default_dts_val', 'dts_mask'):
+        return int(values[0], 0)
+    return values[0] if len(values) == 1 else values
+
+
+def parse_header_lines(lines):
+    """
+    Parse the key/value header block of a raw ThermaPy capture.
+
+    :param lines: iterable of text lines, starting at the beginning of the capture
+    :return: dict of header key -> value. 'setup' is returned as a dict, 'thermal_sensors' as a dict of sensor name ->
+        bit offset and the numeric keys as numbers
+    """
+    header = {}
+    for row in csv.reader(lines):
+        if not row:
+            continue
+        key = row[0].strip()
+        if key == FRAME_KEY:
+            break
+        if key == START_TOKEN:
+            header[START_TOKEN] = True
+            continue
+        header[key] = _convert(key, row[1:])
+        if key == START_EPOCH:
+            break
+    return header
+
+
+def open_capture(raw_file):
+    """
+    Open a raw ThermaPy capture for streamed text reading. A zip archive is read in place: its first CSV member is
+    decompressed on the fly.
+
+    :param raw_file: path to the raw capture CSV or to a zip archive holding it
+    :return: text file object
+    """
+    if not raw_file.lower().endswith(ARCHIVE_SUFFIX):
+        return open(raw_file, 'r', newline='')
+    archive = zipfile.ZipFile(raw_file)
+    try:
+        members = [name for name in archive.namelist() if name.lower().endswith('.csv')]
+        if not members:
+            raise ValueError(f'No capture CSV in {raw_file}')
+        # The member keeps its own handle on the archive file, so the archive object can be closed
+        member = archive.open(members[0])
+    finally:
+        archive.close()
+    return io.TextIOWrapper(member, newline='')
+
+
+def read_header(raw_file):
+    """
+    Read the header block of a raw ThermaPy capture without reading the sampled frames.
+
+    :param raw_file: path to the raw capture (CSV or zip archive)
+    :return: dict of header key -> value (see parse_header_lines)
+    """
+    with open_capture(raw_file) as in_file:
+        return parse_header_lines(in_file)
+
+
+CACHE_SUFFIX = '.cache'
+CACHE_INFO_FILE = 'cache.json'
+CACHE_DTYPE = 'float64'
+DEFAULT_CHUNK_ROWS = 262144
+
+
+def cache_path(parsed_file):
+    """
+    Default cache directory of a parsed ThermaPy CSV
+    """
+    return os.path.splitext(parsed_file)[0] + CACHE_SUFFIX
+
+
+def is_cache(path):
+    return os.path.isfile(os.path.join(path, CACHE_INFO_FILE))
+
+
+def build_cache(parsed_file, cache_dir=None, header=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Stream a parsed ThermaPy CSV into a columnar cache.
+
+    The 'Time' column is converted from milliseconds to seconds. Non-numeric columns are dropped.
+
+    :param parsed_file: CSV generated by ThermapyDataParser
+    :param cache_dir: cache directory (default: the CSV path with a '.cache' extension)
+    :param header: raw capture header (see read_header) stored with the cache
+    :param chunk_rows: number of CSV rows converted at once
+    :return: path of the cache directory
+    """
+    cache_dir = cache_dir or cache_path(parsed_file)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    columns = None
+    outputs = []
+    rows = 0
+    try:
+        for chunk in pandas.read_csv(parsed_file, chunksize=chunk_rows):
+            if columns is None:
+                columns = list(chunk.select_dtypes(include='number').columns)
+                outputs = [open(os.path.join(cache_dir, f'column_{i}.bin'), 'wb') for i in range(len(columns))]
+            values = chunk[columns].to_numpy(dtype=CACHE_DTYPE)
+            if 'Time' in columns:
+                values[:, columns.index('Time')] /= 1000
+            for position, output in enumerate(outputs):
+                output.write(numpy.ascontiguousarray(values[:, position]).tobytes())
+            rows += values.shape[0]
+    finally:
+        for output in outputs:
+            output.close()
+
+    info = {
+        'source': os.path.abspath(parsed_file),
+        'columns': columns or [],
+        'rows': rows,
+        'dtype': CACHE_DTYPE,
+        'time_unit': 'sec',
+        'header': header or {}
+    }
+    with open(os.path.join(cache_dir, CACHE_INFO_FILE), 'w') as out_file:
+        json.dump(info, out_file, indent=4)
+    return cache_dir
+
+
+def read_cache_info(cache_dir):
+    with open(os.path.join(cache_dir, CACHE_INFO_FILE), 'r') as in_file:
+        return json.load(in_file)
+
+
+def load_cache(cache_dir):
+    """
+    Load a ThermaPy cache as a frame whose columns are read-only memory maps of the cache files.
+
+    :param cache_dir: cache directory created by build_cache
+    :return: pandas.DataFrame with the parsed columns ('Time' in seconds)
+    """
+    info = read_cache_info(cache_dir)
+    data = {}
+    for position, column in enumerate(info['columns']):
+        path = os.path.join(cache_dir, f'column_{position}.bin')
+        data[column] = numpy.memmap(path, dtype=info['dtype'], mode='r', shape=(info['rows'],)) \
+            if info['rows'] else numpy.empty(0, dtype=info['dtype'])
+    return pandas.DataFrame(data, copy=False)
+
+
+def parse_capture(raw_file, parsed_file, lab_path, cache_dir=None):
+    """
+    Decode a raw ThermaPy capture with ThermapyDataParser and convert the result into a columnar cache.
+
+    ThermapyDataParser reads the capture from a path, so a zipped capture is streamed into a temporary CSV next to
+    the parsed output for the duration of the decode.
+
+    :param raw_file: raw capture CSV or zip archive holding it
+    :param parsed_file: path of the parsed CSV written by ThermapyDataParser
+    :param lab_path: ThermaPy lab code path
+    :param cache_dir: cache directory (default: see build_cache)
+    :return: path of the cache directory
+    """
+    if lab_path not in sys.path:
+        sys.path.append(lab_path)
+    from thermapy_app_parser.thermapy_data_parse import ThermapyDataParser
+
+    input_file = raw_file
+    if raw_file.lower().endswith(ARCHIVE_SUFFIX):
+        input_file = os.path.splitext(parsed_file)[0] + '_raw.csv'
+        with open_capture(raw_file) as member, open(input_file, 'w', newline='') as out_file:
+            shutil.copyfileobj(member, out_file)
+    try:
+        ThermapyDataParser().parse_file(input_file=input_file, output_file=parsed_file)
+    finally:
+        if input_file != raw_file:
+            os.remove(input_file)
+    return build_cache(parsed_file, cache_dir=cache_dir, header=read_header(raw_file))
@@ -0,0 +1,84 @@
+"""
+Helpers for frames indexed by a sorted time axis.
+
+Time windows are located with a binary search on the index and taken as positional slices, so trimming a wide frame
+does not scan the index in Python or fancy-index (copy) every column; pandas returns views for such slices where it
+can. Index shifts replace only the index, never the column data.
+"""
+import numpy
+import pandas
+
+
+def window_bounds(index, start=None, stop=None):
+    """
+    Positional bounds of the rows with start <= t <= stop in a sorted time index.
+
+    :param index: sorted time index (pandas.Index or array)
+    :param start: window start (None for the beginning of the index)
+    :param stop: window end, inclusive (None for the end of the index)
+    :return: (first, last) positions to slice with
+    """
+    values = numpy.asarray(index)
+    first = 0 if start is None else int(numpy.searchsorted(values, start, side='left'))
+    last = values.shape[0] if stop is None else int(numpy.searchsorted(values, stop, side='right'))
+    return first, max(first, last)
+
+
+def time_window(df, start=None, stop=None):
+    """
+    Rows of a time-indexed frame with start <= t <= stop.
+
+    :param df: pandas.DataFrame or pandas.Series with a sorted time index
+    :param start: window start (None for the beginning of the frame)
+    :param stop: window end, inclusive (None for the end of the frame)
+    :return: positional slice of the frame
+    """
+    if not df.index.is_monotonic_increasing:
+        raise ValueError('time_window requires a sorted time index')
+    first, last = window_bounds(df.index.values, start, stop)
+    return df.iloc[first:last]
+
+
+def shift_time(df, delta=0.0, decimals=None):
+    """
+    Shift (and optionally round) the time index of the frame in place, keeping the index name.
+
+    :param df: pandas.DataFrame or pandas.Series
+    :param delta: value added to every index point
+    :param decimals: round the shifted index to this number of decimals
+    :return: the same frame
+    """
+    values = df.index.values + delta
+    if decimals is not None:
+        values = numpy.round(values, decimals)
+    df.index = pandas.Index(values, name=df.index.name)
+    return df
+
+
+def rebase_time(df):
+    """
+    Shift the time index of the frame in place so that it starts at 0.
+    """
+    if df.shape[0]:
+        shift_time(df, -df.index.values[0])
+    return df
+
+
+def on_time_axis(df, axis):
+    """
+    Place a frame whose index points come from "axis" onto that axis, so frames sharing the axis can be combined
+    without joining their indexes. Axis points missing from the frame are NaN.
+
+    :param df: pandas.DataFrame indexed by a subset of the axis points
+    :param axis: sorted time index
+    :return: pandas.DataFrame indexed by "axis"
+    """
+    axis_values = numpy.asarray(axis)
+    positions = numpy.searchsorted(axis_values, df.index.values)
+    if numpy.any(positions >= axis_values.shape[0]) or \
+            numpy.any(axis_values[numpy.minimum(positions, axis_values.shape[0] - 1)] != df.index.values):
+        raise ValueError('Frame index points are not on the time axis')
+
+    values = numpy.full((axis_values.shape[0], df.shape[1]), numpy.nan)
+    values[positions] = df.to_numpy(dtype=float)
+    return pandas.DataFrame(values, index=axis, columns=df.columns)
@@ -0,0 +1,199 @@
+"""
+Content-addressed on-disk cache for parsed traces and alignment results.
+
+Entries are keyed by the SHA-256 of the input file contents together with the parser version and the stage
+parameters, so editing an input file, upgrading a parser or changing a parameter simply misses the cache. Each entry
+is a directory holding an 'entry.json' description and, for frames, 'index.npy'/'values.npy' arrays that are loaded
+back as read-only memory maps. Entries are written to a temporary directory and renamed into place, so parallel
+runs sharing a cache directory never see partial entries. When the cache grows beyond its size budget the least
+recently used entries are evicted.
+
+:example:
+
+    >>> cache = TraceCache(r'C:\\Temp\\wl_sampler_cache')
+    >>> key = cache.key('emon', emon_parser.PARSER_VERSION, file_digest('emon_raw_data.txt'))
+    >>> frame, info = cache.get_frame(key) or (None, None)
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy
+import pandas
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.wl_sampler_cache')
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+ENTRY_FILE = 'entry.json'
+_READ_BLOCK = 1024 * 1024
+
+
+def file_digest(path):
+    """
+    SHA-256 of a file's contents, or of every file of a directory (in sorted relative path order).
+    """
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    else:
+        paths = [path]
+    for file_path in paths:
+        if len(paths) > 1:
+            digest.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, 'rb') as in_file:
+            for block in iter(lambda: in_file.read(_READ_BLOCK), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def trace_key(name, version, digest):
+    """
+    Cache key of a parsed input trace: the trace kind ('emon', 'thermalpy', 'daq'), its loader version and the digest
+    of the input file (see file_digest)
+    """
+    return TraceCache.key(name, version, digest)
+
+
+def _encode_columns(columns):
+    return [list(column) if isinstance(column, tuple) else column for column in columns]
+
+
+def _decode_columns(columns, names):
+    if columns and isinstance(columns[0], list):
+        return pandas.MultiIndex.from_tuples([tuple(column) for column in columns], names=names)
+    return pandas.Index(columns)
+
+
+class TraceCache:
+    """
+    Size-bounded LRU cache of parsed traces (pandas.DataFrame) and JSON-serializable stage results.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """
+        Build an entry key from its parts (digests, versions, parameters)
+        """
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _read_entry(self, key):
+        entry_file = os.path.join(self._entry_dir(key), ENTRY_FILE)
+        try:
+            with open(entry_file, 'r') as in_file:
+                entry = json.load(in_file)
+            # mark as recently used
+            os.utime(entry_file)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def _write_entry(self, key, entry, arrays=None):
+        temp_dir = self._entry_dir(f'{key}.tmp-{uuid.uuid4().hex}')
+        os.makedirs(temp_dir)
+        try:
+            for name, array in (arrays or {}).items():
+                numpy.save(os.path.join(temp_dir, f'{name}.npy'), array, allow_pickle=False)
+            with open(os.path.join(temp_dir, ENTRY_FILE), 'w') as out_file:
+                json.dump(entry, out_file)
+            try:
+                os.rename(temp_dir, self._entry_dir(key))
+            except OSError:
+                # another process stored the same entry first
+                pass
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self.evict()
+
+    def get(self, key):
+        """
+        :return: the JSON value stored under the key, or None
+        """
+        entry = self._read_entry(key)
+        return None if entry is None else entry.get('value')
+
+    def put(self, key, value):
+        """
+        Store a JSON-serializable value under the key
+        """
+        self._write_entry(key, {'kind': 'value', 'value': value})
+
+    def get_frame(self, key):
+        """
+        :return: (pandas.DataFrame backed by read-only memory maps, info dict) stored under the key, or None
+        """
+        entry = self._read_entry(key)
+        if entry is None or entry.get('kind') != 'frame':
+            return None
+        entry_dir = self._entry_dir(key)
+        try:
+            index = numpy.load(os.path.join(entry_dir, 'index.npy'), mmap_mode='r')
+            values = numpy.load(os.path.join(entry_dir, 'values.npy'), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        frame = pandas.DataFrame(values, index=pandas.Index(index, name=entry['index_name']),
+                                 columns=_decode_columns(entry['columns'], entry['column_names']), copy=False)
+        return frame, entry['info']
+
+    def put_frame(self, key, frame, info=None):
+        """
+        Store a frame with a numeric index and a single numeric dtype under the key. Other frames are not cached.
+
+        :param frame: pandas.DataFrame
+        :param info: JSON-serializable dict stored with the frame
+        :return: True if the frame was stored
+        """
+        values = frame.to_numpy()
+        if values.dtype.kind not in 'iuf' or frame.index.dtype.kind not in 'iuf':
+            return False
+        entry = {
+            'kind': 'frame',
+            'index_name': frame.index.name,
+            'columns': _encode_columns(frame.columns),
+            'column_names': list(frame.columns.names),
+            'info': info or {}
+        }
+        self._write_entry(key, entry, arrays={'index': frame.index.values, 'values': values})
+        return True
+
+    def entries(self):
+        """
+        :return: dict of key -> (last use time, size in bytes) of the complete entries
+        """
+        entries = {}
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(key)
+            entry_file = os.path.join(entry_dir, ENTRY_FILE)
+            if '.tmp-' in key or not os.path.isfile(entry_file):
+                continue
+            try:
+                used = os.path.getmtime(entry_file)
+                size = sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+            except OSError:
+                continue
+            entries[key] = (used, size)
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits its size budget
+        """
+        entries = self.entries()
+        total = sum(size for _, size in entries.values())
+        for key, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
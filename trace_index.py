@@ -0,0 +1,383 @@
+"""
+Time-range index of a combined trace, for reading one phase of a run without loading the whole trace.
+
+The index is a small JSON sidecar next to the trace ('<trace>.index.json', e.g. 'out.csv.index.json'). It splits
+the trace rows into fixed-size blocks and stores for every block its row range, its time range and the min, max, mean
+and sample count of the key columns (the alignment frequencies, the DAQ IA power and the DTS temperatures by
+default). It also stores where the blocks are in the file: the byte offset of the first row of every block for CSV,
+and the row counts of the row groups (parquet) or record batches (feather) that hold them.
+
+query reads only the blocks overlapping a time range (npz traces, which can not be read partially, are loaded whole)
+and summarize answers coarse summary queries from the block statistics alone, without reading any sample.
+
+:example:
+
+    >>> index_file = write_index(combined_df, 'out.csv', 'csv')
+    >>> window = query('out.csv', start=120.0, stop=180.0, columns=['Frequency0', 'P_IA'])
+    >>> summarize('out.csv', start=120.0, stop=180.0)
+
+    python trace_index.py out.csv --start 120 --stop 180 --columns Frequency0 "DTS*" --output phase.csv
+"""
+import argparse
+import fnmatch
+import io
+import json
+import os
+import sys
+
+import numpy
+import pandas
+
+from time_axis import time_window
+from trace_output import read_combined
+
+INDEX_SUFFIX = '.index.json'
+INDEX_VERSION = 1
+DEFAULT_BLOCK_ROWS = 4096
+DEFAULT_INDEX_COLUMNS = ('Frequency0', 'Frequency[MHz]', 'P_IA', 'DTS*')
+_READ_BLOCK = 1 << 24
+
+
+def index_path(trace_file):
+    """
+    Sidecar index path of a combined trace (keeps the trace extension, so traces of different formats written to the
+    same base name have their own index)
+    """
+    return trace_file + INDEX_SUFFIX
+
+
+def _trace_format(trace_file):
+    """
+    Output format of a combined trace, from its extension
+    """
+    return os.path.splitext(trace_file)[1][1:].lower()
+
+
+def resolve_columns(columns, patterns):
+    """
+    :param patterns: column names or fnmatch patterns of column names
+    :return: the columns matching any of the patterns, in column order
+    """
+    # names such as 'Frequency[MHz]' are also taken literally, not as a character class
+    return [column for column in columns
+            if any(str(column) == pattern or fnmatch.fnmatchcase(str(column), pattern) for pattern in patterns)]
+
+
+def _block_stats(df):
+    stats = {}
+    values = df.to_numpy(dtype=float)
+    counts = numpy.count_nonzero(~numpy.isnan(values), axis=0)
+    with numpy.errstate(invalid='ignore'):
+        mins, maxs, means = numpy.nanmin(values, axis=0), numpy.nanmax(values, axis=0), numpy.nanmean(values, axis=0)
+    for position, column in enumerate(df.columns):
+        if counts[position]:
+            stats[column] = {'min': float(mins[position]), 'max': float(maxs[position]),
+                             'mean': float(means[position]), 'count': int(counts[position])}
+    return stats
+
+
+class TraceIndexer:
+    """
+    Builds the index of a combined trace from the frame (or the chunks of the frame) that is written.
+
+    :ivar blocks: list of block dicts ('rows', 'time' and 'stats')
+    """
+
+    def __init__(self, block_rows=DEFAULT_BLOCK_ROWS, columns=DEFAULT_INDEX_COLUMNS):
+        """
+        :param block_rows: number of trace rows per block
+        :param columns: fnmatch patterns of the columns with block statistics
+        """
+        if block_rows <= 0:
+            raise ValueError(f'Invalid index block size: {block_rows}')
+        self.block_rows = block_rows
+        self.patterns = columns
+        self.blocks = []
+        self.rows = 0
+        self.index_name = None
+        self.columns = None
+        self.stats_columns = []
+        self._pending = None
+
+    def add(self, df):
+        """
+        Add the next rows of the trace, indexed by time with flattened column names.
+        """
+        if self.columns is None:
+            self.index_name = df.index.name
+            self.columns = [str(column) for column in df.columns]
+            self.stats_columns = resolve_columns(df.columns, self.patterns)
+        df = df[self.stats_columns]
+        if self._pending is not None:
+            df = pandas.concat([self._pending, df])
+        whole = df.shape[0] - df.shape[0] % self.block_rows
+        for start in range(0, whole, self.block_rows):
+            self._add_block(df.iloc[start:start + self.block_rows])
+        self._pending = df.iloc[whole:]
+
+    def _add_block(self, df):
+        first = self.rows
+        self.rows += df.shape[0]
+        self.blocks.append({'rows': [first, self.rows],
+                            'time': [float(df.index[0]), float(df.index[-1])],
+                            'stats': _block_stats(df)})
+
+    def finish(self):
+        """
+        Close the last (partial) block
+        """
+        if self._pending is not None and self._pending.shape[0]:
+            self._add_block(self._pending)
+        self._pending = None
+
+    def write(self, trace_file, output_format):
+        """
+        Write the sidecar index of the written trace file.
+
+        :return: path of the index file
+        """
+        self.finish()
+        index = {
+            'version': INDEX_VERSION,
+            'trace': os.path.basename(trace_file),
+            'format': output_format,
+            'rows': self.rows,
+            'block_rows': self.block_rows,
+            'index': self.index_name,
+            'columns': self.columns or [],
+            'stats_columns': [str(column) for column in self.stats_columns],
+            'blocks': self.blocks,
+        }
+        if output_format == 'csv':
+            offsets = _csv_row_offsets(trace_file, [block['rows'][0] for block in self.blocks])
+            for block, offset in zip(self.blocks, offsets):
+                block['offset'] = offset
+            index['size'] = os.path.getsize(trace_file)
+        elif output_format in ('parquet', 'feather'):
+            index['groups'] = _group_rows(trace_file, output_format)
+
+        path = index_path(trace_file)
+        with open(path, 'w') as out_file:
+            json.dump(index, out_file, indent=1)
+        return path
+
+
+def _csv_row_offsets(path, rows):
+    """
+    Byte offsets of the given (sorted) data rows of a CSV file with a single header line
+    """
+    # Row r starts after the line break of index r (the first line break ends the header)
+    wanted = numpy.asarray(rows, dtype=numpy.int64)
+    offsets = numpy.zeros(wanted.shape[0], dtype=numpy.int64)
+    found = 0
+    breaks = 0
+    position = 0
+    with open(path, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(_READ_BLOCK), b''):
+            if found == wanted.shape[0]:
+                break
+            ends = numpy.flatnonzero(numpy.frombuffer(block, dtype=numpy.uint8) == ord('\n'))
+            count = numpy.searchsorted(wanted, breaks + ends.shape[0], side='left') - found
+            offsets[found:found + count] = position + ends[wanted[found:found + count] - breaks] + 1
+            found += count
+            breaks += ends.shape[0]
+            position += len(block)
+    return offsets[:found].tolist()
+
+
+def _group_rows(path, output_format):
+    """
+    Row counts of the parquet row groups or of the feather record batches
+    """
+    if output_format == 'parquet':
+        import pyarrow.parquet
+        metadata = pyarrow.parquet.ParquetFile(path).metadata
+        return [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    import pyarrow
+    import pyarrow.ipc
+    with pyarrow.memory_map(path) as source:
+        reader = pyarrow.ipc.open_file(source)
+        return [reader.get_batch(i).num_rows for i in range(reader.num_record_batches)]
+
+
+def write_index(df, trace_file, output_format, block_rows=DEFAULT_BLOCK_ROWS, columns=DEFAULT_INDEX_COLUMNS):
+    """
+    Write the sidecar index of a combined trace written from a frame.
+
+    :param df: the written frame, indexed by time with flattened column names
+    :return: path of the index file
+    """
+    indexer = TraceIndexer(block_rows=block_rows, columns=columns)
+    indexer.add(df)
+    return indexer.write(trace_file, output_format)
+
+
+def build_index(trace_file, block_rows=DEFAULT_BLOCK_ROWS, columns=DEFAULT_INDEX_COLUMNS):
+    """
+    Index an existing combined trace (reads it whole once)
+
+    :return: path of the index file
+    """
+    df, _ = read_combined(trace_file)
+    return write_index(df, trace_file, _trace_format(trace_file), block_rows=block_rows, columns=columns)
+
+
+def read_index(trace_file):
+    """
+    :return: the index dict of a combined trace
+    :raise FileNotFoundError: if the trace has no index (see build_index)
+    :raise ValueError: if the index is of another version, or does not describe the trace file as it is now (another
+        format, or a CSV trace rewritten since it was indexed) - rebuild it with build_index
+    """
+    with open(index_path(trace_file), 'r') as in_file:
+        index = json.load(in_file)
+    if index.get('version') != INDEX_VERSION:
+        raise ValueError(f'Unsupported trace index version {index.get("version")} of {trace_file}')
+    trace_format = _trace_format(trace_file)
+    if index.get('format') != trace_format:
+        raise ValueError(f'Trace index of {trace_file} describes a {index.get("format")} trace, not {trace_format}, '
+                         f'rebuild it with build_index')
+    if trace_format == 'csv' and index.get('size') != os.path.getsize(trace_file):
+        raise ValueError(f'Trace index of {trace_file} is stale ({index.get("size")} bytes indexed, '
+                         f'{os.path.getsize(trace_file)} bytes in the file), rebuild it with build_index')
+    return index
+
+
+def select_blocks(index, start=None, stop=None):
+    """
+    :return: the blocks whose time range overlaps start <= t <= stop
+    """
+    return [block for block in index['blocks']
+            if (start is None or block['time'][1] >= start) and (stop is None or block['time'][0] <= stop)]
+
+
+def _read_csv_rows(trace_file, index, blocks, columns):
+    first = blocks[0]['offset']
+    last = index['blocks'].index(blocks[-1]) + 1
+    stop = index['blocks'][last]['offset'] if last < len(index['blocks']) else index['size']
+    with open(trace_file, 'rb') as in_file:
+        header = in_file.readline()
+        in_file.seek(first)
+        data = in_file.read(stop - first)
+    usecols = None if columns is None else [index['index']] + columns
+    return pandas.read_csv(io.BytesIO(header + data), index_col=0, usecols=usecols)
+
+
+def _read_groups(trace_file, index, blocks, columns):
+    """
+    Read the row groups (record batches) holding the rows of the blocks
+    """
+    import pyarrow
+
+    first, stop = blocks[0]['rows'][0], blocks[-1]['rows'][1]
+    bounds = numpy.concatenate([[0], numpy.cumsum(index['groups'])])
+    groups = list(range(int(numpy.searchsorted(bounds, first, side='right')) - 1,
+                        int(numpy.searchsorted(bounds, stop, side='left'))))
+    selected = None if columns is None else [index['index']] + columns
+    if index['format'] == 'parquet':
+        import pyarrow.parquet
+        table = pyarrow.parquet.ParquetFile(trace_file).read_row_groups(groups, columns=selected,
+                                                                        use_pandas_metadata=True)
+    else:
+        import pyarrow.ipc
+        with pyarrow.memory_map(trace_file) as source:
+            reader = pyarrow.ipc.open_file(source)
+            table = pyarrow.Table.from_batches([reader.get_batch(group) for group in groups], schema=reader.schema)
+            if selected is not None:
+                table = table.select(selected)
+    return table.to_pandas()
+
+
+def query(trace_file, start=None, stop=None, columns=None):
+    """
+    Read a time window of a combined trace, reading only the blocks that overlap it.
+
+    :param trace_file: combined trace with a sidecar index
+    :param start: window start [sec] (None for the beginning of the trace)
+    :param stop: window end, inclusive [sec] (None for the end of the trace)
+    :param columns: fnmatch patterns of the columns to read (None for all)
+    :return: pandas.DataFrame indexed by time
+    """
+    index = read_index(trace_file)
+    if columns is not None:
+        columns = resolve_columns(index['columns'], columns)
+    blocks = select_blocks(index, start, stop)
+    if not blocks:
+        return pandas.DataFrame(columns=index['columns'] if columns is None else columns,
+                                index=pandas.Index([], name=index['index'], dtype=float), dtype=float)
+
+    if index['format'] == 'csv':
+        df = _read_csv_rows(trace_file, index, blocks, columns)
+    elif index['format'] in ('parquet', 'feather'):
+        df = _read_groups(trace_file, index, blocks, columns)
+    else:
+        df, _ = read_combined(trace_file)
+        if columns is not None:
+            df = df[columns]
+    return time_window(df, start=start, stop=stop)
+
+
+def summarize(trace_file, start=None, stop=None, columns=None):
+    """
+    Summary of the key columns over a time window, from the block statistics only. The statistics cover the whole
+    blocks that overlap the window, so they may include up to one block of samples outside each end of it.
+
+    :param columns: fnmatch patterns of the columns (None for all the columns with block statistics)
+    :return: pandas.DataFrame with a row per column and min, max, mean, count, start and stop (the time range
+        covered) columns
+    """
+    index = read_index(trace_file)
+    names = index['stats_columns'] if columns is None else resolve_columns(index['stats_columns'], columns)
+    blocks = select_blocks(index, start, stop)
+    rows = {}
+    for name in names:
+        stats = [block['stats'][name] for block in blocks if name in block['stats']]
+        count = sum(item['count'] for item in stats)
+        rows[name] = {
+            'min': min((item['min'] for item in stats), default=numpy.nan),
+            'max': max((item['max'] for item in stats), default=numpy.nan),
+            'mean': sum(item['mean'] * item['count'] for item in stats) / count if count else numpy.nan,
+            'count': count,
+            'start': blocks[0]['time'][0] if blocks else numpy.nan,
+            'stop': blocks[-1]['time'][1] if blocks else numpy.nan,
+        }
+    return pandas.DataFrame.from_dict(rows, orient='index', columns=['min', 'max', 'mean', 'count', 'start', 'stop'])
+
+
+def _parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description="Read a time window of a combined trace through its sidecar index",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("trace_file", help="Combined trace (csv, parquet, feather or npz)")
+    parser.add_argument("--start", type=float, default=None, help="Window start [sec]")
+    parser.add_argument("--stop", type=float, default=None, help="Window end [sec]")
+    parser.add_argument("--columns", nargs='*', default=None,
+                        help="Columns to read (fnmatch patterns, e.g. 'DTS*'; default: all)")
+    parser.add_argument("--summary", action='store_true',
+                        help="Print the block statistics summary of the window instead of reading samples")
+    parser.add_argument("--output", "-o", default=None, help="CSV file of the window (default: print it)")
+    parser.add_argument("--build", action='store_true', help="(Re)build the index of the trace first")
+    parser.add_argument("--block-rows", type=int, default=DEFAULT_BLOCK_ROWS,
+                        help="Rows per block of a built index")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = _parse_command_line(argv)
+    if args.build or not os.path.isfile(index_path(args.trace_file)):
+        print(f'Indexed {args.trace_file}: {build_index(args.trace_file, block_rows=args.block_rows)}')
+    if args.summary:
+        print(summarize(args.trace_file, start=args.start, stop=args.stop, columns=args.columns).to_string())
+        return 0
+    window = query(args.trace_file, start=args.start, stop=args.stop, columns=args.columns)
+    if args.output:
+        window.to_csv(args.output)
+        print(f'Wrote {window.shape[0]} rows to {args.output}')
+    else:
+        print(window.to_string())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,265 @@
+"""
+Writers (and a reader) for the combined EMON/ThermaPy/DAQ trace.
+
+CSV keeps the flattened 'package-core_type-CPU-event' column names and is written in row chunks with a fixed float
+format. The binary formats (parquet and feather through pyarrow, npz through numpy) are written in row groups /
+record batches and additionally store, as JSON metadata:
+
+* 'columns': the column hierarchy, one dict per column with its source ('emon', 'thermalpy', 'daq') and, for EMON
+  counters, its package, core_type, CPU and event
+* 'system_info': the run information (tsc_freq, emon db, thermapy setup, alignment offsets, ...)
+
+A CombinedWriter appends the trace chunk by chunk (csv, parquet and feather), for traces combined out of core.
+
+The column dtypes can be narrowed with a dtype policy: an ordered list of (column pattern, dtype) pairs, where a column
+takes the dtype of the first matching fnmatch pattern whose dtype is of the same kind (integer or floating point) as
+the column, and columns without such a pattern keep their dtype. The 'compact' policy stores EMON counters (the
+counts of one sample interval) as uint32 and every other value as float32.
+
+:example:
+
+    >>> write_combined(combined_df, 'out.parquet', output_format='parquet', column_levels=levels, system_info=info)
+    >>> combined_df, metadata = read_combined('out.parquet')
+"""
+import fnmatch
+import json
+import os
+
+import numpy
+import pandas
+
+OUTPUT_FORMATS = ('csv', 'parquet', 'feather', 'npz')
+DEFAULT_CHUNK_ROWS = 65536
+DEFAULT_FLOAT_FORMAT = '%.6f'
+METADATA_KEY = b'wl_sampler'
+
+DTYPE_POLICIES = {
+    'keep': [],
+    'compact': [
+        ('package*', 'uint32'),
+        ('*', 'float32'),
+    ],
+}
+
+
+def output_path(output_file, output_format):
+    """
+    Return the output file name with the extension of the output format.
+    """
+    extension = f'.{output_format}'
+    if not output_file.endswith(extension):
+        output_file += extension
+    return output_file
+
+
+def build_metadata(columns, column_levels=None, system_info=None, index_name=None):
+    """
+    Build the JSON-serializable metadata stored with the binary formats.
+
+    :param columns: flattened column names
+    :param column_levels: dict of column name -> dict describing the column (source, package, core_type, CPU, event)
+    :param system_info: dict of run information
+    :param index_name: name of the time index
+    """
+    column_levels = column_levels or {}
+    return {
+        'index': index_name,
+        'columns': [dict(name=column, **column_levels.get(column, {})) for column in columns],
+        'system_info': system_info or {}
+    }
+
+
+def resolve_dtypes(dtypes, policy):
+    """
+    Map every column to its dtype under a dtype policy.
+
+    :param dtypes: dict (or pandas.Series) of column name -> current dtype
+    :param policy: ordered sequence of (fnmatch pattern, dtype) pairs
+    :return: dict of column -> new dtype, for the columns the policy changes
+    """
+    resolved = {}
+    for column, dtype in dict(dtypes).items():
+        for pattern, target in policy:
+            target = numpy.dtype(target)
+            if fnmatch.fnmatchcase(str(column), pattern) and \
+                    numpy.issubdtype(dtype, numpy.integer) == numpy.issubdtype(target, numpy.integer) and \
+                    numpy.issubdtype(dtype, numpy.number):
+                if target != dtype:
+                    resolved[column] = target
+                break
+    return resolved
+
+
+def apply_dtype_policy(df, policy):
+    """
+    Narrow the column dtypes of a frame with a dtype policy (see resolve_dtypes).
+
+    :raise ValueError: if the values of an integer column do not fit its new dtype
+    :return: the converted frame
+    """
+    dtypes = resolve_dtypes(df.dtypes, policy)
+    for column, dtype in dtypes.items():
+        if numpy.issubdtype(dtype, numpy.integer) and df.shape[0]:
+            info = numpy.iinfo(dtype)
+            values = df[column].to_numpy()
+            if values.min() < info.min or values.max() > info.max:
+                raise ValueError(f'Values of column {column} do not fit {dtype}')
+    return df.astype(dtypes) if dtypes else df
+
+
+def _chunks(df, chunk_rows):
+    for start in range(0, max(df.shape[0], 1), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+
+def _write_csv(df, path, chunk_rows, float_format):
+    df.to_csv(path, float_format=float_format, chunksize=chunk_rows)
+
+
+def _arrow_writer(df, path, metadata, output_format):
+    """
+    :return: (parquet or Arrow IPC file writer, schema of the frame with the metadata)
+    """
+    import pyarrow
+
+    schema = pyarrow.Schema.from_pandas(df, preserve_index=True)
+    schema = schema.with_metadata({**(schema.metadata or {}), METADATA_KEY: json.dumps(metadata).encode()})
+
+    if output_format == 'parquet':
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(path, schema), schema
+    # Feather V2 is the Arrow IPC file format
+    import pyarrow.ipc
+    return pyarrow.ipc.new_file(path, schema), schema
+
+
+def _write_arrow(df, path, metadata, chunk_rows, output_format):
+    import pyarrow
+
+    writer, schema = _arrow_writer(df, path, metadata, output_format)
+    with writer:
+        for chunk in _chunks(df, chunk_rows):
+            writer.write_table(pyarrow.Table.from_pandas(chunk, schema=schema, preserve_index=True))
+
+
+def _write_npz(df, path, metadata):
+    numpy.savez(path,
+                time=df.index.values,
+                values=df.to_numpy(dtype=float),
+                columns=numpy.array(df.columns, dtype=str),
+                metadata=numpy.array(json.dumps(metadata)))
+
+
+def write_combined(df, output_file, output_format='csv', column_levels=None, system_info=None,
+                   chunk_rows=DEFAULT_CHUNK_ROWS, float_format=DEFAULT_FLOAT_FORMAT):
+    """
+    Write the combined trace in the requested format.
+
+    :param df: combined trace indexed by time with flattened column names
+    :param output_file: output path (the format extension is appended if missing)
+    :param output_format: one of OUTPUT_FORMATS
+    :param column_levels: dict of column name -> dict describing the column (binary formats only)
+    :param system_info: dict of run information (binary formats only)
+    :param chunk_rows: number of rows written at once
+    :param float_format: float format of the CSV output
+    :return: path of the written file
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Unsupported output format: {output_format}')
+
+    path = output_path(output_file, output_format)
+    if output_format == 'csv':
+        _write_csv(df, path, chunk_rows, float_format)
+        return path
+
+    metadata = build_metadata(df.columns, column_levels=column_levels, system_info=system_info,
+                              index_name=df.index.name)
+    if output_format == 'npz':
+        _write_npz(df, path, metadata)
+    else:
+        _write_arrow(df, path, metadata, chunk_rows, output_format)
+    return path
+
+
+class CombinedWriter:
+    """
+    Appends the combined trace to the output file chunk by chunk. Every chunk must have the columns (and dtypes) of
+    the first one. The npz format can not be appended to and is not supported.
+
+    :example:
+
+        >>> with CombinedWriter('out.parquet', 'parquet', column_levels=levels, system_info=info) as writer:
+        ...     for chunk in chunks:
+        ...         writer.write(chunk)
+
+    :ivar path: path of the written file
+    :ivar rows: number of rows written so far
+    """
+
+    def __init__(self, output_file, output_format='csv', column_levels=None, system_info=None,
+                 float_format=DEFAULT_FLOAT_FORMAT):
+        if output_format not in OUTPUT_FORMATS or output_format == 'npz':
+            raise ValueError(f'Unsupported chunked output format: {output_format}')
+        self.output_format = output_format
+        self.path = output_path(output_file, output_format)
+        self.column_levels = column_levels
+        self.system_info = system_info
+        self.float_format = float_format
+        self.rows = 0
+        self._writer = None
+        self._schema = None
+
+    def write(self, df):
+        """
+        Append a chunk indexed by time with flattened column names.
+        """
+        if self.output_format == 'csv':
+            df.to_csv(self.path, mode='a' if self.rows else 'w', header=not self.rows, float_format=self.float_format)
+        else:
+            import pyarrow
+            if self._writer is None:
+                metadata = build_metadata(df.columns, column_levels=self.column_levels, system_info=self.system_info,
+                                          index_name=df.index.name)
+                self._writer, self._schema = _arrow_writer(df, self.path, metadata, self.output_format)
+            self._writer.write_table(pyarrow.Table.from_pandas(df, schema=self._schema, preserve_index=True))
+        self.rows += df.shape[0]
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_combined(path):
+    """
+    Read a combined trace written by write_combined.
+
+    :param path: path to a .csv, .parquet, .feather or .npz combined trace
+    :return: (pandas.DataFrame indexed by time, metadata dict - empty for CSV)
+    """
+    output_format = os.path.splitext(path)[1][1:]
+    if output_format == 'csv':
+        return pandas.read_csv(path, index_col=0), {}
+
+    if output_format == 'npz':
+        with numpy.load(path) as npz:
+            metadata = json.loads(str(npz['metadata']))
+            index = pandas.Index(npz['time'], name=metadata.get('index'))
+            return pandas.DataFrame(npz['values'], index=index, columns=list(npz['columns'])), metadata
+
+    if output_format == 'parquet':
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path)
+    elif output_format == 'feather':
+        import pyarrow.feather
+        table = pyarrow.feather.read_table(path)
+    else:
+        raise ValueError(f'Unsupported output format: {output_format}')
+    metadata = json.loads(table.schema.metadata.get(METADATA_KEY, b'{}'))
+    return table.to_pandas(), metadata
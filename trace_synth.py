@@ -0,0 +1,344 @@
+"""
+Synthetic run traces for benchmarking the alignment pipeline on runs of any length.
+
+A run is generated on a common (host) time line starting at the ThermaPy capture start: an idle lead, a DAQAlign-like
+pattern of full-frequency pulses, the workload, a second pattern and an idle tail. The traces sample the same CPU
+frequency with their own noise, rate and start time:
+
+* EMON -V trace (emon_raw_data.txt) with the counters of the examples for every logical CPU, on bigcore and optionally
+  smallcore CPUs. CPU_CLK_UNHALTED.THREAD / REF_TSC follows the frequency
+* parsed ThermaPy CSV (parsed_thermapy_raw_data.csv) with the columns of ThermapyDataParser
+* raw ThermaPy capture (thermapy_raw_data.csv or .zip) with a real header and frame layout. The IDV payloads are random,
+  so it is only meant for the capture reading paths (the lab code would not decode it to the parsed CSV values)
+* DAQ CSV (daq.csv) whose P_IA follows the frequency
+
+'synth.json' describes the run, including the 'shifts' of the EMON and DAQ time stamps against the ThermaPy time line,
+from which expected_offset gives the offsets align() should find.
+
+:example:
+
+    python trace_synth.py --output-dir synth_1h --duration 3600 --cpus 8 --smallcores 8
+
+    >>> run = generate_run('synth_1h', duration=3600)
+    >>> align(run['emon_file'], run['thermalpy_file'], run['daq_file'], 'out.csv')
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import zipfile
+
+import numpy
+import pandas
+
+EVENTS = ['INST_RETIRED.ANY', 'CPU_CLK_UNHALTED.THREAD', 'CPU_CLK_UNHALTED.REF_TSC', 'DTLB_LOAD_MISSES.WALK_PENDING',
+          'TOPDOWN.SLOTS:perf_metrics', 'IDQ.DSB_UOPS:u0x2C', 'L1D.REPLACEMENT', 'L2_RQSTS.REFERENCES',
+          'FP_ARITH_DISPATCHED.PORT_0:u0x43', 'UOPS_EXECUTED.CORE']
+TSC_FREQ = 2419.2e6
+MAX_FREQUENCY = 4800.0
+IDLE_FREQUENCY = 800.0
+WORKLOAD_FREQUENCY = (2000.0, 4300.0)
+
+# DAQAlign-like pattern: pulses at the maximal frequency
+ALIGN_PULSES = 5
+ALIGN_PULSE_DURATION = 1.5
+ALIGN_PULSE_GAP = 1.0
+
+DEFAULT_EMON_PERIOD = 0.016
+DEFAULT_THERMALPY_PERIOD = 0.0003
+DEFAULT_DAQ_PERIOD = 0.001
+DEFAULT_CHUNK_SAMPLES = 65536
+_RAW_IDV_BITS = (369, 135, 112)
+_RAW_SAMPLES_PER_FRAME = 1000
+
+
+class FrequencyProfile:
+    """
+    CPU frequency [MHz] and utilization of the synthetic run on the host time line [sec from the capture start].
+    """
+
+    def __init__(self, duration, pulse_offset, seed=0):
+        self.duration = duration
+        pattern = ALIGN_PULSES * (ALIGN_PULSE_DURATION + ALIGN_PULSE_GAP)
+        starts = pulse_offset + numpy.arange(ALIGN_PULSES) * (ALIGN_PULSE_DURATION + ALIGN_PULSE_GAP)
+        end_pattern = duration - pulse_offset - pattern
+        self.pulses = numpy.concatenate([starts, starts - starts[0] + end_pattern])
+        self.workload = (pulse_offset + pattern, end_pattern)
+        if self.workload[1] - self.workload[0] < 2 * pattern:
+            raise ValueError(f'A {duration} sec run is too short for the align patterns')
+
+        rng = numpy.random.default_rng(seed)
+        # Workload frequency: a random walk with 10 Hz knots, kept below the align pulse level
+        self._knots = numpy.arange(self.workload[0], self.workload[1] + 0.1, 0.1)
+        low, high = WORKLOAD_FREQUENCY
+        walk = numpy.cumsum(rng.normal(0, 60, self._knots.shape[0]))
+        self._walk = low + (high - low) * (numpy.sin(walk / 400) + 1) / 2
+
+    def _in_pulse(self, times):
+        position = numpy.searchsorted(self.pulses, times, side='right') - 1
+        return (position >= 0) & (times - self.pulses[numpy.maximum(position, 0)] < ALIGN_PULSE_DURATION)
+
+    def frequency(self, times):
+        times = numpy.asarray(times, dtype=float)
+        in_workload = (times >= self.workload[0]) & (times < self.workload[1])
+        result = numpy.where(in_workload, numpy.interp(times, self._knots, self._walk), IDLE_FREQUENCY)
+        return numpy.where(self._in_pulse(times), MAX_FREQUENCY, result)
+
+    def utilization(self, times):
+        times = numpy.asarray(times, dtype=float)
+        busy = self._in_pulse(times) | ((times >= self.workload[0]) & (times < self.workload[1]))
+        return numpy.where(busy, 1.0, 0.3)
+
+
+def _cpu_layout(cpus, smallcores):
+    return [('bigcore', f'CPU{i}') for i in range(cpus)] + \
+           [('smallcore', f'CPU{i}') for i in range(cpus, cpus + smallcores)]
+
+
+def _emon_header(layout):
+    core_types = [core_type for core_type, _ in layout]
+    lines = [
+        '# SYSTEM INFORMATION FOLLOWS',
+        '# emon db : alderlake',
+        '# num_packages : 1',
+        f'# num_cores_per_package : {len(layout)}',
+        f'# device bigcore : num_events {len(EVENTS)}, num_unit 1',
+        f'# device smallcore : num_events {len(EVENTS)}, num_unit 1',
+        f'# tsc_freq : {TSC_FREQ / 1e6:.2f} MHz',
+        '# END OF SYSTEM INFORMATION',
+        '# GROUPING INFORMATION FOLLOWS',
+        f"# group 0 : {', '.join(EVENTS)}",
+        '# END OF GROUPING INFORMATIONS',
+        '# START OF COLLECTION',
+    ]
+    padding = [''] * (len(EVENTS) - 1)
+    package_row = ['timestamp', '', 'package0'] + [''] * (len(layout) * len(EVENTS) - 1)
+    core_type_row = ['', '']
+    cpu_row = ['epoch', 'timestamp']
+    for position, (core_type, cpu) in enumerate(layout):
+        core_type_row += [core_type if position == 0 or core_types[position - 1] != core_type else ''] + padding
+        cpu_row += [cpu] + padding
+    event_row = ['', ''] + EVENTS * len(layout)
+    return lines + [';'.join(row) + ';' for row in (package_row, core_type_row, cpu_row, event_row)]
+
+
+def write_emon(path, profile, start, stop, start_epoch, cpus=2, smallcores=0, period=DEFAULT_EMON_PERIOD, seed=0,
+               chunk_samples=DEFAULT_CHUNK_SAMPLES):
+    """
+    Write an EMON -V trace sampling the profile from "start" to "stop" [host sec].
+
+    :param start_epoch: target epoch [sec] of the host time 0
+    :return: path
+    """
+    rng = numpy.random.default_rng(seed + 1)
+    layout = _cpu_layout(cpus, smallcores)
+    period_ms = int(round(period * 1000))
+    ends = numpy.arange(start + period, stop, period_ms / 1000)
+
+    with open(path, 'w', newline='') as out_file:
+        out_file.write('\n'.join(_emon_header(layout)) + '\n')
+        for first in range(0, ends.shape[0], chunk_samples):
+            times = ends[first:first + chunk_samples]
+            middles = times - period / 2
+            frequency = profile.frequency(middles)[:, None] * rng.normal(1, 0.01, (times.shape[0], len(layout)))
+            ref_tsc = profile.utilization(middles)[:, None] * TSC_FREQ * period * \
+                rng.uniform(0.97, 1.0, (times.shape[0], len(layout)))
+            thread = frequency * 1e6 * ref_tsc / TSC_FREQ
+            instructions = thread * rng.uniform(0.8, 2.5, thread.shape)
+            counters = numpy.empty((times.shape[0], len(layout), len(EVENTS)))
+            counters[:, :, 0] = instructions
+            counters[:, :, 1] = thread
+            counters[:, :, 2] = ref_tsc
+            counters[:, :, 3] = thread * rng.uniform(0.0, 0.002, thread.shape)
+            counters[:, :, 4] = thread * 6
+            counters[:, :, 5] = instructions * rng.uniform(0.2, 0.6, thread.shape)
+            counters[:, :, 6] = instructions * rng.uniform(0.001, 0.02, thread.shape)
+            counters[:, :, 7] = instructions * rng.uniform(0.002, 0.01, thread.shape)
+            counters[:, :, 8] = 0
+            counters[:, :, 9] = instructions * rng.uniform(0.9, 1.3, thread.shape)
+
+            rows = numpy.empty((times.shape[0], 2 + len(layout) * len(EVENTS)), dtype=numpy.int64)
+            rows[:, 0] = numpy.round((start_epoch + times) * 1000)
+            rows[:, 1] = round(TSC_FREQ * period)
+            rows[:, 2:] = counters.reshape(times.shape[0], -1)
+            numpy.savetxt(out_file, rows, fmt='%d', delimiter=';', newline=';\n')
+    return path
+
+
+def _jittered_times(start, stop, period, rng):
+    count = int((stop - start) / period * 1.1) + 1
+    times = start + numpy.cumsum(rng.uniform(0.67 * period, 1.33 * period, count))
+    return times[times < stop]
+
+
+def thermalpy_frame(profile, start, stop, period=DEFAULT_THERMALPY_PERIOD, seed=0):
+    """
+    Parsed ThermaPy samples of the profile from "start" to "stop" [host sec, 0 is the capture start].
+
+    :return: pandas.DataFrame with the ThermapyDataParser columns ('Time' in ms from the capture start)
+    """
+    rng = numpy.random.default_rng(seed + 2)
+    times = _jittered_times(start, stop, period, rng)
+    frequency = profile.frequency(times) + rng.normal(0, 30, times.shape[0])
+    frame = pandas.DataFrame({'Frame': numpy.arange(times.shape[0]) // _RAW_SAMPLES_PER_FRAME, 'Time': times * 1000})
+    for sensor in ['DTS0', 'DTS1', 'DTS2']:
+        frame[sensor] = 45 + frequency / 150 + rng.normal(0, 1, times.shape[0])
+    frame['ratio'] = frequency / 100
+    frame['Frequency[MHz]'] = frequency
+    frame['cycles'] = (frequency * 300).astype(numpy.int64)
+    return frame
+
+
+def write_raw_capture(path, frame, start_epoch_ms, seed=0):
+    """
+    Write a raw ThermaPy capture with the header and frame layout of a real capture and random IDV payloads for the
+    samples of the parsed frame. A path ending with '.zip' writes a zip archive holding 'thermapy_raw_data.csv'.
+
+    :return: path
+    """
+    rng = numpy.random.default_rng(seed + 3)
+    header = [
+        'ip,core0_t0', 'DescendantsIPs,core0_t0', 'chainLength,20', 'cntrall_numOfBits,28', 'padding_bits,42',
+        f'number_of_samples,{_RAW_SAMPLES_PER_FRAME}', 'active_idvs,20',
+        'thermal_sensors,DTS0,123,DTS1,132,DTS2,141,DTS3,150,DTS5,168', 'default_dts_val,0b10000000',
+        'dts_mask,0b111111111', 'time_padding_bits,57', 'time_freq,38400000.0',
+        'setup,"{\'Product name\': \'synthetic\'}"', 'Start token', f'Start Epoch,{start_epoch_ms}',
+    ]
+    # Random payloads, reused across samples to keep the generation cheap
+    payloads = [[f'IDV,[{bits}b] 0x' + ''.join(rng.choice(list('0123456789ABCDEF'), (bits + 3) // 4))
+                 for bits in _RAW_IDV_BITS] for _ in range(64)]
+    times = frame['Time'].to_numpy()
+
+    def write(out_file):
+        out_file.write('\r\n'.join(header) + '\r\n')
+        for first in range(0, times.shape[0], _RAW_SAMPLES_PER_FRAME):
+            out_file.write(f'IP,core0_t0,Frame:,{first // _RAW_SAMPLES_PER_FRAME + 1},Time:,{times[first]},dt,'
+                           f'{times[first] - times[max(first - _RAW_SAMPLES_PER_FRAME, 0)]}\r\n')
+            count = min(_RAW_SAMPLES_PER_FRAME, times.shape[0] - first)
+            out_file.write(''.join('\r\n'.join(payloads[i % len(payloads)]) + '\r\n' for i in range(count)))
+
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            with archive.open('thermapy_raw_data.csv', 'w') as member:
+                with io.TextIOWrapper(member, newline='') as out_file:
+                    write(out_file)
+    else:
+        with open(path, 'w', newline='') as out_file:
+            write(out_file)
+    return path
+
+
+def daq_frame(profile, start, stop, time_origin, period=DEFAULT_DAQ_PERIOD, seed=0):
+    """
+    DAQ samples of the profile from "start" to "stop" [host sec], time stamped from "time_origin" [sec].
+    """
+    rng = numpy.random.default_rng(seed + 4)
+    times = numpy.arange(start, stop, period)
+    power = profile.frequency(times) / 100 * profile.utilization(times) + rng.normal(0, 1, times.shape[0])
+    return pandas.DataFrame({'TimeStamp': times + time_origin, 'P_IA': power, 'V_IA': 1.1, 'I_IA': power / 1.1})
+
+
+def expected_offset(trace_index, thermalpy_index, shift):
+    """
+    Offset align() should find for a trace: the thermalpy time of the first sample align() keeps from the trace.
+
+    :param trace_index: time index of the loaded trace [sec]
+    :param thermalpy_index: time index of the loaded thermalpy trace [sec]
+    :param shift: trace time minus thermalpy time of the same instant [sec] ('shifts' of synth.json)
+    """
+    trace_index = numpy.asarray(trace_index)
+    start = trace_index[-1] - thermalpy_index[-1]
+    first = trace_index[numpy.searchsorted(trace_index, start, side='left')]
+    return float(first - shift)
+
+
+def generate_run(output_dir, duration=120.0, cpus=2, smallcores=0, emon_period=DEFAULT_EMON_PERIOD,
+                 thermalpy_period=DEFAULT_THERMALPY_PERIOD, daq_period=DEFAULT_DAQ_PERIOD, pulse_offset=5.0,
+                 emon_lead=2.0, daq_lead=1.0, raw_capture=None, seed=0):
+    """
+    Generate the traces of a synthetic run.
+
+    EMON and DAQ start "emon_lead" and "daq_lead" seconds before the ThermaPy capture and all traces stop within a few
+    seconds of each other, like in a real run.
+
+    :param duration: ThermaPy capture duration [sec]
+    :param cpus: number of bigcore logical CPUs
+    :param smallcores: number of smallcore logical CPUs
+    :param pulse_offset: time of the first align pulse from the capture start [sec]
+    :param raw_capture: None, 'csv' or 'zip' to also write a raw ThermaPy capture
+    :return: dict of the run description (also written to '<output_dir>/synth.json')
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    profile = FrequencyProfile(duration, pulse_offset, seed=seed)
+    capture_epoch = 1663070237.0
+    emon_epoch = capture_epoch + 3600.0 + 0.123
+
+    emon_file = write_emon(os.path.join(output_dir, 'emon_raw_data.txt'), profile, -emon_lead, duration + 1.5,
+                           start_epoch=emon_epoch, cpus=cpus, smallcores=smallcores, period=emon_period, seed=seed)
+
+    thermalpy = thermalpy_frame(profile, 0.0, duration, period=thermalpy_period, seed=seed)
+    thermalpy_file = os.path.join(output_dir, 'parsed_thermapy_raw_data.csv')
+    thermalpy.to_csv(thermalpy_file, index=False)
+    raw_file = None
+    if raw_capture:
+        raw_file = write_raw_capture(os.path.join(output_dir, f'thermapy_raw_data.{raw_capture}'), thermalpy,
+                                     start_epoch_ms=capture_epoch * 1000, seed=seed)
+
+    daq_origin = 100.0
+    daq_file = os.path.join(output_dir, 'daq.csv')
+    daq_frame(profile, -daq_lead, duration + 0.5, time_origin=daq_origin, period=daq_period, seed=seed).to_csv(
+        daq_file, index=False)
+
+    run = {
+        'emon_file': emon_file,
+        'thermalpy_file': thermalpy_file,
+        'thermalpy_raw_file': raw_file,
+        'daq_file': daq_file,
+        'duration': duration,
+        'cpus': cpus,
+        'smallcores': smallcores,
+        'periods': {'emon': emon_period, 'thermalpy': thermalpy_period, 'daq': daq_period},
+        'pulses': profile.pulses.tolist(),
+        # trace time - thermalpy time [sec]: EMON is stamped with the target epoch, the DAQ from its own origin
+        'shifts': {'emon': emon_epoch, 'daq': daq_origin},
+        'seed': seed,
+    }
+    with open(os.path.join(output_dir, 'synth.json'), 'w') as out_file:
+        json.dump(run, out_file, indent=4)
+    return run
+
+
+def _parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic EMON, ThermaPy and DAQ traces of a run",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--output-dir", "-o", required=True, help="Directory of the generated traces")
+    parser.add_argument("--duration", type=float, default=120.0, help="ThermaPy capture duration [sec]")
+    parser.add_argument("--cpus", type=int, default=2, help="Number of bigcore logical CPUs")
+    parser.add_argument("--smallcores", type=int, default=0, help="Number of smallcore logical CPUs")
+    parser.add_argument("--emon-period", type=float, default=DEFAULT_EMON_PERIOD, help="EMON sample period [sec]")
+    parser.add_argument("--thermalpy-period", type=float, default=DEFAULT_THERMALPY_PERIOD,
+                        help="Mean ThermaPy sample period [sec]")
+    parser.add_argument("--daq-period", type=float, default=DEFAULT_DAQ_PERIOD, help="DAQ sample period [sec]")
+    parser.add_argument("--pulse-offset", type=float, default=5.0,
+                        help="Time of the first align pulse from the capture start [sec]")
+    parser.add_argument("--raw-capture", choices=['csv', 'zip'], default=None,
+                        help="Also write a raw ThermaPy capture (random IDV payloads)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = _parse_command_line(argv)
+    run = generate_run(args.output_dir, duration=args.duration, cpus=args.cpus, smallcores=args.smallcores,
+                       emon_period=args.emon_period, thermalpy_period=args.thermalpy_period,
+                       daq_period=args.daq_period, pulse_offset=args.pulse_offset, raw_capture=args.raw_capture,
+                       seed=args.seed)
+    print(json.dumps({key: run[key] for key in ('emon_file', 'thermalpy_file', 'daq_file', 'shifts')}, indent=4))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
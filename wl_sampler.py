@@ -2,58 +2,58 @@
 import os
 import time
 import signal
-from  multiprocess import Process
 import subprocess
-from datetime import datetime
 import pickle as pkl
 import json
 import sys
-import pandas as pd
 import argparse
+import asyncio
 import pprint
 import shutil
-from evtar.services.communicator.ux import Communicator, CommunicatorConfig
+from thermapy_parser import load_cache
+from run_timeline import Timeline
+from thermapy_daemon import ThermapyDaemonClient
+from sampler_backends import create_backend
+from emon_transfer import EmonTransfer
+from trace_cache import TraceCache
+from daq_pyramid import build_pyramid, pyramid_path
+from host_resources import PYTHONSV
+from clock_sync import DEFAULT_SAMPLES, communicator_query, estimate_clock, read_clock_sync, sample_clock, \
+    write_clock_sync
+from completion_wait import DEFAULT_INITIAL_INTERVAL, DEFAULT_MAX_INTERVAL, start_exit_watcher, tasklist_probe, \
+    wait_for_completion
 
 DEFAULT_CFG_PATH = r'C:\SVSHARE\WL_Sampler_Infra\wl_sampler_config.json'
+# EMON and NiDAQ keep sampling this long after Thermapy stopped [sec]
+COLLECTOR_STOP_MARGIN = 1
 
-def thermapy_func_wrapper(ip, duration, output_path, app_flow_path, resolution):
-    import __main__
-    import sys
-    import time
-    sys.path.append(app_flow_path)
-    if "cpu" not in __main__.__dict__.keys():
+# The target Communicator, NiDAQ and PythonSV come from the active backend (see sampler_backends), bound by use_backend
+backend = None
+Communicator = None
+CommunicatorConfig = None
 
-        from raptorlake import startrpl_rpp
-        startrpl_rpp.main()
 
-        cpu = __main__.cpu
-    else:
-        cpu = __main__.cpu
+def use_backend(new_backend):
+    """
+    Make the backend the one every collection and post-processing step of this process uses
+    """
+    global backend, Communicator, CommunicatorConfig
+    backend = new_backend
+    Communicator, CommunicatorConfig = new_backend.communicator()
+    return new_backend
 
-    import application_collection as appf
-    time_func = lambda: time.time() * resolution
-    # cannot receive lambda function from outside.
-    appf.collect_application_dts_time_freq(ip=ip, duration=duration, output_path=output_path, time_func=time_func)
 
-        
-    
-def init_common_time(communicator_obj, resolution, time_func):
-    t1 = time_func()
-    target_time = communicator_obj.ExecuteCommandOnTarget(f'echo %date%-%time%', logOutput=False)
-    t2 = time_func()
-    # Calculate how long does it take to receive answer from the target using communicator
-    penalty_time = (t2 - t1) / 2
-    target_time = target_time.split('\r\n')[0]
-    formatted_time = datetime.strptime(target_time, "%a %m/%d/%Y-%H:%M:%S.%f")
-    base_epoch_time = (formatted_time - datetime(1970, 1, 1)).total_seconds() * resolution + penalty_time
-    return base_epoch_time, t2
-    
-    
-def enable_nidaq(nidaq_script_dir, nidaq_calibration_file):
-    sys.path.append(r"C:\Intel\DAQ Controller")
-    sys.path.append(nidaq_script_dir)
-    import DAQ 
-    daq = DAQ.DAQ(nidaq_calibration_file)
+def get_backend(cfg):
+    """
+    :return: the active backend, or the backend of the configuration (made active) when there is none yet
+    """
+    return backend if backend is not None else use_backend(create_backend(cfg))
+
+
+def enable_nidaq(nidaq_script_dir, nidaq_calibration_file, daq=None):
+    # An existing DAQ object (from a previous run) is reused, only the recording is restarted
+    if daq is None:
+        daq = backend.create_daq(nidaq_script_dir, nidaq_calibration_file)
     daq.record()
     return daq
     
@@ -65,50 +65,260 @@ def enable_emon(emon_cmd_params, emon_target_output_path):
     return command_pid
     
 
-def enable_thermapy(ip, raw_data_path, data_collection_duration, launching_duration, lab_path, resolution):
-    thermapy_app_flow_path = os.path.join(lab_path, r'flows\application')
-    thermapy_process = Process(target=thermapy_func_wrapper, kwargs={'ip': ip, 'duration': data_collection_duration, 'output_path': raw_data_path, 'app_flow_path': thermapy_app_flow_path, 'resolution': args.resolution})
-    thermapy_process.start()
+def enable_thermapy(ip, raw_data_path, data_collection_duration, lab_path, resolution):
+    thermapy_process, ready = backend.start_thermapy(ip, raw_data_path, data_collection_duration, lab_path, resolution)
     print(f'Thermapy PID: ', thermapy_process.pid)
-    time.sleep(launching_duration)
-    return thermapy_process
-    
+    return thermapy_process, ready
+
+
+async def wait_for_thermapy(thermapy_process, ready, timeout, interval=0.1):
+    # Readiness is signaled by the ThermaPy child right before it starts collecting
+    deadline = time.monotonic() + timeout
+    while not ready.is_set():
+        if not thermapy_process.is_alive():
+            raise RuntimeError(f'Thermapy process exited with code {thermapy_process.exitcode} before collecting')
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f'Thermapy did not start collecting within {timeout} sec')
+        await asyncio.sleep(interval)
+
+
+async def wait_for_file_growth(path, timeout, interval=0.25):
+    # A trace file on the target that keeps growing means the collector is sampling
+    deadline = time.monotonic() + timeout
+    first_size = None
+    while True:
+        if await asyncio.to_thread(Communicator.IsFile, path=path):
+            size = int(await asyncio.to_thread(Communicator.GetFileSize, sFilePath=path))
+            if first_size is None:
+                first_size = size
+            elif size > first_size:
+                return size
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f'{path} did not grow within {timeout} sec')
+        await asyncio.sleep(interval)
+
+
+async def start_collectors(timeline, nidaq_script_dir, nidaq_calibration_file, emon_cmd_params,
+                           emon_target_output_path, emon_ready_timeout, ip, thermapy_raw_data_path,
+                           data_collection_duration, thermapy_launching_duration, thermapy_lab_path, resolution,
+                           thermapy_daemon=None, daq=None):
+    """
+    Start NiDAQ, EMON and Thermapy concurrently and wait until each of them is really sampling.
+
+    :param thermapy_daemon: ThermapyDaemonClient collecting in a warm PythonSV session (None to start a new process)
+    :param daq: DAQ object to reuse (None to create one)
+    :return: (daq, emon_pid, thermapy process or the daemon client)
+    """
+    async def start_nidaq():
+        with timeline.stage('nidaq start', threaded=True) as record:
+            # DAQ.record() returns once the recording runs
+            return await asyncio.to_thread(timeline.in_thread(record, enable_nidaq), nidaq_script_dir=nidaq_script_dir,
+                                           nidaq_calibration_file=nidaq_calibration_file, daq=daq)
+
+    async def start_emon():
+        with timeline.stage('emon start', threaded=True) as record:
+            emon_pid = await asyncio.to_thread(timeline.in_thread(record, enable_emon), emon_cmd_params=emon_cmd_params,
+                                               emon_target_output_path=emon_target_output_path)
+            await wait_for_file_growth(emon_target_output_path, timeout=emon_ready_timeout)
+            return emon_pid
+
+    async def start_thermapy():
+        with timeline.stage('thermapy start'):
+            if thermapy_daemon is not None:
+                # Returns once collecting (the daemon re-initializes a dropped PythonSV session first)
+                await asyncio.to_thread(thermapy_daemon.start, ip=ip, output_path=thermapy_raw_data_path,
+                                        duration=data_collection_duration, resolution=resolution,
+                                        timeout=thermapy_launching_duration)
+                return thermapy_daemon
+            # Launch PythonSV and then start collecting data
+            thermapy_process, ready = enable_thermapy(ip, thermapy_raw_data_path, data_collection_duration,
+                                                      thermapy_lab_path, resolution)
+            await wait_for_thermapy(thermapy_process, ready, timeout=thermapy_launching_duration)
+            return thermapy_process
+
+    return await asyncio.gather(start_nidaq(), start_emon(), start_thermapy())
+
+
+async def stop_collectors(timeline, daq, emon_pid, thermapy_process):
+    """
+    Stop Thermapy, and then EMON and NiDAQ concurrently.
+
+    The combine step takes the last thermalpy-duration of the EMON and NiDAQ traces, so they must end after the
+    thermalpy trace: a trace ending first would start before the thermalpy trace in that window.
+    """
+    async def stop_thermapy():
+        with timeline.stage('thermapy stop'):
+            if isinstance(thermapy_process, ThermapyDaemonClient):
+                result = await asyncio.to_thread(thermapy_process.stop)
+                print('Thermapy collection stopped' + (f" with error: {result['error']}" if result['error'] else ''))
+                return
+            thermapy_process.kill()
+            print('Terminating Thermapy...')
+            await asyncio.to_thread(thermapy_process.join)
+
+    async def stop_emon():
+        with timeline.stage('emon stop', threaded=True) as record:
+            await asyncio.to_thread(timeline.in_thread(record, Communicator.KillCommandOnTarget), pid=str(emon_pid))
+            print('Terminating Emon...')
+
+    async def stop_nidaq():
+        with timeline.stage('nidaq stop', threaded=True) as record:
+            await asyncio.to_thread(timeline.in_thread(record, daq.stop_record))
+            print('Terminating NIDAQ')
+
+    await stop_thermapy()
+    await asyncio.sleep(COLLECTOR_STOP_MARGIN)
+    await asyncio.gather(stop_emon(), stop_nidaq())
+
+
+def daq_align(timeline, align_cmd, align_dir, settle_duration, name):
+    # The idle periods around the align pattern keep it distinguishable from the workload
+    with timeline.stage(name):
+        time.sleep(settle_duration)
+        try:
+            Communicator.ExecuteCommandOnTarget(command=align_cmd, sCommandCwd=align_dir)
+        except:
+            pass
+        time.sleep(settle_duration)
+
+
+def fetch_emon_output(emon_target_output_path, emon_host_output_path, target_dir, emon_transfer=None):
+    if emon_transfer is not None:
+        # Most of the trace was pulled during the run - pull the rest, verify it and keep the parsed trace for the
+        # combine step
+        emon_host_output_path, emon_trace = emon_transfer.finish()
+        if emon_trace is not None:
+            emon_transfer.store(TraceCache(), emon_trace)
+    else:
+        if not Communicator.IsFile(path=emon_target_output_path):
+            return None
+        print(f"Emon created a trace file of size: {Communicator.GetFileSize(sFilePath=emon_target_output_path)}")
+
+        # Sync files between host & target
+        Communicator.GetFileFromTarget(sourceFileLocation=emon_target_output_path, whereToStore=emon_host_output_path)
+    print(f"{emon_target_output_path} -> {emon_host_output_path}")
+
+    # Remove output dir in target
+    Communicator.ExecuteCommandOnTarget(command=f'rmdir /S /Q {target_dir}')
+    return emon_host_output_path
+
+
+async def collect_outputs(timeline, emon_target_output_path, emon_host_output_path, target_dir, nidaq_output_file,
+                          host_nidaq_output_file, emon_transfer=None, daq_channels=None, daq_resolutions=None):
+    """
+    Fetch the EMON trace and copy the NiDAQ trace concurrently. With pyramid resolutions, the copied NiDAQ trace is also
+    streamed into a DAQ pyramid next to it (see daq_pyramid), which the combine step then reads.
+
+    :param daq_channels: NiDAQ channels kept in the pyramid (None for all)
+    :param daq_resolutions: bin widths of the pyramid levels [sec] (None for no pyramid)
+    :return: (EMON host path (None if EMON did not create a trace), host DAQ trace path: the pyramid directory when one
+        is built, else the copied NiDAQ CSV)
+    """
+    async def fetch_emon():
+        with timeline.stage('emon fetch', threaded=True) as record:
+            return await asyncio.to_thread(timeline.in_thread(record, fetch_emon_output), emon_target_output_path,
+                                           emon_host_output_path, target_dir, emon_transfer)
+
+    async def copy_nidaq():
+        # The raw trace is always kept: the next recording overwrites the NiDAQ output file
+        with timeline.stage('nidaq copy', threaded=True) as record:
+            await asyncio.to_thread(timeline.in_thread(record, shutil.copyfile), nidaq_output_file,
+                                    host_nidaq_output_file)
+        if not daq_resolutions:
+            return host_nidaq_output_file
+        with timeline.stage('nidaq ingest', threaded=True) as record:
+            return await asyncio.to_thread(timeline.in_thread(record, build_pyramid), host_nidaq_output_file,
+                                           pyramid_path(host_nidaq_output_file), channels=daq_channels,
+                                           resolutions=daq_resolutions)
+
+    return await asyncio.gather(fetch_emon(), copy_nidaq())
+
 
 def thermapy_post_processing(lab_path, raw_data_path, parsed_output_file):
-    sys.path.append(lab_path)
-    from thermapy_app_parser.thermapy_data_parse import ThermapyDataParser 
-    parser = ThermapyDataParser()
-    parser.parse_file(input_file=raw_data_path, output_file=parsed_output_file)
-    parsed_df = pd.read_csv(parsed_output_file)
-    parsed_df.to_csv(parsed_output_file, index=False)
-    return parsed_df
+    # Decode the capture and convert the parsed CSV once into a memory-mappable columnar cache that the combine step
+    # loads directly
+    return backend.parse_thermapy(lab_path, raw_data_path, parsed_output_file)
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='.')
-    parser.add_argument('--cfg_path', type=str, required=False, default=DEFAULT_CFG_PATH, help='.')
-    parser.add_argument('--resolution', type=int, required=False, default=1, help='.')
-    args = parser.parse_args()
 
-    
-    time_func = lambda: time.time() * args.resolution
-    # read json config
-    with open(args.cfg_path) as f:
-        cfg = json.load(f)
-        
-    pp = pprint.PrettyPrinter(indent=4)
-    print(f"Input Configurations from: {args.cfg_path}")
-    print(pp.pprint(cfg))
-    
- 
-    # base_epoch_time, t2 = init_common_time(Communicator, resolution=args.resolution, time_func=time_func)
+def warm_combine():
+    """
+    Import the combine step and its heavy dependencies ahead of the first run (e.g. as the initializer of the
+    post-processing worker processes), so no run pays for the imports
+    """
+    import scipy.signal
+    import thermapy_emon_combine
+
+
+def combine_in_process(cfg, emon_file, thermapy_cache_dir, thermapy_raw_file, output_file, timeline,
+                       clock_sync_file=None, daq_file=None):
+    """
+    Combine the traces of a run by calling thermapy_emon_combine.align in this process. The parsed ThermaPy trace is
+    handed over as the frame of the ThermaPy cache, and the parsed EMON trace is taken from the trace cache the EMON
+    transfer filled.
+
+    :param daq_file: NiDAQ CSV trace or DAQ pyramid directory of the run (None to combine without DAQ)
+    :return: the align() result dict
+    """
+    import thermapy_emon_combine
+    from trace_output import DTYPE_POLICIES
+
+    thermalpy_trace = load_cache(thermapy_cache_dir).set_index('Time')
+    clock_sync = read_clock_sync(clock_sync_file) if clock_sync_file else None
+    with timeline.stage('combine'):
+        return thermapy_emon_combine.align(
+            emon_file, thermalpy_trace, daq_file, output_file, thermalpy_raw_file=thermapy_raw_file, cache=TraceCache(),
+            report_mode=cfg.get('combine_report') or 'decimated', clock_sync=clock_sync,
+            dtype_policy=DTYPE_POLICIES[cfg.get('combine_dtype_policy') or 'keep'],
+            chunk_rows=cfg.get('combine_chunk_rows'), timeline=timeline)
+
+
+def load_config(cfg_path):
+    with open(cfg_path) as f:
+        return json.load(f)
+
+
+def connect_target(cfg):
+    get_backend(cfg)
+    CommunicatorConfig.Target.IsConnectedTimeoutSec = cfg.get('Target.IsConnectedTimeoutSec')
+    CommunicatorConfig.Target.DefaultPeer2PeerIP = cfg.get('Target.DefaultPeer2PeerIP')
+    print(f"Is Target Connected: {Communicator.IsConnected()}")
+
+
+def connect_thermapy_daemon(cfg, timeline):
+    # Connect to (or launch) the warm Thermapy collector
+    thermapy_daemon_address = cfg.get('thermapy_daemon_address')
+    if not thermapy_daemon_address:
+        return None
+    with timeline.stage('thermapy daemon'):
+        thermapy_daemon = get_backend(cfg).connect_thermapy_daemon(cfg.get('thermapy_lab_code_path'),
+                                                                   thermapy_daemon_address)
+        if thermapy_daemon is None:
+            return None
+        print(f"Thermapy daemon: {thermapy_daemon.health()}")
+    return thermapy_daemon
+
+
+def run_collection(cfg, host_dir, timeline, resolution, thermapy_daemon=None, daq=None, resources=None):
+    """
+    Collect a single run: start the collectors, run the workload between the two DAQ align patterns, stop the
+    collectors and bring the target-side and DAQ outputs to the host directory. Everything that needs the target or
+    the DAQ is done here, so that post_process_run can overlap with the next collection.
+
+    :param cfg: wl_sampler configuration
+    :param host_dir: run output directory on the host
+    :param thermapy_daemon: ThermapyDaemonClient (None to start a Thermapy process)
+    :param daq: DAQ object to reuse (None to create one)
+    :param resources: host_resources.HostResources shared with other DUTs, held from the collectors start until the
+        NiDAQ output is on the host (the PythonSV session only until the collectors stop)
+    :return: dict of the collected files ('emon_file', 'thermapy_raw_file', 'daq_file', 'clock_sync_file') and the
+        'daq' object
+    """
     # Extracts configurations from static file
     emon_output_filename = cfg.get('emon_output_filename')
     emon_cmd_params = cfg.get('emon_cmd_params')
     target_dir = cfg.get('target_dir')
-    host_dir = cfg.get('host_dir')
     # Create output dir in host
-    if not os.path.isdir(host_dir):
-        os.mkdir(host_dir)
+    os.makedirs(host_dir, exist_ok=True)
 
     ip = cfg.get('thermapy_ip_target')
     data_collection_duration = None
@@ -118,106 +328,210 @@ if __name__ == '__main__':
     wl_dir = cfg.get('wl_dir')
     wl_cmd = cfg.get('wl_cmd')
     wl_duration = cfg.get('wl_duration')
+    wl_wait_mode = cfg.get('wl_wait_mode', 'watcher')
+    wl_poll_interval = cfg.get('wl_poll_interval', DEFAULT_INITIAL_INTERVAL)
+    wl_poll_max_interval = cfg.get('wl_poll_max_interval', DEFAULT_MAX_INTERVAL)
     align_dir = cfg.get('alignment_exe_dir')
     align_cmd = cfg.get('alignment_exe_cmd')
-    speed_cmd = cfg.get('speed_cmd')
-    speed_combine_script = cfg.get('speed_combine_script')
-    speed_output_filename = cfg.get('speed_output_filename')
     nidaq_script_dir = cfg.get('nidaq_script_dir')
     nidaq_calibration_file = cfg.get('nidaq_calibration_file')
     nidaq_output_file = cfg.get('nidaq_output_file')
-    
-    # ###
-    # speed_output_path = os.path.join(host_dir, speed_output_filename)
-    # cmd_list = [speed_cmd, 'run', speed_combine_script, '--emon-file', r'C:\Users\mvhlab\Desktop\wl_sampler_host_data\emon_raw_data.txt, '--thermalpy-file', r"C:\Users\mvhlab\Desktop\wl_sampler_host_data\parsed_thermapy_raw_data.csv", '--output-file', r"C:\Users\mvhlab\Desktop\wl_sampler_host_data\out.csv"]
-    # speed_output = subprocess.run(cmd_list, shell=False)
-    # raise ValueError()
-    # ###
-    
-    CommunicatorConfig.Target.IsConnectedTimeoutSec = cfg.get('Target.IsConnectedTimeoutSec')
-    CommunicatorConfig.Target.DefaultPeer2PeerIP = cfg.get('Target.DefaultPeer2PeerIP')
-    print(f"Is Target Connected: {Communicator.IsConnected()}")
-    
+    emon_ready_timeout = cfg.get('emon_ready_timeout', 30)
+    align_settle_duration = cfg.get('align_settle_duration', 1)
+    emon_transfer_interval = cfg.get('emon_transfer_interval')
+    emon_transfer_compress = cfg.get('emon_transfer_compress', True)
+    clock_sync_samples = cfg.get('clock_sync_samples', DEFAULT_SAMPLES)
+
     # Create output dir in target
-    Communicator.ExecuteCommandOnTarget(command=f'mkdir {target_dir}')
-    
-  
-    # Enabling nidaq
-    daq = enable_nidaq(nidaq_script_dir=nidaq_script_dir, nidaq_calibration_file=nidaq_calibration_file)
-  
-    # Enabling Emon
-    emon_target_output_path = os.path.join(target_dir, emon_output_filename)
-    emon_pid = enable_emon(emon_cmd_params=emon_cmd_params, emon_target_output_path=emon_target_output_path)
+    with timeline.stage('target mkdir'):
+        Communicator.ExecuteCommandOnTarget(command=f'mkdir {target_dir}')
+
+    # Clock exchanges before and after the run, outside of the sampled interval. The host clock is the ThermaPy
+    # time_func in the units of the parsed trace Time axis [sec]
+    clock_query = communicator_query(Communicator)
+    clock_func = lambda: time.time() * resolution / 1000
+    clock_bursts = []
+    if clock_sync_samples:
+        with timeline.stage('clock sync (start)'):
+            clock_bursts.append(sample_clock(clock_query, count=clock_sync_samples, time_func=clock_func))
 
-    # Run Thermapy - launch PythonSV and then start collecting data
+    if resources is not None:
+        with timeline.stage('host resources wait'):
+            resources.acquire()
+
+    # Enabling nidaq, Emon and Thermapy
+    emon_target_output_path = os.path.join(target_dir, emon_output_filename)
     thermapy_raw_data_path = os.path.join(host_dir, thermapy_output_filename)
-    thermapy_process = enable_thermapy(ip, thermapy_raw_data_path, data_collection_duration, thermapy_launching_duration, thermapy_lab_path, args.resolution)
-	# DAQ Align
-    time.sleep(1)
-    try:
-        Communicator.ExecuteCommandOnTarget(command=align_cmd, sCommandCwd=align_dir)
-    except:
-        pass
-    time.sleep(1)
-	
+    daq, emon_pid, thermapy_process = asyncio.run(start_collectors(
+        timeline, nidaq_script_dir=nidaq_script_dir, nidaq_calibration_file=nidaq_calibration_file,
+        emon_cmd_params=emon_cmd_params, emon_target_output_path=emon_target_output_path,
+        emon_ready_timeout=emon_ready_timeout, ip=ip, thermapy_raw_data_path=thermapy_raw_data_path,
+        data_collection_duration=data_collection_duration, thermapy_launching_duration=thermapy_launching_duration,
+        thermapy_lab_path=thermapy_lab_path, resolution=resolution, thermapy_daemon=thermapy_daemon, daq=daq))
+
+    # Pull the EMON trace in increments while the workload runs (between the completion checks)
+    emon_host_output_path = os.path.join(host_dir, emon_output_filename)
+    emon_transfer = None
+    if emon_transfer_interval:
+        emon_transfer = EmonTransfer(Communicator, emon_target_output_path, emon_host_output_path,
+                                     chunk_path=os.path.join(target_dir, 'emon_chunk.tmp'),
+                                     compress=emon_transfer_compress, interval=emon_transfer_interval,
+                                     timeline=timeline)
+
+    daq_align(timeline, align_cmd, align_dir, align_settle_duration, 'daq align (start)')
+
     # Run WL
-    wl_pid = Communicator.ExecuteCommandOnTargetAsync(command=wl_cmd, bOrphan=False, sCommandCwd=wl_dir)
-    wl_start_time = time.time()
+    timeline.mark('wl start')
+    with timeline.stage('wl launch'):
+        wl_pid = Communicator.ExecuteCommandOnTargetAsync(command=wl_cmd, bOrphan=False, sCommandCwd=wl_dir)
+    wl_start_time = time.monotonic()
     print(f"WL PID={wl_pid}")
-    while True:
-        try:
-            res = Communicator.ExecuteCommandOnTarget(f'tasklist | find "{wl_pid}"', logOutput=False) 
-        except:
-            break
-        if wl_duration is not None and time.time() - wl_start_time >= wl_duration:
-            break
-            
-    Communicator.KillCommandOnTarget(pid=str(wl_pid))
+    if wl_wait_mode == 'tasklist':
+        wl_probe = tasklist_probe(Communicator, wl_pid)
+    else:
+        wl_probe = start_exit_watcher(Communicator, wl_pid, marker_path=os.path.join(target_dir, 'wl_exited.marker'))
+    with timeline.stage('wl wait'):
+        wl_wait = wait_for_completion(wl_probe, timeout=wl_duration, initial_interval=wl_poll_interval,
+                                      max_interval=wl_poll_max_interval, start_time=wl_start_time,
+                                      between_checks=None if emon_transfer is None else emon_transfer.poll)
+    print(f"WL wait: {wl_wait}")
+
+    with timeline.stage('wl kill'):
+        Communicator.KillCommandOnTarget(pid=str(wl_pid))
     print('Terminating WL...')
-	# DAQ Align
-    time.sleep(1)
-    try:
-        Communicator.ExecuteCommandOnTarget(command=align_cmd, sCommandCwd=align_dir)
-    except:
-        pass
-		
-    time.sleep(1)
-    thermapy_process.kill()
-    print('Terminating Thermapy...')
-    time.sleep(1)
-    thermapy_process.join()
-    
-    Communicator.KillCommandOnTarget(pid=str(emon_pid))
-    print('Terminating Emon...')
-    time.sleep(1)
-    
-    daq.stop_record()
-    print('Terminating NIDAQ')
-    time.sleep(1)
-	
-    if Communicator.IsFile(path=emon_target_output_path):
-        print(f"Emon created a trace file of size: {Communicator.GetFileSize(sFilePath=emon_target_output_path)}")
-        
-        # Sync files between host & target
-        emon_host_output_path = os.path.join(host_dir, emon_output_filename)
-        Communicator.GetFileFromTarget(sourceFileLocation=emon_target_output_path, whereToStore=emon_host_output_path)
-        print(f"{emon_target_output_path} -> {emon_host_output_path}")
-        
-        # Remove output dir in target
-        Communicator.ExecuteCommandOnTarget(command=f'rmdir /S /Q {target_dir}')  
-        
+    timeline.mark('wl stop')
+
+    daq_align(timeline, align_cmd, align_dir, align_settle_duration, 'daq align (end)')
+
+    # Stopping Thermapy, Emon and nidaq
+    asyncio.run(stop_collectors(timeline, daq, emon_pid, thermapy_process))
+    if resources is not None:
+        resources.release(PYTHONSV)
+
+    clock_sync_file = None
+    if clock_sync_samples:
+        with timeline.stage('clock sync (end)'):
+            clock_bursts.append(sample_clock(clock_query, count=clock_sync_samples, time_func=clock_func))
+        try:
+            clock_model = estimate_clock(clock_bursts)
+            clock_sync_file = write_clock_sync(os.path.join(host_dir, 'clock_sync.json'), {'emon': clock_model},
+                                               resolution=resolution)
+            print(f"Target clock: offset {clock_model['offset']:.6f} sec, drift {clock_model['drift'] * 1e6:.2f} ppm, "
+                  f"uncertainty {clock_model['uncertainty'] * 1000:.1f} ms")
+        except ValueError as e:
+            print(f'Clock sync failed, the traces are aligned by correlation only: {e}')
+
+    # Sync Emon trace from the target and move daq output to host location
+    host_nidaq_output_file = os.path.join(host_dir, os.path.basename(nidaq_output_file))
+    emon_host_output_path, host_nidaq_output_file = asyncio.run(collect_outputs(
+        timeline, emon_target_output_path=emon_target_output_path,
+        emon_host_output_path=emon_host_output_path, target_dir=target_dir, nidaq_output_file=nidaq_output_file,
+        host_nidaq_output_file=host_nidaq_output_file, emon_transfer=emon_transfer,
+        daq_channels=cfg.get('daq_channels'), daq_resolutions=cfg.get('daq_pyramid_resolutions')))
+    if resources is not None:
+        resources.release()
+
+    return {
+        'emon_file': emon_host_output_path,
+        'thermapy_raw_file': thermapy_raw_data_path,
+        'daq_file': host_nidaq_output_file,
+        'clock_sync_file': clock_sync_file,
+        'daq': daq,
+    }
+
+
+def post_process_run(cfg, host_dir, emon_file, thermapy_raw_file, timeline=None, clock_sync_file=None, daq_file=None):
+    """
+    Parse the Thermapy capture and combine the traces of a collected run, with speed or (with 'combine_in_process'
+    set) by calling the combine in this process (see combine_in_process). Needs neither the target nor the
+    collectors, so it can run in a worker process while the next run collects.
+
+    :param timeline: Timeline to record into (None to record and save a 'post_process_timeline.json' and its
+        'post_process_trace.json' Chrome trace of its own)
+    :param clock_sync_file: clock_sync.json of the run, used by the combine to place the EMON trace
+    :param daq_file: host DAQ trace of the run (the 'daq_file' of run_collection), None to combine without DAQ
+    :return: path of the combined trace
+    """
+    # A post-processing worker process binds the backend of the configuration
+    get_backend(cfg)
+    own_timeline = timeline is None
+    timeline = Timeline() if own_timeline else timeline
+    thermapy_output_filename = cfg.get('thermapy_output_filename')
+
     # Parsing Thermapy raw data
     thermapy_parsed_output_file = os.path.join(host_dir, f'parsed_{thermapy_output_filename}')
-    thermapy_post_processing(thermapy_lab_path, thermapy_raw_data_path, thermapy_parsed_output_file)
-    
-    # Move daq output to host location
-    host_nidaq_output_file = os.path.join(host_dir, os.path.basename(nidaq_output_file))
-    shutil.copyfile(nidaq_output_file, host_nidaq_output_file)
-    
+    with timeline.stage('thermapy parse'):
+        thermapy_cache_dir = thermapy_post_processing(cfg.get('thermapy_lab_code_path'), thermapy_raw_file,
+                                                      thermapy_parsed_output_file)
+
+    speed_output_path = os.path.join(host_dir, cfg.get('speed_output_filename'))
+    if cfg.get('combine_in_process'):
+        speed_output_path = combine_in_process(cfg, emon_file, thermapy_cache_dir, thermapy_raw_file,
+                                               speed_output_path, timeline,
+                                               clock_sync_file=clock_sync_file, daq_file=daq_file)['output_file']
+        if own_timeline:
+            timeline.write(os.path.join(host_dir, 'post_process_timeline.json'))
+            timeline.write_chrome_trace(os.path.join(host_dir, 'post_process_trace.json'))
+        return speed_output_path
+
     # Speed combine
-    speed_output_path = os.path.join(host_dir, speed_output_filename)
-    cmd_list = [speed_cmd, 'run', speed_combine_script, '--emon-file', emon_host_output_path, '--thermalpy-file', thermapy_parsed_output_file, '--output-file', speed_output_path]
+    cmd_list = [cfg.get('speed_cmd'), 'run', cfg.get('speed_combine_script'), '--emon-file', emon_file, '--thermalpy-file', thermapy_cache_dir, '--output-file', speed_output_path]
+    if daq_file:
+        cmd_list += ['--daq-file', daq_file]
+    if clock_sync_file:
+        cmd_list += ['--clock-sync', clock_sync_file]
+    if cfg.get('combine_chunk_rows'):
+        cmd_list += ['--chunk-rows', str(cfg.get('combine_chunk_rows'))]
+    if cfg.get('combine_dtype_policy'):
+        cmd_list += ['--dtype-policy', cfg.get('combine_dtype_policy')]
     print(cmd_list)
-    speed_output = subprocess.run(cmd_list, shell=False)
+    with timeline.stage('speed combine'):
+        speed_output = subprocess.run(cmd_list, shell=False)
+    if speed_output.returncode != 0:
+        raise RuntimeError(f'speed combine failed with exit code {speed_output.returncode}')
+
+    if own_timeline:
+        timeline.write(os.path.join(host_dir, 'post_process_timeline.json'))
+        timeline.write_chrome_trace(os.path.join(host_dir, 'post_process_trace.json'))
+    return speed_output_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='.')
+    parser.add_argument('--cfg_path', type=str, required=False, default=DEFAULT_CFG_PATH, help='.')
+    parser.add_argument('--resolution', type=int, required=False, default=1, help='.')
+    parser.add_argument('--profile', type=str, required=False, default=None,
+                        help='Profile every occurrence of this timeline stage with cProfile (e.g. "emon fetch", '
+                             '"thermapy parse", "combine"); the profiles are written to the host directory')
+    args = parser.parse_args()
+
+    
+    # read json config
+    cfg = load_config(args.cfg_path)
+        
+    pp = pprint.PrettyPrinter(indent=4)
+    print(f"Input Configurations from: {args.cfg_path}")
+    print(pp.pprint(cfg))
+    
+ 
+    host_dir = cfg.get('host_dir')
+    os.makedirs(host_dir, exist_ok=True)
+    timeline = Timeline(profile=args.profile, profile_dir=host_dir)
+    
+    # ###
+    # speed_output_path = os.path.join(host_dir, speed_output_filename)
+    # cmd_list = [speed_cmd, 'run', speed_combine_script, '--emon-file', r'C:\Users\mvhlab\Desktop\wl_sampler_host_data\emon_raw_data.txt, '--thermalpy-file', r"C:\Users\mvhlab\Desktop\wl_sampler_host_data\parsed_thermapy_raw_data.csv", '--output-file', r"C:\Users\mvhlab\Desktop\wl_sampler_host_data\out.csv"]
+    # speed_output = subprocess.run(cmd_list, shell=False)
+    # raise ValueError()
+    # ###
+    
+    connect_target(cfg)
+    thermapy_daemon = connect_thermapy_daemon(cfg, timeline)
+    collected = run_collection(cfg, host_dir, timeline, args.resolution, thermapy_daemon=thermapy_daemon)
+    post_process_run(cfg, host_dir, collected['emon_file'], collected['thermapy_raw_file'], timeline=timeline,
+                     clock_sync_file=collected['clock_sync_file'], daq_file=collected['daq_file'])
+
+    print(timeline.format())
+    timeline.write(os.path.join(host_dir, 'timeline.json'))
+    timeline.write_chrome_trace(os.path.join(host_dir, 'timeline_trace.json'))
     print("Finished.")
-    
\ No newline at end of file